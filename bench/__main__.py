@@ -0,0 +1,226 @@
+"""Load test the bridge against a fake homeserver and a simulated device fleet.
+
+Run from the repository root, e.g.:
+
+    python -m bench --devices 50 --rate 200 --duration 30 --hs-latency 0.02
+
+The bridge runs under uvicorn in its own process, with a configuration
+generated from bridge.yaml.sample and a freshly seeded SQLite database in
+a temporary directory. Use --set to override configuration values.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import aiohttp
+import yaml
+from aiohttp import web
+
+from bench.fleet import DeviceFleet
+from bench.homeserver import FakeHomeserver
+from bench.load import LoadGenerator
+
+ROOT = Path(__file__).resolve().parent.parent
+DOMAIN = "bench.local"
+SENDER = f"@bench:{DOMAIN}"
+MANAGEMENT_ROOM = f"!management:{DOMAIN}"
+
+
+def _arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=20, help="Simulated devices")
+    parser.add_argument("--rate", type=float, default=50, help="Transactions per second")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds to send for")
+    parser.add_argument("--events-per-txn", type=int, default=1)
+    parser.add_argument("--management-ratio", type=float, default=0.05, help="Share of management room commands")
+    parser.add_argument("--hs-latency", type=float, default=0.0, help="Seconds added to each homeserver request")
+    parser.add_argument("--hs-jitter", type=float, default=0.0)
+    parser.add_argument("--hs-429-ratio", type=float, default=0.0, help="Share of homeserver requests refused with 429")
+    parser.add_argument("--device-latency", type=float, default=0.0, help="Seconds each device command takes")
+    parser.add_argument("--device-jitter", type=float, default=0.0)
+    parser.add_argument("--device-error-ratio", type=float, default=0.0)
+    parser.add_argument("--drain-timeout", type=float, default=30, help="Seconds to wait for the last replies")
+    parser.add_argument("--hs-port", type=int, default=18008)
+    parser.add_argument("--bridge-port", type=int, default=18009)
+    parser.add_argument("--device-port", type=int, default=19000, help="First port of the device fleet")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="SECTION.KEY=VALUE",
+        help="Override a bridge configuration value, e.g. homeserver.requests_per_second=100",
+    )
+    parser.add_argument("--output", default="bench_output.txt", help="File the report is written to")
+    return parser.parse_args()
+
+
+def _configuration(args: argparse.Namespace, workdir: Path) -> Dict[str, Any]:
+    with open(ROOT / "bridge.yaml.sample") as f:
+        conf = yaml.safe_load(f)
+
+    conf["homeserver"].update(address=f"http://127.0.0.1:{args.hs_port}", domain=DOMAIN)
+    conf["appservice"].update(
+        port=args.bridge_port,
+        database=f"sqlite:///{workdir / 'bench.db'}",
+        persist_flows=False,
+    )
+    conf["logging"] = {"format": "text", "level": "WARNING"}
+    # Only the message path is measured
+    conf.setdefault("devices", {})["health_interval"] = 0
+
+    for override in args.set:
+        path, value = override.split("=", 1)
+        section, key = path.split(".", 1)
+        conf.setdefault(section, {})[key] = yaml.safe_load(value)
+
+    return conf
+
+
+def _seed(workdir: Path, hosts: List[str]) -> List[str]:
+    """Create the schema, the bot and its room, and one entity per device."""
+    script = f"""
+import asyncio
+from mautrix_iot.db.database import Session, _initial_db_population, engine, upgrade_database
+from mautrix_iot.db.models import Entity, Room
+from mautrix_iot.db.operations import update_bot_room
+from mautrix_iot.utils import bot_full_name
+
+async def seed():
+    await upgrade_database()
+    await _initial_db_population()
+    await update_bot_room({MANAGEMENT_ROOM!r}, bot_full_name())
+    async with Session() as db:
+        for i, host in enumerate({hosts!r}):
+            device = Entity(
+                name=f"bench{{i}}",
+                host=host,
+                matrix_id=f"iot_bench{{i}}",
+                access_token=f"token{{i}}",
+                is_device=True,
+            )
+            db.add(Room(id=f"!bench{{i}}:{DOMAIN}", entity=device, user_matrix_id={SENDER!r}))
+    await engine.dispose()
+
+asyncio.run(seed())
+"""
+    subprocess.run([sys.executable, "-c", script], cwd=workdir, env=_environment(), check=True)
+
+    return [f"!bench{i}:{DOMAIN}" for i in range(len(hosts))]
+
+
+def _environment() -> Dict[str, str]:
+    return {**os.environ, "PYTHONPATH": os.pathsep.join([str(ROOT), os.environ.get("PYTHONPATH", "")])}
+
+
+async def _wait_for_bridge(url: str, hs_token: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.post(
+                    f"{url}/_matrix/app/v1/ping", headers={"Authorization": f"Bearer {hs_token}"}
+                ) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+
+    raise TimeoutError("The bridge did not start")
+
+
+async def _bridge_metrics(url: str, hs_token: str) -> List[str]:
+    wanted = ("mautrix_iot_queue_items", "mautrix_iot_messages", "mautrix_iot_rate_limit")
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(
+                f"{url}/metrics", headers={"Authorization": f"Bearer {hs_token}"}
+            ) as response:
+                text = await response.text()
+    except aiohttp.ClientError:
+        return []
+
+    return [line for line in text.splitlines() if line.startswith(wanted)]
+
+
+async def main() -> None:
+    args = _arguments()
+
+    fleet = DeviceFleet(
+        args.devices, args.device_port, args.device_latency, args.device_jitter, args.device_error_ratio
+    )
+    homeserver = FakeHomeserver(DOMAIN, args.hs_latency, args.hs_jitter, args.hs_429_ratio)
+
+    with tempfile.TemporaryDirectory(prefix="mautrix-iot-bench-") as tmp:
+        workdir = Path(tmp)
+        conf = _configuration(args, workdir)
+        with open(workdir / "bridge.yaml", "w") as f:
+            yaml.safe_dump(conf, f)
+
+        rooms = _seed(workdir, fleet.hosts)
+        bridge_url = f"http://127.0.0.1:{args.bridge_port}"
+
+        load = LoadGenerator(
+            bridge_url,
+            conf["appservice"]["hs_token"],
+            rooms,
+            MANAGEMENT_ROOM,
+            SENDER,
+            args.rate,
+            args.duration,
+            args.events_per_txn,
+            args.management_ratio,
+        )
+        homeserver.on_message = load.on_message
+
+        runner = web.AppRunner(homeserver.app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", args.hs_port).start()
+        await fleet.start()
+
+        bridge = subprocess.Popen(
+            [
+                sys.executable, "-m", "uvicorn", "mautrix_iot.main:app",
+                "--host", "127.0.0.1", "--port", str(args.bridge_port), "--log-level", "warning",
+            ],
+            cwd=workdir,
+            env=_environment(),
+        )
+
+        try:
+            await _wait_for_bridge(bridge_url, conf["appservice"]["hs_token"])
+            await load.run(args.drain_timeout)
+            metrics = await _bridge_metrics(bridge_url, conf["appservice"]["hs_token"])
+        finally:
+            bridge.terminate()
+            bridge.wait(timeout=60)
+            await fleet.stop()
+            await runner.cleanup()
+
+    report = [
+        f"Devices: {args.devices}, homeserver latency {args.hs_latency * 1000:.0f} ms, "
+        f"429 ratio {args.hs_429_ratio:.2f}, device latency {args.device_latency * 1000:.0f} ms",
+        *load.report(),
+        f"Homeserver 429s injected: {homeserver.rate_limited}",
+        "Homeserver requests:",
+        *(f"  {line}" for line in homeserver.summary()),
+        "Bridge metrics:",
+        *(f"  {line}" for line in metrics),
+    ]
+
+    print("\n".join(report))
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write("\n".join(report) + "\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
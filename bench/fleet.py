@@ -0,0 +1,81 @@
+import asyncio
+import random
+from typing import List
+
+from aiohttp import web
+
+COMMANDS = [
+    {"name": "on", "alias": "", "description": "Turn the device on", "args": ["id"]},
+    {"name": "off", "alias": "", "description": "Turn the device off", "args": ["id"]},
+    {"name": "status", "alias": "", "description": "Current state", "args": ["id"]},
+]
+
+
+class DeviceFleet:
+    """``count`` simulated devices, each listening on its own port.
+
+    Commands take ``latency`` seconds (plus up to ``jitter``) and fail
+    with a 500 for an ``error_ratio`` share of them. The first argument
+    of a command is echoed back, so a reply can be matched to its request.
+    """
+
+    def __init__(
+        self,
+        count: int,
+        base_port: int,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_ratio: float = 0.0,
+    ):
+        self.count = count
+        self.base_port = base_port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_ratio = error_ratio
+
+        self.commands = 0
+        self.errors = 0
+        self._runner: web.AppRunner = None
+
+        self.app = web.Application()
+        self.app.add_routes(
+            [
+                web.get("/api/v1/ping", self.ping),
+                web.get("/api/v1/commands", self.list_commands),
+                web.post("/api/v1/command", self.command),
+            ]
+        )
+
+    @property
+    def hosts(self) -> List[str]:
+        return [f"http://127.0.0.1:{self.base_port + i}" for i in range(self.count)]
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+
+        for i in range(self.count):
+            await web.TCPSite(self._runner, "127.0.0.1", self.base_port + i).start()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def ping(self, request: web.Request) -> web.Response:
+        return web.json_response({})
+
+    async def list_commands(self, request: web.Request) -> web.Response:
+        return web.json_response(COMMANDS, headers={"ETag": '"bench"'})
+
+    async def command(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.commands += 1
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if random.random() < self.error_ratio:
+            self.errors += 1
+            return web.Response(status=500, text=f"failed {' '.join(body['args'])}")
+
+        return web.Response(text=f"{body['command']} ok {' '.join(body['args'])}")
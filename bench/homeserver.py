@@ -0,0 +1,101 @@
+import asyncio
+import json
+import random
+import re
+import time
+from typing import Callable, Dict, List, Optional
+from uuid import uuid4
+
+from aiohttp import web
+
+
+class FakeHomeserver:
+    """Answers the client-server API calls made by ``homeserver_api``.
+
+    Every request waits ``latency`` seconds (plus up to ``jitter``), and a
+    ``rate_limit_ratio`` share of them is refused with M_LIMIT_EXCEEDED.
+    Sent messages are handed to ``on_message`` with their arrival time.
+    """
+
+    def __init__(
+        self,
+        domain: str,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        rate_limit_ratio: float = 0.0,
+        on_message: Optional[Callable[[str, Dict, float], None]] = None,
+    ):
+        self.domain = domain
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.on_message = on_message
+
+        self.requests: Dict[str, int] = {}
+        self.rate_limited = 0
+        self._txn_ids: Dict[str, str] = {}
+
+        self.app = web.Application()
+        prefix = "/_matrix/client/v3"
+        self.app.add_routes(
+            [
+                web.post(f"{prefix}/register", self.register),
+                web.post(f"{prefix}/createRoom", self.create_room),
+                web.post(f"{prefix}/rooms/{{room_id}}/join", self.membership),
+                web.post(f"{prefix}/rooms/{{room_id}}/leave", self.membership),
+                web.put(
+                    f"{prefix}/rooms/{{room_id}}/send/{{event_type}}/{{txn_id}}",
+                    self.send,
+                ),
+            ]
+        )
+        self.app.middlewares.append(self._simulate)
+
+    @web.middleware
+    async def _simulate(self, request: web.Request, handler) -> web.StreamResponse:
+        endpoint = re.sub(r"/rooms/[^/]+/", "/rooms/{room}/", request.path)
+        endpoint = re.sub(r"/send/.*", "/send", endpoint)
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            return web.json_response(
+                {"errcode": "M_LIMIT_EXCEEDED", "error": "Too many requests", "retry_after_ms": 100},
+                status=429,
+            )
+
+        return await handler(request)
+
+    async def register(self, request: web.Request) -> web.Response:
+        username = (await request.json())["username"]
+        return web.json_response(
+            {"user_id": f"@{username}:{self.domain}", "access_token": uuid4().hex}
+        )
+
+    async def create_room(self, request: web.Request) -> web.Response:
+        return web.json_response({"room_id": f"!{uuid4().hex[:18]}:{self.domain}"})
+
+    async def membership(self, request: web.Request) -> web.Response:
+        return web.json_response({"room_id": request.match_info["room_id"]})
+
+    async def send(self, request: web.Request) -> web.Response:
+        room_id = request.match_info["room_id"]
+        txn_id = request.match_info["txn_id"]
+
+        # Retried sends reuse their transaction ID and get the same event back
+        if txn_id in self._txn_ids:
+            return web.json_response({"event_id": self._txn_ids[txn_id]})
+
+        event_id = f"${uuid4().hex}"
+        self._txn_ids[txn_id] = event_id
+
+        if self.on_message is not None:
+            self.on_message(room_id, json.loads(await request.text()), time.perf_counter())
+
+        return web.json_response({"event_id": event_id})
+
+    def summary(self) -> List[str]:
+        return [f"{endpoint}: {count}" for endpoint, count in sorted(self.requests.items())]
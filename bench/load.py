@@ -0,0 +1,168 @@
+import asyncio
+import random
+import re
+import time
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+import aiohttp
+
+_REPLY = re.compile(r"(ok|failed) (r[0-9a-f]{12})")
+
+
+def percentile(values: List[float], percent: float) -> Optional[float]:
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class LoadGenerator:
+    """PUTs transactions to the bridge at a fixed rate, like a homeserver would.
+
+    Each transaction carries ``events_per_txn`` messages, mostly device
+    commands sent to random device rooms, and some management commands.
+    Device commands carry a request ID that the simulated device echoes, so
+    the reply seen by the fake homeserver gives the end-to-end latency.
+    """
+
+    def __init__(
+        self,
+        bridge_url: str,
+        hs_token: str,
+        device_rooms: List[str],
+        management_room: str,
+        sender: str,
+        rate: float,
+        duration: float,
+        events_per_txn: int = 1,
+        management_ratio: float = 0.05,
+    ):
+        self.bridge_url = bridge_url
+        self.hs_token = hs_token
+        self.device_rooms = device_rooms
+        self.management_room = management_room
+        self.sender = sender
+        self.rate = rate
+        self.duration = duration
+        self.events_per_txn = events_per_txn
+        self.management_ratio = management_ratio
+
+        self._pending: Dict[str, float] = {}
+
+        self.transactions = 0
+        self.commands = 0
+        self.put_latencies: List[float] = []
+        self.put_errors = 0
+        self.reply_latencies: List[float] = []
+        self.device_errors = 0
+        self.elapsed = 0.0
+        self._started_at = 0.0
+        self._last_reply_at = 0.0
+
+    @property
+    def lost(self) -> int:
+        return len(self._pending)
+
+    def on_message(self, room_id: str, content: Dict, received_at: float) -> None:
+        for outcome, request_id in _REPLY.findall(content.get("body", "")):
+            sent_at = self._pending.pop(request_id, None)
+            if sent_at is None:
+                continue
+
+            self.reply_latencies.append(received_at - sent_at)
+            self._last_reply_at = received_at
+            if outcome == "failed":
+                self.device_errors += 1
+
+    def _event(self) -> Dict:
+        if random.random() < self.management_ratio:
+            room_id, body = self.management_room, "help"
+        else:
+            request_id = f"r{uuid4().hex[:12]}"
+            command = random.choice(["on", "off", "status"])
+            room_id, body = random.choice(self.device_rooms), f"{command} {request_id}"
+            self._pending[request_id] = time.perf_counter()
+            self.commands += 1
+
+        return {
+            "type": "m.room.message",
+            "room_id": room_id,
+            "sender": self.sender,
+            "event_id": f"${uuid4().hex}",
+            "origin_server_ts": int(time.time() * 1000),
+            "content": {"msgtype": "m.text", "body": body},
+        }
+
+    async def _put(self, session: aiohttp.ClientSession) -> None:
+        events = [self._event() for _ in range(self.events_per_txn)]
+        start = time.perf_counter()
+
+        try:
+            async with session.put(
+                f"{self.bridge_url}/_matrix/app/v1/transactions/{uuid4().hex}",
+                json={"events": events},
+                headers={"Authorization": f"Bearer {self.hs_token}"},
+            ) as response:
+                await response.read()
+                ok = response.status == 200
+        except aiohttp.ClientError:
+            ok = False
+
+        self.transactions += 1
+        if ok:
+            self.put_latencies.append(time.perf_counter() - start)
+        else:
+            self.put_errors += 1
+
+    async def run(self, drain_timeout: float) -> None:
+        interval = 1 / self.rate
+        tasks = []
+        start = self._started_at = time.perf_counter()
+
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0)
+        ) as session:
+            # Open loop: transactions keep coming even when the bridge falls behind
+            for i in range(int(self.rate * self.duration)):
+                delay = start + i * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(self._put(session)))
+
+            await asyncio.gather(*tasks)
+
+        self.elapsed = time.perf_counter() - start
+        deadline = time.perf_counter() + drain_timeout
+        while self._pending and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+
+    def report(self) -> List[str]:
+        def ms(value: Optional[float]) -> str:
+            return "-" if value is None else f"{value * 1000:.1f} ms"
+
+        def latencies(name: str, values: List[float]) -> str:
+            return (
+                f"{name}: p50 {ms(percentile(values, 50))}, p95 {ms(percentile(values, 95))}, "
+                f"p99 {ms(percentile(values, 99))}, max {ms(max(values) if values else None)}"
+            )
+
+        def ratio(count: int, total: int) -> str:
+            return f"{count} ({count / total * 100 if total else 0:.2f}%)"
+
+        answered = len(self.reply_latencies)
+        answering = self._last_reply_at - self._started_at
+        return [
+            f"Transactions: {self.transactions} in {self.elapsed:.1f} s "
+            f"({self.transactions / self.elapsed if self.elapsed else 0:.1f}/s, "
+            f"target {self.rate:.1f}/s), {self.events_per_txn} events each",
+            f"Device commands: {self.commands}, answered {answered} "
+            f"({answered / answering if answering > 0 else 0:.1f}/s)",
+            latencies("Transaction PUT latency", self.put_latencies),
+            latencies("Command reply latency", self.reply_latencies),
+            f"PUT errors: {ratio(self.put_errors, self.transactions)}",
+            f"Device errors: {ratio(self.device_errors, self.commands)}",
+            f"Unanswered commands: {ratio(self.lost, self.commands)}",
+        ]
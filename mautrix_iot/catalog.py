@@ -0,0 +1,78 @@
+import time
+from typing import Dict, List, Optional
+
+from mautrix_iot.configuration import CONF
+from mautrix_iot.device_api import get_available_device_commands
+from mautrix_iot.routing import DeviceRecord
+from mautrix_iot.types import _DeviceAPIResponseCommand
+
+
+class CommandCatalog:
+    def __init__(
+        self, commands: List[_DeviceAPIResponseCommand], etag: Optional[str] = None
+    ):
+        self.commands: Dict[str, _DeviceAPIResponseCommand] = {
+            command["name"]: command for command in commands
+        }
+        self.etag = etag
+        self.fetched_at = time.monotonic()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.commands
+
+    def list(self) -> List[_DeviceAPIResponseCommand]:
+        return list(self.commands.values())
+
+
+class CommandCatalogCache:
+    """Commands exposed by each device host, revalidated after ``ttl`` seconds."""
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._catalogs: Dict[str, CommandCatalog] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def put(
+        self,
+        host: str,
+        commands: List[_DeviceAPIResponseCommand],
+        etag: Optional[str] = None,
+    ) -> CommandCatalog:
+        catalog = CommandCatalog(commands, etag)
+        self._catalogs[host] = catalog
+        return catalog
+
+    async def get(self, device: DeviceRecord) -> Optional[CommandCatalog]:
+        catalog = self._catalogs.get(device.host)
+        if catalog is not None and time.monotonic() - catalog.fetched_at < self.ttl:
+            self.hits += 1
+            return catalog
+
+        self.misses += 1
+        response = await get_available_device_commands(
+            device.host, etag=catalog.etag if catalog else None
+        )
+
+        if response["error"]["code"] == "NOT_MODIFIED" and catalog is not None:
+            self.revalidations += 1
+            catalog.fetched_at = time.monotonic()
+            return catalog
+
+        if response["error"]["code"] != "OK":
+            return None
+
+        return self.put(device.host, response["response"], response["etag"])
+
+    def invalidate(self, host: Optional[str] = None) -> None:
+        if host is None:
+            self._catalogs.clear()
+        else:
+            self._catalogs.pop(host, None)
+
+
+command_catalogs = CommandCatalogCache(
+    CONF.get("devices", {}).get("commands_ttl", 300)
+)
@@ -0,0 +1,333 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from mautrix_iot.configuration import CONF
+from mautrix_iot.db.database import engine
+from mautrix_iot.db.operations import (
+    acquire_lease,
+    get_live_instances,
+    heartbeat_instance,
+    release_lease,
+    remove_instances,
+)
+from mautrix_iot.health import health_monitor
+from mautrix_iot.jobs import job_manager
+from mautrix_iot.routing import routing_index
+from mautrix_iot.telemetry import telemetry_store
+from mautrix_iot.utils import instance_url
+
+logger = logging.getLogger(__name__)
+
+LEADER_LOCK = "mautrix_iot_leader"
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+def forwarded_txn_id(txn_id: str, url: str) -> str:
+    """ID of the part of a transaction meant for another instance.
+
+    The same on every delivery, so a part is handled once even if it is
+    forwarded again, or handled here after forwarding it seemed to fail.
+    """
+    return f"{txn_id}.{_hash(url) & 0xFFFFFFFF:08x}"
+
+
+class HashRing:
+    """Consistent hashing of room IDs onto instances.
+
+    Every instance is placed ``replicas`` times on the ring, so when one
+    joins or leaves only the rooms next to its points change owner.
+    """
+
+    def __init__(self, nodes: List[str], replicas: int):
+        self.nodes = sorted(set(nodes))
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas))
+        self._keys = [key for key, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._keys:
+            return None
+
+        return self._nodes[bisect.bisect(self._keys, _hash(key)) % len(self._keys)]
+
+
+class AdvisoryLock:
+    """PostgreSQL session lock, held for as long as its connection stays open.
+
+    If the instance dies, the database closes the connection and the lock
+    is free for another instance right away.
+    """
+
+    def __init__(self, name: str):
+        # Advisory lock keys are bigints, any CRC32 fits
+        self.key = zlib.crc32(name.encode())
+        self._connection: Optional[AsyncConnection] = None
+
+    async def acquire(self) -> bool:
+        if self._connection is not None:
+            try:
+                await self._connection.execute(text("SELECT 1"))
+                await self._connection.commit()
+                return True
+            except Exception:
+                logger.warning("Lost the connection holding the leader lock")
+                await self._close()
+
+        connection = await engine.connect()
+        try:
+            held = (
+                await connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": self.key})
+            ).scalar()
+            # Not left idle in a transaction, the lock belongs to the session
+            await connection.commit()
+        except BaseException:
+            await connection.close()
+            raise
+
+        if held:
+            self._connection = connection
+        else:
+            await connection.close()
+
+        return bool(held)
+
+    async def release(self) -> None:
+        if self._connection is None:
+            return
+
+        try:
+            await self._connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": self.key})
+            await self._connection.commit()
+        except Exception:
+            logger.warning("Failed to release the leader lock, it goes with the connection")
+        await self._close()
+
+    async def _close(self) -> None:
+        connection, self._connection = self._connection, None
+        try:
+            await connection.close()
+        except Exception:
+            pass
+
+
+class LeaseLock:
+    """Lock kept in the leases table, for databases without advisory locks.
+
+    The holder renews it on every heartbeat, another instance takes over
+    once it was not renewed for ``ttl`` seconds.
+    """
+
+    def __init__(self, name: str, holder: str, ttl: float):
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+
+    async def acquire(self) -> bool:
+        now = datetime.utcnow()
+        return await acquire_lease(self.name, self.holder, now, now + timedelta(seconds=self.ttl))
+
+    async def release(self) -> None:
+        await release_lease(self.name, self.holder)
+
+
+class Cluster:
+    """Lets several bridge instances share a homeserver registration and a database.
+
+    Each instance registers itself in the database and sends a heartbeat
+    every ``heartbeat_interval`` seconds. Instances heard from in the last
+    ``instance_timeout`` seconds form a hash ring that gives every room an
+    owner, and transactions are split so each instance only handles the
+    events of its own rooms. One instance, elected through a database
+    lock, runs the background duties: health checks, job polling and
+    telemetry retention. The routing index is reloaded every
+    ``reload_interval`` seconds to see devices registered elsewhere.
+
+    When disabled, the bridge is a cluster of one: every room is local and
+    the background duties run right away.
+    """
+
+    def __init__(
+        self,
+        url: Optional[str],
+        heartbeat_interval: float,
+        instance_timeout: float,
+        replicas: int,
+        forward_timeout: float,
+        reload_interval: float,
+    ):
+        self.url = url
+        self.heartbeat_interval = heartbeat_interval
+        self.instance_timeout = instance_timeout
+        self.replicas = replicas
+        self.forward_timeout = forward_timeout
+        self.reload_interval = reload_interval
+
+        self.ring = HashRing([url] if url else [], replicas)
+        self.leader = False
+        self._lock = None
+        self._task: Optional[asyncio.Task] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._reloaded_at = time.monotonic()
+
+        self.forwarded = 0
+        self.forward_failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.url is not None
+
+    @property
+    def instances(self) -> int:
+        return len(self.ring.nodes)
+
+    async def start(self) -> None:
+        if not self.enabled:
+            await self._start_duties()
+            return
+
+        if engine.dialect.name == "postgresql":
+            self._lock = AdvisoryLock(LEADER_LOCK)
+        else:
+            self._lock = LeaseLock(LEADER_LOCK, self.url, self.instance_timeout)
+
+        await self._tick()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        await self._stop_duties()
+
+        if not self.enabled:
+            return
+
+        # Leave right away instead of when the heartbeat times out
+        try:
+            await self._lock.release()
+            await remove_instances(url=self.url)
+        except Exception:
+            logger.exception("Failed to leave the cluster")
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _start_duties(self) -> None:
+        await health_monitor.start()
+        await job_manager.start_polling()
+        await telemetry_store.start_retention()
+        self.leader = True
+
+    async def _stop_duties(self) -> None:
+        if not self.leader:
+            return
+
+        self.leader = False
+        await health_monitor.stop()
+        await job_manager.stop_polling()
+        await telemetry_store.stop_retention()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+
+            try:
+                await self._tick()
+            except Exception:
+                logger.exception("Cluster heartbeat failed")
+                # Another instance takes over once the lock runs out
+                await self._stop_duties()
+
+    async def _tick(self) -> None:
+        now = datetime.utcnow()
+        await heartbeat_instance(self.url, now)
+
+        instances = await get_live_instances(now - timedelta(seconds=self.instance_timeout))
+        if set(instances) | {self.url} != set(self.ring.nodes):
+            self.ring = HashRing(instances + [self.url], self.replicas)
+            logger.info("Cluster instances: %s", ", ".join(self.ring.nodes))
+
+        leader = await self._lock.acquire()
+        if leader and not self.leader:
+            logger.info("This instance now runs the background duties")
+            await self._start_duties()
+        elif not leader and self.leader:
+            await self._stop_duties()
+
+        if self.leader:
+            # Background commands of instances that went away are not coming back
+            for url in await remove_instances(before=now - timedelta(seconds=self.instance_timeout)):
+                await job_manager.recover(url)
+
+        if time.monotonic() - self._reloaded_at >= self.reload_interval:
+            self._reloaded_at = time.monotonic()
+            await routing_index.load()
+
+    def partition(
+        self, events: List[Dict[str, Any]]
+    ) -> Tuple[List[Dict[str, Any]], Dict[str, List[Dict[str, Any]]]]:
+        """Split events into those of rooms owned here and those of every other instance."""
+        local: List[Dict[str, Any]] = []
+        remote: Dict[str, List[Dict[str, Any]]] = {}
+
+        for event in events:
+            owner = self.ring.owner(event["room_id"]) if "room_id" in event else None
+            if owner is None or owner == self.url:
+                local.append(event)
+            else:
+                remote.setdefault(owner, []).append(event)
+
+        return local, remote
+
+    async def forward(self, url: str, txn_id: str, events: List[Dict[str, Any]]) -> bool:
+        """Hand events to the instance owning their rooms, False if it could not take them.
+
+        ``txn_id`` is the ID of the whole transaction.
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.forward_timeout)
+            )
+
+        try:
+            async with self._session.put(
+                f"{url}/_iot/v1/cluster/transactions/{forwarded_txn_id(txn_id, url)}",
+                json={"events": events},
+                headers={"Authorization": f"Bearer {CONF.appservice['hs_token']}"},
+            ) as response:
+                if response.status == 200:
+                    self.forwarded += len(events)
+                    return True
+
+                logger.warning("Instance %s refused forwarded events: %d", url, response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            logger.warning("Could not forward events to %s: %s", url, error)
+
+        self.forward_failures += 1
+        return False
+
+
+cluster = Cluster(
+    url=instance_url(),
+    heartbeat_interval=CONF.get("cluster", {}).get("heartbeat_interval", 10),
+    instance_timeout=CONF.get("cluster", {}).get("instance_timeout", 30),
+    replicas=CONF.get("cluster", {}).get("virtual_nodes", 64),
+    forward_timeout=CONF.get("cluster", {}).get("forward_timeout", 10),
+    reload_interval=CONF.get("cluster", {}).get("routing_reload_interval", 60),
+)
@@ -17,5 +17,8 @@ class Configuration:
     def __getattr__(self, name: str) -> Any:
         return self.conf[name]
 
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.conf.get(key, default)
+
 
 CONF = Configuration()
@@ -31,24 +31,81 @@ HELP_MESSAGE = """
 <strong>cancel</strong> - Cancel running command<br>
 <h4>Devices</h4>
 <strong>register</strong> - Register new IoT device<br>
-<strong>list</strong> - List registered devices<br>
-<strong>info</strong> <em>&lt;name&gt;</em> - Details about a device<br>
+<strong>import</strong> <em>&lt;file&gt;</em> - Register the devices listed in a YAML or CSV manifest from the import directory<br>
+<strong>list</strong> <em>[page]</em> <em>[--group &lt;group&gt;]</em> <em>[--filter &lt;text&gt;]</em> - List registered devices<br>
+<strong>info</strong> <em>&lt;name&gt;</em> | <em>--group &lt;group&gt;</em> - Details about a device, or every device in a group<br>
+<strong>refresh</strong> <em>[name]</em> - Fetch the commands of a device (or all devices) again<br>
+<strong>broadcast</strong> <em>&lt;all|group|name,...&gt;</em> <em>&lt;command&gt;</em> <em>[args]</em> - Send a command to many devices at once<br>
+<strong>token</strong> <em>&lt;name&gt;</em> <em>[rotate]</em> - Show or replace the token a device pushes events with<br>
+<strong>jobs</strong> - List the latest long running commands<br>
+<strong>job</strong> <em>&lt;id&gt;</em> - Details about a long running command<br>
+<h4>Groups</h4>
+<strong>group list</strong> - List groups<br>
+<strong>group create|delete</strong> <em>&lt;group&gt;</em> - Create or delete a group<br>
+<strong>group add|remove</strong> <em>&lt;group&gt;</em> <em>&lt;name,...&gt;</em> - Add or remove devices<br>
+<strong>group members</strong> <em>&lt;group&gt;</em> - List the devices in a group<br>
 """
 
-DEVICE_MESSAGE_FORMAT = lambda id, name, host, room_id: f"""
+DEVICE_MESSAGE_FORMAT = lambda id, name, host, room_id, health: f"""
  <li> {name}
  <ul>
  <li> <strong> Host: </strong> {host} </li>
+ <li> <strong> Health: </strong> {health} </li>
  <li> <strong> Room: </strong> <a href="https://matrix.to/#/{room_id}"> {room_id} </a> </li>
  </ul>
  </li>
  <br> 
 """
 
+INGEST_TOKEN_MESSAGE = lambda name, token: (
+    f"Events from <strong> {name} </strong> are pushed to "
+    f"<code>/_iot/v1/devices/{name}/events</code> with the header "
+    f"<code>Authorization: Bearer {token}</code>"
+)
+
+DEVICE_ROOM_HELP_MESSAGE = """
+<strong> bg </strong> <em>&lt;command&gt;</em> <em>[args]</em> - \
+Run a command in the background, the answer comes as a reply once it's done <br>
+<strong> stats </strong> <em>[metric]</em> <em>[range]</em> - \
+Summary of the readings pushed by the device, e.g. <em>stats temperature 24h</em>. \
+A device with its own <em>stats</em> command answers it instead <br>
+"""
+
+STATS_MESSAGE_FORMAT = lambda metric, period, summary: (
+    f"<strong> {metric} </strong> over the last {period}: "
+    f"avg {summary.avg:.2f}, min {summary.min:g}, max {summary.max:g} "
+    f"({summary.count} readings)"
+)
+
+JOB_STATUS_ICONS = {"running": "⏳", "succeeded": "✅", "failed": "❌", "timed_out": "⌛"}
+
+JOB_STARTED_MESSAGE = lambda job_id, command: (
+    f"⏳ <strong> {command} </strong> is running as job <code>{job_id}</code>, "
+    f"you will get an answer here once it's done."
+)
+
+JOB_FINISHED_MESSAGE = lambda job_id, command, status, result: (
+    f"{JOB_STATUS_ICONS.get(status, '')} Job <code>{job_id}</code> "
+    f"(<strong> {command} </strong>) {status.replace('_', ' ')}"
+    + (f": {result}" if result else ".")
+)
+
+JOB_MESSAGE_FORMAT = lambda job_id, device, command, status, created_at: (
+    f" <li> {JOB_STATUS_ICONS.get(status, '')} <code>{job_id}</code> "
+    f"<strong> {device}: </strong> {command} - {status.replace('_', ' ')}, "
+    f"started {created_at:%Y-%m-%d %H:%M:%S} UTC </li>"
+)
+
+BROADCAST_RESULT_FORMAT = lambda name, status, text: (
+    f" <li> {status} <strong> {name}: </strong> {str(text)[:200]} </li>"
+)
+
 UNKNOWN_COMMAND_MESSAGE = (
     "This is not a registered command. Send <strong>help</strong> "
     "for the available commands."
 )
 
+CANCELLED_MESSAGE = "Cancelled the running command."
+
 
 BRIDGE_USERS_PREFIX = "@iot_"
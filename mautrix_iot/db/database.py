@@ -1,44 +1,110 @@
-from typing import Optional
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Optional
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import event, inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 from mautrix_iot.configuration import CONF
 from mautrix_iot.db.models import Entity
+from mautrix_iot.metrics import instrument_engine
 from mautrix_iot.utils import bot_full_name
 
-engine = create_engine(
-    CONF.appservice["database"], connect_args={"check_same_thread": False}
+
+def _async_database_url(url: str) -> str:
+    """Pick the asyncio driver for the configured database URL."""
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url.startswith("postgres://"):
+        return url.replace("postgres://", "postgresql+asyncpg://", 1)
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    return url
+
+
+def _engine_options(url: str) -> Dict[str, Any]:
+    pool = CONF.appservice.get("database_pool", {})
+    options = {
+        "pool_pre_ping": pool.get("pre_ping", True),
+        "pool_recycle": pool.get("recycle", 3600),
+    }
+
+    # In-memory SQLite databases live in a single static connection
+    if ":memory:" not in url:
+        options["pool_size"] = pool.get("size", 10)
+        options["max_overflow"] = pool.get("max_overflow", 10)
+
+    return options
+
+
+DATABASE_URL = _async_database_url(CONF.appservice["database"])
+
+engine = create_async_engine(DATABASE_URL, **_engine_options(DATABASE_URL))
+instrument_engine(engine.sync_engine)
+SessionLocal = async_sessionmaker(
+    engine, autoflush=False, expire_on_commit=False, class_=AsyncSession
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+if engine.dialect.name == "sqlite":
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _configure_sqlite(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # Readers no longer wait on the writer with write-ahead logging
+        if CONF.appservice.get("sqlite_wal", True):
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.close()
 
 
 class Session:
-    def __init__(self, session: Optional["Session"] = None):
+    """Async session that commits on exit.
+
+    When an outer session is passed in, it is reused as is and left to its
+    owner to commit and close.
+    """
+
+    def __init__(self, session: Optional[AsyncSession] = None):
         self.session_maker = SessionLocal
         self.session = session
+        self.owned = session is None
 
-    def __enter__(self, *args, **kwargs):
+    async def __aenter__(self) -> AsyncSession:
         if not self.session:
             self.session = self.session_maker()
         return self.session
 
-    def __exit__(self, *args, **kwargs):
-        if self.session:
-            self.session.flush()
-            self.session.expunge_all()
-            self.session.commit()
-            self.session.close()
+    async def __aexit__(self, exc_type, exc, traceback):
+        if not self.owned:
+            return
+
+        try:
+            if exc_type is None:
+                await self.session.flush()
+                self.session.expunge_all()
+                await self.session.commit()
+            else:
+                await self.session.rollback()
+        finally:
+            await self.session.close()
 
 
-def get_entity_for_room(room_id: str) -> Optional[Entity]:
-    with Session() as db:
-        return db.query(Entity).filter(Entity.room_id == room_id).first()
+async def get_entity_for_room(room_id: str) -> Optional[Entity]:
+    async with Session() as db:
+        return (
+            await db.execute(select(Entity).where(Entity.room_id == room_id))
+        ).scalars().first()
 
 
-def get_bot_entity() -> Entity:
-    with Session() as db:
-        bot = db.query(Entity).filter(Entity.is_device == False).first()
+async def get_bot_entity() -> Entity:
+    async with Session() as db:
+        bot = (
+            await db.execute(select(Entity).where(Entity.is_device == False))
+        ).scalars().first()
 
     if bot is None:
         raise Exception("No default bot in database")
@@ -46,13 +112,15 @@ def get_bot_entity() -> Entity:
     return bot
 
 
-def _initial_db_population():
-    with Session() as session:
-        if (
-            not session.query(Entity)
-            .filter(Entity.name == CONF.appservice["bot_username"])
-            .first()
-        ):
+async def _initial_db_population():
+    async with Session() as session:
+        bot = (
+            await session.execute(
+                select(Entity.id).where(Entity.name == CONF.appservice["bot_username"])
+            )
+        ).first()
+
+        if not bot:
             session.add(
                 Entity(
                     name=CONF.appservice["bot_username"],
@@ -61,3 +129,27 @@ def _initial_db_population():
                     is_device=False,
                 )
             )
+
+
+def _upgrade(connection) -> None:
+    config = Config()
+    config.set_main_option("script_location", str(Path(__file__).parent / "migrations"))
+    config.attributes["connection"] = connection
+
+    # Databases created before migrations existed already have the initial schema
+    tables = inspect(connection).get_table_names()
+    if "entities" in tables and "alembic_version" not in tables:
+        command.stamp(config, "0001")
+
+    command.upgrade(config, "head")
+
+
+async def upgrade_database() -> None:
+    """Bring the schema up to date with the Alembic migrations."""
+    async with engine.begin() as connection:
+        # Instances of a cluster starting together migrate one after the other
+        if engine.dialect.name == "postgresql":
+            await connection.execute(
+                text("SELECT pg_advisory_xact_lock(:key)"), {"key": zlib.crc32(b"mautrix_iot_migrations")}
+            )
+        await connection.run_sync(_upgrade)
@@ -0,0 +1,39 @@
+import asyncio
+from logging.config import fileConfig
+
+from alembic import context
+
+from mautrix_iot.db.database import engine
+from mautrix_iot.db.models import Base
+
+config = context.config
+
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+
+def run_migrations(connection) -> None:
+    context.configure(
+        connection=connection,
+        target_metadata=Base.metadata,
+        # SQLite can only alter tables by copying them
+        render_as_batch=connection.dialect.name == "sqlite",
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+async def run_async_migrations() -> None:
+    async with engine.begin() as connection:
+        await connection.run_sync(run_migrations)
+    await engine.dispose()
+
+
+# upgrade_database() hands over its own connection
+connection = config.attributes.get("connection")
+
+if connection is not None:
+    run_migrations(connection)
+else:
+    asyncio.run(run_async_migrations())
@@ -0,0 +1,48 @@
+"""Transactions and flow sessions
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 10:05:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, Sequence[str], None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Deployments from before migrations got these tables from create_all()
+    existing = sa.inspect(op.get_bind()).get_table_names()
+
+    if "transactions" not in existing:
+        op.create_table(
+            "transactions",
+            sa.Column("id", sa.String(), nullable=False),
+            sa.Column("processed_at", sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint("id"),
+        )
+
+    if "flow_sessions" not in existing:
+        op.create_table(
+            "flow_sessions",
+            sa.Column("room_id", sa.String(), nullable=False),
+            sa.Column("sender", sa.String(), nullable=False),
+            sa.Column("command", sa.String(), nullable=True),
+            sa.Column("state", sa.Integer(), nullable=True),
+            sa.Column("props", sa.JSON(), nullable=True),
+            sa.Column("args", sa.JSON(), nullable=True),
+            sa.Column("updated_at", sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint("room_id", "sender"),
+        )
+
+
+def downgrade() -> None:
+    op.drop_table("flow_sessions")
+    op.drop_table("transactions")
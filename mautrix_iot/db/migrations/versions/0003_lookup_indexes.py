@@ -0,0 +1,32 @@
+"""Indexes for the message hot path
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 10:10:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, Sequence[str], None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index("ix_entities_room_id", "entities", ["room_id"], unique=True)
+    op.create_index("ix_entities_matrix_id", "entities", ["matrix_id"], unique=True)
+    op.create_index("ix_entities_is_device", "entities", ["is_device"])
+    op.create_index("ix_transactions_processed_at", "transactions", ["processed_at"])
+    op.create_index("ix_flow_sessions_updated_at", "flow_sessions", ["updated_at"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_flow_sessions_updated_at", table_name="flow_sessions")
+    op.drop_index("ix_transactions_processed_at", table_name="transactions")
+    op.drop_index("ix_entities_is_device", table_name="entities")
+    op.drop_index("ix_entities_matrix_id", table_name="entities")
+    op.drop_index("ix_entities_room_id", table_name="entities")
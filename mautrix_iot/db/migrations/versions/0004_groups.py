@@ -0,0 +1,44 @@
+"""Device groups
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 10:15:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, Sequence[str], None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "groups",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("name", sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_groups_name", "groups", ["name"], unique=True)
+
+    op.create_table(
+        "entity_groups",
+        sa.Column("group_id", sa.Integer(), nullable=False),
+        sa.Column("entity_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["group_id"], ["groups.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["entity_id"], ["entities.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("group_id", "entity_id"),
+    )
+    op.create_index("ix_entity_groups_entity_id", "entity_groups", ["entity_id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_entity_groups_entity_id", table_name="entity_groups")
+    op.drop_table("entity_groups")
+    op.drop_index("ix_groups_name", table_name="groups")
+    op.drop_table("groups")
@@ -0,0 +1,30 @@
+"""Device health
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 10:20:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0005"
+down_revision: Union[str, Sequence[str], None] = "0004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("entities", sa.Column("health_status", sa.String(), nullable=True))
+    op.add_column("entities", sa.Column("last_seen", sa.DateTime(), nullable=True))
+    op.add_column("entities", sa.Column("last_latency_ms", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("entities") as batch_op:
+        batch_op.drop_column("last_latency_ms")
+        batch_op.drop_column("last_seen")
+        batch_op.drop_column("health_status")
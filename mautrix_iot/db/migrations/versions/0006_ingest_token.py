@@ -0,0 +1,26 @@
+"""Device ingest tokens
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 10:25:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0006"
+down_revision: Union[str, Sequence[str], None] = "0005"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("entities", sa.Column("ingest_token", sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("entities") as batch_op:
+        batch_op.drop_column("ingest_token")
@@ -0,0 +1,62 @@
+"""Telemetry store
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 10:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0007"
+down_revision: Union[str, Sequence[str], None] = "0006"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "telemetry_chunks",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("entity_id", sa.Integer(), nullable=True),
+        sa.Column("metric", sa.String(), nullable=True),
+        sa.Column("start", sa.Float(), nullable=True),
+        sa.Column("count", sa.Integer(), nullable=True),
+        sa.Column("offsets", sa.LargeBinary(), nullable=True),
+        sa.Column("values", sa.LargeBinary(), nullable=True),
+        sa.ForeignKeyConstraint(["entity_id"], ["entities.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_telemetry_chunks_lookup", "telemetry_chunks", ["entity_id", "metric", "start"]
+    )
+
+    op.create_table(
+        "telemetry_rollups",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("entity_id", sa.Integer(), nullable=True),
+        sa.Column("metric", sa.String(), nullable=True),
+        sa.Column("resolution", sa.Integer(), nullable=True),
+        sa.Column("bucket", sa.Integer(), nullable=True),
+        sa.Column("count", sa.Integer(), nullable=True),
+        sa.Column("min", sa.Float(), nullable=True),
+        sa.Column("max", sa.Float(), nullable=True),
+        sa.Column("sum", sa.Float(), nullable=True),
+        sa.ForeignKeyConstraint(["entity_id"], ["entities.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_telemetry_rollups_lookup",
+        "telemetry_rollups",
+        ["entity_id", "metric", "resolution", "bucket"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_telemetry_rollups_lookup", table_name="telemetry_rollups")
+    op.drop_table("telemetry_rollups")
+    op.drop_index("ix_telemetry_chunks_lookup", table_name="telemetry_chunks")
+    op.drop_table("telemetry_chunks")
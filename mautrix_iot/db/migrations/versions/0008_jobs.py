@@ -0,0 +1,46 @@
+"""Jobs
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 10:35:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0008"
+down_revision: Union[str, Sequence[str], None] = "0007"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "jobs",
+        sa.Column("id", sa.String(), nullable=False),
+        sa.Column("entity_id", sa.Integer(), nullable=True),
+        sa.Column("device_job_id", sa.String(), nullable=True),
+        sa.Column("command", sa.String(), nullable=True),
+        sa.Column("args", sa.JSON(), nullable=True),
+        sa.Column("room_id", sa.String(), nullable=True),
+        sa.Column("event_id", sa.String(), nullable=True),
+        sa.Column("status", sa.String(), nullable=True),
+        sa.Column("result", sa.String(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("finished_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["entity_id"], ["entities.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_jobs_device_job", "jobs", ["entity_id", "device_job_id"])
+    op.create_index("ix_jobs_status", "jobs", ["status"])
+    op.create_index("ix_jobs_created_at", "jobs", ["created_at"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_jobs_created_at", table_name="jobs")
+    op.drop_index("ix_jobs_status", table_name="jobs")
+    op.drop_index("ix_jobs_device_job", table_name="jobs")
+    op.drop_table("jobs")
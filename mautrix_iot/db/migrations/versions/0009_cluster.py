@@ -0,0 +1,45 @@
+"""Cluster
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18 16:20:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0009"
+down_revision: Union[str, Sequence[str], None] = "0008"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "instances",
+        sa.Column("url", sa.String(), nullable=False),
+        sa.Column("heartbeat_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("url"),
+    )
+    op.create_index("ix_instances_heartbeat_at", "instances", ["heartbeat_at"])
+    op.create_table(
+        "leases",
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("holder", sa.String(), nullable=True),
+        sa.Column("expires_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("name"),
+    )
+    op.add_column("jobs", sa.Column("instance", sa.String(), nullable=True))
+    op.create_index("ix_jobs_instance", "jobs", ["instance"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_jobs_instance", table_name="jobs")
+    with op.batch_alter_table("jobs") as batch_op:
+        batch_op.drop_column("instance")
+    op.drop_table("leases")
+    op.drop_index("ix_instances_heartbeat_at", table_name="instances")
+    op.drop_table("instances")
@@ -0,0 +1,28 @@
+"""Clear room IDs left behind by deleted rooms
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-19 09:10:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0010"
+down_revision: Union[str, Sequence[str], None] = "0009"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Leaving the management room deleted its row but kept the bot's reference
+    op.execute(
+        "UPDATE entities SET room_id = NULL "
+        "WHERE room_id IS NOT NULL AND room_id NOT IN (SELECT id FROM rooms)"
+    )
+
+
+def downgrade() -> None:
+    pass
@@ -1,6 +1,19 @@
+from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String
+from sqlalchemy import (
+    JSON,
+    Boolean,
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    Table,
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -14,29 +27,187 @@ class Room(Base):
     entity = relationship(
         "Entity",
         back_populates="room",
-        lazy="subquery",
+        lazy="select",
         uselist=False,
         cascade="all, delete-orphan",
     )
     user_matrix_id = Column(String)
 
 
+# Membership is looked up from both sides: the primary key covers
+# group -> devices, the extra index covers device -> groups
+entity_groups = Table(
+    "entity_groups",
+    Base.metadata,
+    Column("group_id", Integer, ForeignKey("groups.id", ondelete="CASCADE"), primary_key=True),
+    Column(
+        "entity_id",
+        Integer,
+        ForeignKey("entities.id", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    ),
+)
+
+
+class Group(Base):
+    __tablename__ = "groups"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String, unique=True, index=True)
+    members = relationship(
+        "Entity",
+        secondary=entity_groups,
+        back_populates="groups",
+        lazy="select",
+    )
+
+
 class Entity(Base):
     __tablename__ = "entities"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, unique=True)
     host = Column(String)
-    matrix_id = Column(String)
+    matrix_id = Column(String, index=True, unique=True)
     description = Column(String)
     access_token = Column(String)
+    # Devices authenticate with it when pushing events to the bridge
+    ingest_token = Column(String, nullable=True)
+
+    is_device = Column(Boolean, default=True, index=True)
 
-    is_device = Column(Boolean, default=True)
+    # Kept up to date by the health monitor
+    health_status = Column(String, nullable=True)
+    last_seen = Column(DateTime, nullable=True)
+    last_latency_ms = Column(Integer, nullable=True)
 
-    room_id = Column(String, ForeignKey("rooms.id"), nullable=True)
+    # A room belongs to at most one entity
+    room_id = Column(String, ForeignKey("rooms.id"), nullable=True, index=True, unique=True)
     room = relationship(
         "Room",
         back_populates="entity",
-        lazy="subquery",
+        lazy="select",
         uselist=False,
     )
+    groups = relationship(
+        "Group",
+        secondary=entity_groups,
+        back_populates="members",
+        lazy="select",
+    )
+
+
+class Transaction(Base):
+    __tablename__ = "transactions"
+
+    id = Column(String, primary_key=True)
+    processed_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class FlowSession(Base):
+    __tablename__ = "flow_sessions"
+
+    room_id = Column(String, primary_key=True)
+    sender = Column(String, primary_key=True)
+    command = Column(String)
+    state = Column(Integer)
+    props = Column(JSON)
+    args = Column(JSON)
+    updated_at = Column(
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True
+    )
+
+
+class TelemetryChunk(Base):
+    """Raw readings of one metric, packed as arrays of float64.
+
+    ``offsets`` holds uint32 milliseconds since ``start``, ``values`` the
+    readings in the same order.
+    """
+
+    __tablename__ = "telemetry_chunks"
+    __table_args__ = (
+        Index("ix_telemetry_chunks_lookup", "entity_id", "metric", "start"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    entity_id = Column(Integer, ForeignKey("entities.id", ondelete="CASCADE"))
+    metric = Column(String)
+    start = Column(Float)
+    count = Column(Integer)
+    offsets = Column(LargeBinary)
+    values = Column(LargeBinary)
+
+
+class TelemetryRollup(Base):
+    """Summary of a metric over a bucket of ``resolution`` seconds.
+
+    Rows are only ever appended, a bucket can be spread over several rows
+    and is combined when queried.
+    """
+
+    __tablename__ = "telemetry_rollups"
+    __table_args__ = (
+        Index(
+            "ix_telemetry_rollups_lookup", "entity_id", "metric", "resolution", "bucket"
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    entity_id = Column(Integer, ForeignKey("entities.id", ondelete="CASCADE"))
+    metric = Column(String)
+    resolution = Column(Integer)
+    # Start of the bucket, in seconds since the epoch
+    bucket = Column(Integer)
+    count = Column(Integer)
+    min = Column(Float)
+    max = Column(Float)
+    sum = Column(Float)
+
+
+class Job(Base):
+    """A device command that keeps running after the bridge got an answer.
+
+    Jobs with a ``device_job_id`` run on the device and are polled or
+    reported back by it, the others run in the background on the bridge.
+    """
+
+    __tablename__ = "jobs"
+    __table_args__ = (Index("ix_jobs_device_job", "entity_id", "device_job_id"),)
+
+    id = Column(String, primary_key=True)
+    entity_id = Column(Integer, ForeignKey("entities.id", ondelete="CASCADE"))
+    entity = relationship("Entity", lazy="select")
+    device_job_id = Column(String, nullable=True)
+    command = Column(String)
+    args = Column(JSON)
+    # Where the command was sent, to reply to it once the job is done
+    room_id = Column(String)
+    event_id = Column(String, nullable=True)
+    # "running", "succeeded", "failed" or "timed_out"
+    status = Column(String, index=True)
+    result = Column(String, nullable=True)
+    # Bridge instance running the command itself, for jobs without a device job
+    instance = Column(String, nullable=True, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class Instance(Base):
+    """A bridge instance taking part in a cluster, known by its URL."""
+
+    __tablename__ = "instances"
+
+    url = Column(String, primary_key=True)
+    heartbeat_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class Lease(Base):
+    """Named lock held by one instance until it expires, where advisory locks are missing."""
+
+    __tablename__ = "leases"
+
+    name = Column(String, primary_key=True)
+    holder = Column(String)
+    expires_at = Column(DateTime)
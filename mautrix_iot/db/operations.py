@@ -1,48 +1,701 @@
-from typing import Optional
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
 
 import sqlalchemy
+from sqlalchemy import Row, Select, delete, func, insert, literal, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from mautrix_iot.configuration import CONF
 from mautrix_iot.db.database import Session
-from mautrix_iot.db.models import Entity, Room
+from mautrix_iot.db.models import (
+    Entity,
+    FlowSession,
+    Group,
+    Instance,
+    Job,
+    Lease,
+    Room,
+    TelemetryChunk,
+    TelemetryRollup,
+    Transaction,
+    entity_groups,
+)
 
 
-def get_bot_entity(session: Optional[Session] = None) -> Entity:
-    with Session(session=session) as db:
+async def get_bot_entity(session: Optional[AsyncSession] = None) -> Entity:
+    async with Session(session=session) as db:
         bot = (
-            db.query(Entity)
-            # .join(Room.entity)
-            # .options(sqlalchemy.orm.joinedload(Entity.room))
-            .filter(Entity.name == CONF.appservice["bot_username"]).first()
-        )
+            await db.execute(
+                select(Entity)
+                # The room is read after the session is closed
+                .options(sqlalchemy.orm.joinedload(Entity.room))
+                .where(Entity.name == CONF.appservice["bot_username"])
+            )
+        ).scalars().first()
 
-    print(bot.room)
     return bot
 
 
-def update_bot_room(
-    room_id: str, bot_matrix_id: str, session: Optional[Session] = None
+async def update_bot_room(
+    room_id: str,
+    bot_matrix_id: str,
+    user_matrix_id: Optional[str] = None,
+    session: Optional[AsyncSession] = None,
 ) -> Room:
-    with Session(session=session) as db:
-        bot = db.query(Entity).filter(Entity.matrix_id == bot_matrix_id).first()
+    async with Session(session=session) as db:
+        bot = (
+            await db.execute(
+                select(Entity)
+                .options(sqlalchemy.orm.selectinload(Entity.room))
+                .where(Entity.matrix_id == bot_matrix_id)
+            )
+        ).scalars().first()
         if bot is None:
             raise ValueError(f"No such bot: {bot_matrix_id}")
 
-        room = db.query(Room).filter(Room.id == room_id).first()
+        room = await db.get(Room, room_id, options=[sqlalchemy.orm.selectinload(Room.entity)])
         if room is None:
             room = Room(id=room_id, entity=bot)
             db.add(room)
 
+        # The user who brought the bot in, invited to rooms of devices provisioned offline
+        if user_matrix_id is not None:
+            room.user_matrix_id = user_matrix_id
+
         bot.room = room
 
     return room
 
 
-def delete_bot_room(session: Optional[Session] = None) -> None:
-    with Session(session=session) as db:
-        bot = get_bot_entity(db)
-        if not bot.room:
+async def delete_bot_room(session: Optional[AsyncSession] = None) -> None:
+    async with Session(session=session) as db:
+        bot = await get_bot_entity(db)
+        if bot.room_id is None:
+            return
+
+        # Cleared with the room, the routing index is loaded from this column
+        await db.execute(update(Entity).where(Entity.id == bot.id).values(room_id=None))
+        await db.execute(delete(Room).where(Room.id == bot.room_id))
+
+
+async def is_transaction_processed(
+    txn_id: str, session: Optional[AsyncSession] = None
+) -> bool:
+    async with Session(session=session) as db:
+        return await db.get(Transaction, txn_id) is not None
+
+
+async def mark_transaction_processed(
+    txn_id: str, session: Optional[AsyncSession] = None
+) -> None:
+    async with Session(session=session) as db:
+        await db.merge(Transaction(id=txn_id))
+
+
+async def claim_transaction(txn_id: str) -> bool:
+    """Mark a transaction as handled, False if someone else already did."""
+    try:
+        async with Session() as db:
+            db.add(Transaction(id=txn_id))
+    except IntegrityError:
+        return False
+
+    return True
+
+
+async def release_transaction(
+    txn_id: str, session: Optional[AsyncSession] = None
+) -> None:
+    async with Session(session=session) as db:
+        await db.execute(delete(Transaction).where(Transaction.id == txn_id))
+
+
+async def prune_transactions(
+    older_than: datetime, session: Optional[AsyncSession] = None
+) -> None:
+    async with Session(session=session) as db:
+        await db.execute(delete(Transaction).where(Transaction.processed_at < older_than))
+
+
+async def get_flow_session(
+    room_id: str, sender: str, session: Optional[AsyncSession] = None
+) -> Optional[FlowSession]:
+    async with Session(session=session) as db:
+        return await db.get(FlowSession, (room_id, sender))
+
+
+async def save_flow_session(
+    room_id: str,
+    sender: str,
+    command: str,
+    state: int,
+    props: Dict[str, Any],
+    args: List[str],
+    session: Optional[AsyncSession] = None,
+) -> None:
+    async with Session(session=session) as db:
+        await db.merge(
+            FlowSession(
+                room_id=room_id,
+                sender=sender,
+                command=command,
+                state=state,
+                props=props,
+                args=args,
+                updated_at=datetime.utcnow(),
+            )
+        )
+
+
+async def delete_flow_session(
+    room_id: str, sender: str, session: Optional[AsyncSession] = None
+) -> None:
+    async with Session(session=session) as db:
+        await db.execute(
+            delete(FlowSession).where(
+                FlowSession.room_id == room_id, FlowSession.sender == sender
+            )
+        )
+
+
+async def prune_flow_sessions(
+    older_than: datetime, session: Optional[AsyncSession] = None
+) -> None:
+    async with Session(session=session) as db:
+        await db.execute(delete(FlowSession).where(FlowSession.updated_at < older_than))
+
+
+async def get_entity_by_name(
+    name: str, session: Optional[AsyncSession] = None
+) -> Optional[Entity]:
+    async with Session(session=session) as db:
+        return (
+            await db.execute(select(Entity).where(Entity.name == name))
+        ).scalars().first()
+
+
+def _device_query(
+    *columns: Any, name_filter: Optional[str] = None, group: Optional[str] = None
+) -> Select:
+    query = select(*columns).where(Entity.is_device == True)
+
+    if name_filter:
+        query = query.where(Entity.name.contains(name_filter, autoescape=True))
+
+    if group is not None:
+        query = (
+            query.join(entity_groups, entity_groups.c.entity_id == Entity.id)
+            .join(Group, Group.id == entity_groups.c.group_id)
+            .where(Group.name == group)
+        )
+
+    return query
+
+
+async def get_devices(
+    group: Optional[str] = None, session: Optional[AsyncSession] = None
+) -> List[Entity]:
+    async with Session(session=session) as db:
+        return list(
+            (await db.execute(_device_query(Entity, group=group).order_by(Entity.id))).scalars()
+        )
+
+
+async def count_devices(
+    name_filter: Optional[str] = None,
+    group: Optional[str] = None,
+    session: Optional[AsyncSession] = None,
+) -> int:
+    async with Session(session=session) as db:
+        return (
+            await db.execute(
+                _device_query(func.count(Entity.id), name_filter=name_filter, group=group)
+            )
+        ).scalar_one()
+
+
+async def get_device_page_start(
+    page: int,
+    page_size: int,
+    name_filter: Optional[str] = None,
+    group: Optional[str] = None,
+    session: Optional[AsyncSession] = None,
+) -> Optional[int]:
+    """Id of the last device before ``page``, or None if there is no such page.
+
+    Only the id index is scanned to skip the earlier pages, the page itself
+    is then read with :func:`get_device_page`.
+    """
+    if page <= 1:
+        return 0
+
+    async with Session(session=session) as db:
+        return (
+            await db.execute(
+                _device_query(Entity.id, name_filter=name_filter, group=group)
+                .order_by(Entity.id)
+                .offset((page - 1) * page_size - 1)
+                .limit(1)
+            )
+        ).scalar()
+
+
+async def get_device_page(
+    after_id: int,
+    limit: int,
+    name_filter: Optional[str] = None,
+    group: Optional[str] = None,
+    session: Optional[AsyncSession] = None,
+) -> List[Row]:
+    """Up to ``limit`` devices with an id greater than ``after_id``, in id order."""
+    async with Session(session=session) as db:
+        return list(
+            await db.execute(
+                _device_query(
+                    Entity.id,
+                    Entity.name,
+                    Entity.host,
+                    Entity.room_id,
+                    Entity.health_status,
+                    Entity.last_seen,
+                    name_filter=name_filter,
+                    group=group,
+                )
+                .where(Entity.id > after_id)
+                .order_by(Entity.id)
+                .limit(limit)
+            )
+        )
+
+
+async def get_devices_by_names(
+    names: List[str], session: Optional[AsyncSession] = None
+) -> List[Entity]:
+    async with Session(session=session) as db:
+        return list(
+            (
+                await db.execute(
+                    select(Entity).where(Entity.is_device == True, Entity.name.in_(names))
+                )
+            ).scalars()
+        )
+
+
+async def get_entities_by_names(
+    names: List[str], session: Optional[AsyncSession] = None
+) -> List[Entity]:
+    async with Session(session=session) as db:
+        return list((await db.execute(select(Entity).where(Entity.name.in_(names)))).scalars())
+
+
+async def create_devices(
+    devices: List[Entity], session: Optional[AsyncSession] = None
+) -> List[Entity]:
+    async with Session(session=session) as db:
+        db.add_all(devices)
+        await db.flush()
+
+    return devices
+
+
+async def add_device_rooms(
+    rooms: Dict[str, str], user_matrix_id: str, session: Optional[AsyncSession] = None
+) -> List[Entity]:
+    """Give devices their room, ``rooms`` maps device names to room IDs."""
+    async with Session(session=session) as db:
+        devices = await get_devices_by_names(list(rooms), db)
+        for device in devices:
+            db.add(Room(id=rooms[device.name], entity=device, user_matrix_id=user_matrix_id))
+        await db.flush()
+
+    return devices
+
+
+async def get_entities(session: Optional[AsyncSession] = None) -> List[Entity]:
+    async with Session(session=session) as db:
+        return list((await db.execute(select(Entity))).scalars())
+
+
+async def set_ingest_token(
+    name: str, token: str, session: Optional[AsyncSession] = None
+) -> None:
+    async with Session(session=session) as db:
+        await db.execute(update(Entity).where(Entity.name == name).values(ingest_token=token))
+
+
+async def get_group_by_name(
+    name: str, session: Optional[AsyncSession] = None
+) -> Optional[Group]:
+    async with Session(session=session) as db:
+        return (await db.execute(select(Group).where(Group.name == name))).scalars().first()
+
+
+async def create_group(name: str, session: Optional[AsyncSession] = None) -> Group:
+    async with Session(session=session) as db:
+        group = Group(name=name)
+        db.add(group)
+        await db.flush()
+
+    return group
+
+
+async def delete_group(name: str, session: Optional[AsyncSession] = None) -> None:
+    async with Session(session=session) as db:
+        group = await get_group_by_name(name, db)
+        if group is None:
             return
 
-        room = db.query(Room).filter(Room.id == bot.room.id)
-        room.delete()
+        await db.execute(delete(entity_groups).where(entity_groups.c.group_id == group.id))
+        await db.delete(group)
+
+
+async def get_groups(session: Optional[AsyncSession] = None) -> List[Tuple[str, int]]:
+    """Names of all groups, each with its number of members."""
+    async with Session(session=session) as db:
+        return list(
+            await db.execute(
+                select(Group.name, func.count(entity_groups.c.entity_id))
+                .outerjoin(entity_groups, entity_groups.c.group_id == Group.id)
+                .group_by(Group.id)
+                .order_by(Group.name)
+            )
+        )
+
+
+async def add_group_members(
+    group: Group, devices: List[Entity], session: Optional[AsyncSession] = None
+) -> int:
+    async with Session(session=session) as db:
+        existing = set(
+            (
+                await db.execute(
+                    select(entity_groups.c.entity_id).where(
+                        entity_groups.c.group_id == group.id,
+                        entity_groups.c.entity_id.in_([device.id for device in devices]),
+                    )
+                )
+            ).scalars()
+        )
+        rows = [
+            {"group_id": group.id, "entity_id": device.id}
+            for device in devices
+            if device.id not in existing
+        ]
+        if rows:
+            await db.execute(insert(entity_groups), rows)
+
+    return len(rows)
+
+
+async def remove_group_members(
+    group: Group, devices: List[Entity], session: Optional[AsyncSession] = None
+) -> int:
+    async with Session(session=session) as db:
+        result = await db.execute(
+            delete(entity_groups).where(
+                entity_groups.c.group_id == group.id,
+                entity_groups.c.entity_id.in_([device.id for device in devices]),
+            )
+        )
+
+    return result.rowcount
+
+
+async def get_device_health(session: Optional[AsyncSession] = None) -> List[Row]:
+    async with Session(session=session) as db:
+        return list(await db.execute(_device_query(Entity.id, Entity.health_status)))
+
+
+async def update_device_health(
+    results: List[Dict[str, Any]], session: Optional[AsyncSession] = None
+) -> None:
+    """Save probe results, each a dict of Entity columns including the id."""
+    if not results:
+        return
+
+    async with Session(session=session) as db:
+        # Rows missing a column (e.g. last_seen for offline devices) go in
+        # their own batch so the column isn't overwritten with NULL
+        batches: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+        for result in results:
+            batches.setdefault(tuple(sorted(result)), []).append(result)
+
+        for batch in batches.values():
+            await db.execute(update(Entity), batch)
+
+
+async def insert_telemetry(
+    chunks: List[Dict[str, Any]],
+    rollups: List[Dict[str, Any]],
+    session: Optional[AsyncSession] = None,
+) -> None:
+    async with Session(session=session) as db:
+        if chunks:
+            await db.execute(insert(TelemetryChunk), chunks)
+        if rollups:
+            await db.execute(insert(TelemetryRollup), rollups)
+
+
+async def get_telemetry_summary(
+    entity_id: int,
+    metric: str,
+    since: int,
+    resolutions: List[int],
+    session: Optional[AsyncSession] = None,
+) -> Row:
+    """Count, min, max and sum of a metric from ``since`` on, read from the rollups."""
+    async with Session(session=session) as db:
+        return (
+            await db.execute(
+                select(
+                    func.sum(TelemetryRollup.count),
+                    func.min(TelemetryRollup.min),
+                    func.max(TelemetryRollup.max),
+                    func.sum(TelemetryRollup.sum),
+                ).where(
+                    TelemetryRollup.entity_id == entity_id,
+                    TelemetryRollup.metric == metric,
+                    TelemetryRollup.resolution.in_(resolutions),
+                    TelemetryRollup.bucket >= since,
+                )
+            )
+        ).one()
+
+
+async def get_telemetry_metrics(
+    entity_id: int, session: Optional[AsyncSession] = None
+) -> List[str]:
+    async with Session(session=session) as db:
+        return list(
+            (
+                await db.execute(
+                    select(TelemetryRollup.metric)
+                    .where(TelemetryRollup.entity_id == entity_id)
+                    .distinct()
+                    .order_by(TelemetryRollup.metric)
+                )
+            ).scalars()
+        )
+
+
+async def downsample_telemetry(
+    resolution: int, into: int, before: int, session: Optional[AsyncSession] = None
+) -> None:
+    """Merge rollups older than ``before`` into coarser buckets of ``into`` seconds.
+
+    ``before`` has to be a multiple of ``into``, so no bucket ends up split
+    between both resolutions.
+    """
+    bucket = TelemetryRollup.bucket - TelemetryRollup.bucket % into
+    old = (TelemetryRollup.resolution == resolution, TelemetryRollup.bucket < before)
+
+    async with Session(session=session) as db:
+        await db.execute(
+            insert(TelemetryRollup).from_select(
+                ["entity_id", "metric", "resolution", "bucket", "count", "min", "max", "sum"],
+                select(
+                    TelemetryRollup.entity_id,
+                    TelemetryRollup.metric,
+                    literal(into),
+                    bucket,
+                    func.sum(TelemetryRollup.count),
+                    func.min(TelemetryRollup.min),
+                    func.max(TelemetryRollup.max),
+                    func.sum(TelemetryRollup.sum),
+                )
+                .where(*old)
+                .group_by(TelemetryRollup.entity_id, TelemetryRollup.metric, bucket),
+            )
+        )
+        await db.execute(delete(TelemetryRollup).where(*old))
+
+
+async def prune_telemetry(
+    chunks_before: float,
+    rollups_before: int,
+    resolution: int,
+    session: Optional[AsyncSession] = None,
+) -> None:
+    async with Session(session=session) as db:
+        await db.execute(delete(TelemetryChunk).where(TelemetryChunk.start < chunks_before))
+        await db.execute(
+            delete(TelemetryRollup).where(
+                TelemetryRollup.resolution == resolution,
+                TelemetryRollup.bucket < rollups_before,
+            )
+        )
+
+
+async def create_job(job: Job, session: Optional[AsyncSession] = None) -> Job:
+    async with Session(session=session) as db:
+        db.add(job)
+
+    return job
+
+
+async def get_job(job_id: str, session: Optional[AsyncSession] = None) -> Optional[Job]:
+    async with Session(session=session) as db:
+        return (
+            await db.execute(
+                select(Job).options(sqlalchemy.orm.joinedload(Job.entity)).where(Job.id == job_id)
+            )
+        ).scalars().first()
+
+
+async def get_job_by_device_job_id(
+    entity_id: int, device_job_id: str, session: Optional[AsyncSession] = None
+) -> Optional[Job]:
+    async with Session(session=session) as db:
+        return (
+            await db.execute(
+                select(Job)
+                .options(sqlalchemy.orm.joinedload(Job.entity))
+                .where(Job.entity_id == entity_id, Job.device_job_id == device_job_id)
+            )
+        ).scalars().first()
+
+
+async def get_recent_jobs(limit: int, session: Optional[AsyncSession] = None) -> List[Job]:
+    async with Session(session=session) as db:
+        return list(
+            (
+                await db.execute(
+                    select(Job)
+                    .options(sqlalchemy.orm.joinedload(Job.entity))
+                    .order_by(Job.created_at.desc())
+                    .limit(limit)
+                )
+            ).scalars()
+        )
+
+
+async def get_running_device_jobs(session: Optional[AsyncSession] = None) -> List[Job]:
+    async with Session(session=session) as db:
+        return list(
+            (
+                await db.execute(
+                    select(Job)
+                    .options(sqlalchemy.orm.joinedload(Job.entity))
+                    .where(Job.status == "running", Job.device_job_id.is_not(None))
+                )
+            ).scalars()
+        )
+
+
+async def set_device_job_id(
+    job_id: str, device_job_id: str, session: Optional[AsyncSession] = None
+) -> None:
+    async with Session(session=session) as db:
+        await db.execute(update(Job).where(Job.id == job_id).values(device_job_id=device_job_id))
+
+
+async def finish_job(
+    job_id: str, status: str, result: Optional[str], session: Optional[AsyncSession] = None
+) -> bool:
+    """Record the outcome of a running job. False if it had already finished."""
+    async with Session(session=session) as db:
+        updated = await db.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == "running")
+            .values(status=status, result=result, finished_at=datetime.utcnow())
+        )
+
+    return updated.rowcount == 1
+
+
+async def fail_interrupted_jobs(
+    result: str, instance: Optional[str] = None, session: Optional[AsyncSession] = None
+) -> List[Job]:
+    """Fail the bridge side jobs that were running when the bridge (instance) stopped."""
+    async with Session(session=session) as db:
+        jobs = list(
+            (
+                await db.execute(
+                    select(Job)
+                    .options(sqlalchemy.orm.joinedload(Job.entity))
+                    .where(
+                        Job.status == "running",
+                        Job.device_job_id.is_(None),
+                        Job.instance == instance,
+                    )
+                )
+            ).scalars()
+        )
+
+        for job in jobs:
+            job.status = "failed"
+            job.result = result
+            job.finished_at = datetime.utcnow()
+
+    return jobs
+
+
+async def heartbeat_instance(
+    url: str, now: datetime, session: Optional[AsyncSession] = None
+) -> None:
+    async with Session(session=session) as db:
+        await db.merge(Instance(url=url, heartbeat_at=now))
+
+
+async def get_live_instances(
+    since: datetime, session: Optional[AsyncSession] = None
+) -> List[str]:
+    async with Session(session=session) as db:
+        return list(
+            (
+                await db.execute(
+                    select(Instance.url).where(Instance.heartbeat_at >= since).order_by(Instance.url)
+                )
+            ).scalars()
+        )
+
+
+async def remove_instances(
+    before: Optional[datetime] = None,
+    url: Optional[str] = None,
+    session: Optional[AsyncSession] = None,
+) -> List[str]:
+    """Forget an instance, or those whose last heartbeat is older than ``before``."""
+    query = select(Instance.url)
+    if before is not None:
+        query = query.where(Instance.heartbeat_at < before)
+    if url is not None:
+        query = query.where(Instance.url == url)
+
+    async with Session(session=session) as db:
+        urls = list((await db.execute(query)).scalars())
+        if urls:
+            await db.execute(delete(Instance).where(Instance.url.in_(urls)))
+
+    return urls
+
+
+async def acquire_lease(name: str, holder: str, now: datetime, expires_at: datetime) -> bool:
+    """Take or renew a lease, False while another holder's lease runs."""
+    try:
+        async with Session() as db:
+            renewed = await db.execute(
+                update(Lease)
+                .where(Lease.name == name, or_(Lease.holder == holder, Lease.expires_at < now))
+                .values(holder=holder, expires_at=expires_at)
+            )
+            if renewed.rowcount == 1:
+                return True
+
+            if await db.get(Lease, name) is not None:
+                return False
+
+            db.add(Lease(name=name, holder=holder, expires_at=expires_at))
+    except IntegrityError:
+        # Another instance created it first
+        return False
+
+    return True
+
+
+async def release_lease(
+    name: str, holder: str, session: Optional[AsyncSession] = None
+) -> None:
+    async with Session(session=session) as db:
+        await db.execute(delete(Lease).where(Lease.name == name, Lease.holder == holder))
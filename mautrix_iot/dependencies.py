@@ -1,9 +1,11 @@
+import hmac
 from typing import Annotated, Union
 
 from fastapi import Header
 
 from mautrix_iot.configuration import CONF
 from mautrix_iot.exceptions import ForbiddenError, UnauthorizedError
+from mautrix_iot.routing import DeviceRecord, routing_index
 
 
 async def check_authorization_header(
@@ -14,3 +16,24 @@ async def check_authorization_header(
 
     if authorization.removeprefix("Bearer ") != CONF.appservice["hs_token"]:
         raise ForbiddenError()
+
+
+async def check_device_token(
+    name: str,
+    authorization: Annotated[Union[str, None], Header()] = None,
+) -> DeviceRecord:
+    if not authorization:
+        raise UnauthorizedError()
+
+    # Unknown devices get the same answer as a wrong token
+    device = routing_index.for_name(name)
+    if (
+        device is None
+        or not device.ingest_token
+        or not hmac.compare_digest(
+            authorization.removeprefix("Bearer "), device.ingest_token
+        )
+    ):
+        raise ForbiddenError()
+
+    return device
@@ -1,39 +1,286 @@
-from typing import Any, Dict, List
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, List, Mapping, Optional, Tuple
 
-import requests
+import aiohttp
 
-from mautrix_iot.db.models import Entity
-from mautrix_iot.types import DeviceAPIResponseCommands, DeviceAPIResponseSendCommand
+from mautrix_iot.configuration import CONF
+from mautrix_iot.metrics import DEVICE_COMMAND_ERRORS, DEVICE_COMMAND_TIME
+from mautrix_iot.types import (
+    DeviceAPIResponse,
+    DeviceAPIResponseCommands,
+    DeviceAPIResponseJob,
+    DeviceAPIResponseSendCommand,
+)
 
+logger = logging.getLogger(__name__)
+
+
+class DeviceUnavailableError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Stops sending requests to a host after repeated connection failures.
+
+    While open, requests fail immediately and the host is pinged in the
+    background every ``probe_interval`` seconds until it answers again.
+    """
+
+    def __init__(self, client: "DeviceClient", host: str):
+        self.client = client
+        self.host = host
+        self.failures = 0
+        self._probe: Optional[asyncio.Task] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._probe is not None
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+
+        if self.failures >= self.client.failure_threshold and not self.is_open:
+            logger.warning("Device %s is unreachable, pausing requests", self.host)
+            self._probe = asyncio.create_task(self._probe_until_reachable())
+
+    async def _probe_until_reachable(self) -> None:
+        while True:
+            await asyncio.sleep(self.client.probe_interval)
+
+            try:
+                async with self.client.session.get(
+                    f"{self.host}/api/v1/ping"
+                ) as response:
+                    if response.status == 200:
+                        break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                continue
+
+        logger.info("Device %s is reachable again", self.host)
+        self.failures = 0
+        self._probe = None
+
+    def cancel(self) -> None:
+        if self._probe is not None:
+            self._probe.cancel()
+            self._probe = None
+
+
+class DeviceClient:
+    """Connection pool, timeouts and circuit breakers for device hosts."""
+
+    def __init__(self):
+        conf = CONF.get("devices", {})
+        self.connect_timeout = conf.get("connect_timeout", 5)
+        self.read_timeout = conf.get("read_timeout", 30)
+        self.concurrency = conf.get("concurrency_per_device", 4)
+        self.failure_threshold = conf.get("failure_threshold", 3)
+        self.probe_interval = conf.get("probe_interval", 30)
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0, limit_per_host=self.concurrency),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.connect_timeout, sock_read=self.read_timeout
+                ),
+            )
+
+        return self._session
+
+    @property
+    def unreachable(self) -> int:
+        return sum(1 for breaker in self._breakers.values() if breaker.is_open)
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        if host not in self._breakers:
+            self._breakers[host] = CircuitBreaker(self, host)
+        return self._breakers[host]
+
+    async def request(
+        self,
+        host: str,
+        method: str,
+        path: str,
+        timeout: Optional[aiohttp.ClientTimeout] = None,
+        **kwargs,
+    ) -> Tuple[int, str, Mapping[str, str]]:
+        """Send a request through the host's circuit breaker.
+
+        ``timeout`` replaces the session timeouts for requests that are
+        expected to take long. Running out of it is not held against the
+        device, only failing to connect is.
+        """
+        breaker = self.breaker(host)
+        if breaker.is_open:
+            raise DeviceUnavailableError(f"Device {host} is currently unreachable")
+
+        semaphore = self._semaphores.setdefault(
+            host, asyncio.Semaphore(self.concurrency)
+        )
+
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+
+        async with semaphore:
+            try:
+                async with self.session.request(
+                    method, f"{host}{path}", **kwargs
+                ) as response:
+                    text = await response.text()
+            except aiohttp.SocketTimeoutError:
+                if timeout is None:
+                    breaker.record_failure()
+                raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                breaker.record_failure()
+                raise
+
+        breaker.record_success()
+        # Kept case-insensitive, servers don't all spell headers like ETag the same way
+        return (response.status, text, response.headers.copy())
+
+    async def close(self) -> None:
+        for breaker in self._breakers.values():
+            breaker.cancel()
+
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+client = DeviceClient()
+
+
+def _response(code: Any, message: str, response: Any) -> Dict[str, Any]:
+    return {"error": {"code": code, "message": message}, "response": response}
+
+
+def _connection_error(error: Exception, response: Any) -> Dict[str, Any]:
+    if isinstance(error, DeviceUnavailableError):
+        return _response("UNAVAILABLE", str(error), response)
+    if isinstance(error, asyncio.TimeoutError):
+        return _response("TIMEOUT", "Device did not answer in time", response)
+    return _response("CONN_ERR", str(error), response)
+
+
+_CONNECTION_ERRORS = (DeviceUnavailableError, asyncio.TimeoutError, aiohttp.ClientError)
+
+
+async def ping_device(host: str) -> DeviceAPIResponse:
+    try:
+        status, text, _ = await client.request(host, "GET", "/api/v1/ping")
+    except _CONNECTION_ERRORS as error:
+        return _connection_error(error, {})
+
+    if status != 200:
+        return _response(status, text, {})
+
+    return _response("OK", "", {})
+
+
+async def get_available_device_commands(
+    host: str, etag: Optional[str] = None
+) -> DeviceAPIResponseCommands:
+    headers = {"If-None-Match": etag} if etag else {}
+
+    try:
+        status, text, response_headers = await client.request(
+            host, "GET", "/api/v1/commands", headers=headers
+        )
+    except _CONNECTION_ERRORS as error:
+        return {**_connection_error(error, []), "etag": None}
+
+    # Cached list is still current
+    if status == 304:
+        return {**_response("NOT_MODIFIED", "", []), "etag": etag}
+
+    if status != 200:
+        return {**_response(status, text, []), "etag": None}
 
-def get_available_device_commands(device: Entity) -> DeviceAPIResponseCommands:
     try:
-        response = requests.get(f"{device.host}/api/v1/commands")
-    except requests.exceptions.ConnectionError as error:
-        return {"error": {"code": "CONN_ERR", "message": str(error)}, "response": []}
+        commands = json.loads(text)
+    except ValueError:
+        return {**_response("BAD_RESPONSE", text, []), "etag": None}
+
+    return {**_response("OK", "", commands), "etag": response_headers.get("ETag")}
+
 
-    print(response.json())
-    return {"error": {"code": "OK", "message": ""}, "response": response.json()}
+async def send_command(
+    host: str,
+    command: str,
+    args: List[str],
+    timeout: Optional[aiohttp.ClientTimeout] = None,
+) -> DeviceAPIResponseSendCommand:
+    start = time.perf_counter()
+    response = await _send_command(host, command, args, timeout)
+
+    DEVICE_COMMAND_TIME.labels(host).observe(time.perf_counter() - start)
+    if response["error"]["code"] not in ("OK", "ACCEPTED"):
+        DEVICE_COMMAND_ERRORS.labels(host, str(response["error"]["code"])).inc()
 
+    return response
 
-def send_command(
-    device: Entity, command: str, args: List[str]
+
+async def _send_command(
+    host: str,
+    command: str,
+    args: List[str],
+    timeout: Optional[aiohttp.ClientTimeout] = None,
 ) -> DeviceAPIResponseSendCommand:
     try:
-        response = requests.post(
-            f"{device.host}/api/v1/command",
+        status, text, _ = await client.request(
+            host,
+            "POST",
+            "/api/v1/command",
+            timeout=timeout,
             json={
                 "command": command,
                 "args": args,
             },
         )
-    except requests.exceptions.ConnectionError as error:
-        return {"error": {"code": "CONN_ERR", "message": str(error)}, "response": {}}
+    except _CONNECTION_ERRORS as error:
+        return _connection_error(error, {})
+
+    # Long running command, the device answers with the ID of a job to follow
+    if status == 202:
+        try:
+            return _response("ACCEPTED", "", str(json.loads(text)["job_id"]))
+        except (ValueError, KeyError, TypeError):
+            return _response("BAD_RESPONSE", text, {})
+
+    if status != 200:
+        return _response(status, text, {})
+
+    return _response("OK", "", text)
+
+
+async def get_job_status(host: str, job_id: str) -> DeviceAPIResponseJob:
+    try:
+        status, text, _ = await client.request(host, "GET", f"/api/v1/jobs/{job_id}")
+    except _CONNECTION_ERRORS as error:
+        return _connection_error(error, {})
+
+    if status != 200:
+        return _response(status, text, {})
+
+    try:
+        job = json.loads(text)
+    except ValueError:
+        return _response("BAD_RESPONSE", text, {})
 
-    if response.status_code != 200:
-        return {
-            "error": {"code": response.status_code, "message": response.text},
-            "response": {},
-        }
+    if not isinstance(job, dict) or "status" not in job:
+        return _response("BAD_RESPONSE", text, {})
 
-    return {"error": {"code": "OK", "message": ""}, "response": response.text}
+    return _response("OK", "", job)
@@ -1,59 +1,74 @@
-from typing import Any, Dict
+import asyncio
+import secrets
+from typing import Any, Dict, List, Tuple
 from uuid import uuid4
 
 from mautrix_iot.configuration import CONF
+from mautrix_iot.consts import INGEST_TOKEN_MESSAGE
 from mautrix_iot.db.database import Session
 from mautrix_iot.db.models import Entity, Room
-from mautrix_iot.homeserver_api import create_room, register_user, send_message
+from mautrix_iot.db.operations import get_entity_by_name
+from mautrix_iot.device_api import send_command
+from mautrix_iot.dispatcher import dispatcher
+from mautrix_iot.homeserver_api import create_room, register_user
+from mautrix_iot.routing import DeviceRecord, routing_index
+from mautrix_iot.types import DeviceAPIResponseSendCommand
 from mautrix_iot.utils import bot_full_name
 
 
-def register_new_device(data: Dict[str, Any], bot_room_id: str, room_peer_id: str):
+async def register_new_device(data: Dict[str, Any], bot_room_id: str, room_peer_id: str):
     device_matrix_username = f"iot_{uuid4()}"
-    status_code, response = register_user(username=device_matrix_username)
+    status_code, response = await register_user(username=device_matrix_username)
 
     if status_code != 200:
         if status_code == 400 or status_code == 403:
             message = f"❌  Unable to setup device: ({status_code}) {response.get('error', '')}"
         elif status_code == 401:
-            message = (
-                f"❌  Unable to setup device: ({status_code}) Required more authentication information",
-            )
+            message = f"❌  Unable to setup device: ({status_code}) Required more authentication information"
         else:
             message = f"❌  Unable to setup device"
 
-        send_message(
+        dispatcher.send(
             message,
             room_id=bot_room_id,
             sender=bot_full_name(),
         )
         return
 
-    with Session() as db:
+    ingest_token = secrets.token_urlsafe(32)
+
+    async with Session() as db:
         db.add(
             Entity(
                 name=data["device_name"],
                 host=data["device_host"],
                 matrix_id=device_matrix_username,
                 access_token=response["access_token"],
+                ingest_token=ingest_token,
                 is_device=True,
             )
         )
 
-    send_message(
+    dispatcher.send(
         f"Registered user {response['user_id']}",
         room_id=bot_room_id,
         sender=bot_full_name(),
     )
+    dispatcher.send(
+        INGEST_TOKEN_MESSAGE(data["device_name"], ingest_token),
+        formatted_body=INGEST_TOKEN_MESSAGE(data["device_name"], ingest_token),
+        room_id=bot_room_id,
+        sender=bot_full_name(),
+    )
 
-    status_code, response = create_room(
+    status_code, response = await create_room(
         name=data["device_name"],
         room_peer=room_peer_id,
         access_token=response["access_token"],
     )
 
     if status_code == 400:
-        send_message(
+        dispatcher.send(
             f"❌ Could not create room with new device: {response['error']}",
             room_id=bot_room_id,
             sender=bot_full_name(),
@@ -62,18 +77,19 @@ def register_new_device(data: Dict[str, Any], bot_room_id: str, room_peer_id: st
 
     direct_room_id = response["room_id"]
 
-    with Session() as db:
+    async with Session() as db:
+        device = await get_entity_by_name(data["device_name"], db)
         db.add(
             Room(
                 id=direct_room_id,
-                entity=db.query(Entity)
-                .filter(Entity.name == data["device_name"])
-                .first(),
+                entity=device,
                 user_matrix_id=room_peer_id,
             )
         )
+        await db.flush()
+        routing_index.add(DeviceRecord.from_entity(device))
 
-    send_message(
+    dispatcher.send(
         body=f"You can start chatting with the device at https://matrix.to/#/{direct_room_id}:{CONF.homeserver['domain']}",
         formatted_body=(
             "You can start chatting with the device at "
@@ -83,3 +99,27 @@ def register_new_device(data: Dict[str, Any], bot_room_id: str, room_peer_id: st
         room_id=bot_room_id,
         sender=bot_full_name(),
     )
+
+
+async def broadcast_command(
+    devices: List[Entity], command: str, args: List[str]
+) -> List[Tuple[Entity, DeviceAPIResponseSendCommand]]:
+    """Send a command to many devices at once, with a cap on parallel requests."""
+    conf = CONF.get("devices", {})
+    semaphore = asyncio.Semaphore(conf.get("broadcast_concurrency", 50))
+    timeout = conf.get("broadcast_timeout", 30)
+
+    async def send(device: Entity) -> DeviceAPIResponseSendCommand:
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(
+                    send_command(device.host, command, args), timeout
+                )
+            except asyncio.TimeoutError:
+                return {
+                    "error": {"code": "TIMEOUT", "message": "Device did not answer in time"},
+                    "response": {},
+                }
+
+    responses = await asyncio.gather(*(send(device) for device in devices))
+    return list(zip(devices, responses))
@@ -0,0 +1,180 @@
+import asyncio
+import html
+import json
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from mautrix_iot.configuration import CONF
+from mautrix_iot.homeserver_api import send_message
+
+logger = logging.getLogger(__name__)
+
+
+class OutgoingMessage:
+    def __init__(
+        self,
+        body: str,
+        sender: str,
+        formatted_body: Optional[str] = None,
+        access_token: Optional[str] = None,
+        reply_to: Optional[str] = None,
+    ):
+        self.body = body
+        self.formatted_body = formatted_body
+        self.sender = sender
+        self.access_token = access_token
+        self.reply_to = reply_to
+        # Chosen once, so every retry of this message reuses it
+        self.txn_id = uuid4().hex
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        # Senders usually don't wait for the result, failures are logged instead
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    @property
+    def html(self) -> str:
+        if self.formatted_body is not None:
+            return self.formatted_body
+        return html.escape(self.body).replace("\n", "<br>")
+
+    @property
+    def size(self) -> int:
+        return len(json.dumps([self.body, self.formatted_body]).encode())
+
+    def can_merge(self, other: "OutgoingMessage") -> bool:
+        return (
+            self.sender == other.sender
+            and self.access_token == other.access_token
+            and self.reply_to == other.reply_to
+        )
+
+    @classmethod
+    def merge(cls, messages: List["OutgoingMessage"]) -> "OutgoingMessage":
+        if len(messages) == 1:
+            return messages[0]
+
+        formatted = any(message.formatted_body is not None for message in messages)
+        merged = cls(
+            body="\n".join(message.body for message in messages),
+            formatted_body=(
+                "<br>".join(message.html for message in messages) if formatted else None
+            ),
+            sender=messages[0].sender,
+            access_token=messages[0].access_token,
+            reply_to=messages[0].reply_to,
+        )
+        merged.txn_id = messages[0].txn_id
+        return merged
+
+
+class MessageDispatcher:
+    """Sends messages to rooms in the background.
+
+    Each room has its own FIFO queue, so messages keep their order inside a
+    room while different rooms are sent to in parallel. Messages queued for
+    the same room and sender within ``coalesce_window`` seconds are joined
+    into a single event, as long as it stays under ``max_event_size``.
+    """
+
+    def __init__(self, coalesce_window: float, max_event_size: int):
+        self.coalesce_window = coalesce_window
+        self.max_event_size = max_event_size
+        self._queues: Dict[str, Deque[OutgoingMessage]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    @property
+    def max_text_size(self) -> int:
+        """Largest text that fits in one event when sent as both body and HTML."""
+        return self.max_event_size // 2
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def send(
+        self,
+        body: str,
+        room_id: str,
+        sender: str,
+        formatted_body: Optional[str] = None,
+        access_token: Optional[str] = None,
+        reply_to: Optional[str] = None,
+    ) -> "asyncio.Future[Tuple[int, Dict[str, Any]]]":
+        """Queue a message, the returned future resolves once it was sent."""
+        message = OutgoingMessage(body, sender, formatted_body, access_token, reply_to)
+        self._queues.setdefault(room_id, deque()).append(message)
+
+        if room_id not in self._tasks:
+            self._tasks[room_id] = asyncio.create_task(self._drain(room_id))
+
+        return message.future
+
+    def _next_batch(self, queue: Deque[OutgoingMessage]) -> List[OutgoingMessage]:
+        batch = [queue.popleft()]
+        size = batch[0].size
+
+        while queue and batch[0].can_merge(queue[0]):
+            if size + queue[0].size > self.max_event_size:
+                break
+
+            size += queue[0].size
+            batch.append(queue.popleft())
+
+        return batch
+
+    async def _drain(self, room_id: str) -> None:
+        queue = self._queues[room_id]
+
+        try:
+            while queue:
+                # Give the handler a moment to queue the rest of its reply
+                if self.coalesce_window > 0:
+                    await asyncio.sleep(self.coalesce_window)
+
+                batch = self._next_batch(queue)
+                message = OutgoingMessage.merge(batch)
+
+                try:
+                    result = await send_message(
+                        message.body,
+                        room_id=room_id,
+                        sender=message.sender,
+                        formatted_body=message.formatted_body,
+                        access_token=message.access_token,
+                        txn_id=message.txn_id,
+                        reply_to=message.reply_to,
+                    )
+                except Exception as error:
+                    self.failed += len(batch)
+                    logger.exception("Failed to send message to %s", room_id)
+                    for queued in batch:
+                        queued.future.set_exception(error)
+                else:
+                    self.sent += 1
+                    self.coalesced += len(batch) - 1
+                    for queued in batch:
+                        queued.future.set_result(result)
+        finally:
+            del self._tasks[room_id]
+            if not queue:
+                del self._queues[room_id]
+
+    async def close(self, timeout: float) -> None:
+        """Wait up to ``timeout`` seconds for queued messages to be sent."""
+        if not self._tasks:
+            return
+
+        _, pending = await asyncio.wait(list(self._tasks.values()), timeout=timeout)
+        for task in pending:
+            task.cancel()
+
+
+dispatcher = MessageDispatcher(
+    coalesce_window=CONF.homeserver.get("coalesce_window", 0.05),
+    max_event_size=CONF.homeserver.get("max_event_size", 60000),
+)
@@ -35,3 +35,9 @@ class RateLimitedError(MatrixError):
     def __init__(self):
         self.m_code = MatrixErrorCode.M_LIMIT_EXCEEDED
         self.msg = f"Too many requests"
+
+
+class NotFoundError(MatrixError):
+    def __init__(self, what: str):
+        self.m_code = MatrixErrorCode.M_NOT_FOUND
+        self.msg = f"{what} not found"
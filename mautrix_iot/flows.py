@@ -1,16 +1,63 @@
-from typing import Any, Dict, List, Optional
-from uuid import uuid4
-
-import requests
+import asyncio
+import csv
+import html
+import json
+import logging
+import secrets
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import yaml
 from validator_collection import checkers
 
+from mautrix_iot.catalog import command_catalogs
 from mautrix_iot.configuration import CONF
-from mautrix_iot.consts import DEVICE_MESSAGE_FORMAT, HELP_MESSAGE
-from mautrix_iot.db.database import Session
+from mautrix_iot.consts import (
+    BROADCAST_RESULT_FORMAT,
+    DEVICE_MESSAGE_FORMAT,
+    HELP_MESSAGE,
+    INGEST_TOKEN_MESSAGE,
+    JOB_MESSAGE_FORMAT,
+    JOB_STATUS_ICONS,
+)
 from mautrix_iot.db.models import Entity
-from mautrix_iot.devices import register_new_device
-from mautrix_iot.homeserver_api import create_room, register_user, send_message
-from mautrix_iot.utils import bot_full_name, retry_rate_limited
+from mautrix_iot.db.operations import (
+    add_group_members,
+    create_group,
+    delete_group,
+    count_devices,
+    get_device_page,
+    get_device_page_start,
+    get_devices,
+    get_devices_by_names,
+    get_entity_by_name,
+    get_group_by_name,
+    get_groups,
+    get_job,
+    get_recent_jobs,
+    remove_group_members,
+    set_ingest_token,
+)
+from mautrix_iot.device_api import get_available_device_commands, ping_device
+from mautrix_iot.devices import broadcast_command, register_new_device
+from mautrix_iot.dispatcher import dispatcher
+from mautrix_iot.jobs import job_manager
+from mautrix_iot.provisioning import device_importer, load_manifest
+from mautrix_iot.routing import DeviceRecord, routing_index
+from mautrix_iot.utils import format_health, split_message
+
+logger = logging.getLogger(__name__)
+
+
+def _option(args: List[str], option: str) -> Tuple[Optional[str], List[str]]:
+    """Split an option such as `--group <name>` off the command arguments."""
+    if option not in args:
+        return None, args
+
+    index = args.index(option)
+    value = args[index + 1] if index + 1 < len(args) else ""
+
+    return value, args[:index] + args[index + 2:]
 
 
 class BasicFlow:
@@ -21,8 +68,8 @@ class BasicFlow:
             self.flow = flow
             self.args = args
 
-        def send_input(self, value: str):
-            validated, reason = self.validate(value)
+        async def send_input(self, value: str):
+            validated, reason = await self.validate(value)
             if not validated:
                 return validated, reason
 
@@ -30,11 +77,10 @@ class BasicFlow:
 
             return True, reason
 
-        def validate(self, value: str):
+        async def validate(self, value: str):
             return True, None
 
-        @property
-        def prompt(self):
+        async def prompt(self) -> str:
             raise NotImplementedError()
 
     def __init__(self, room_id: str, room_peer: str, args: List[str]):
@@ -49,39 +95,48 @@ class BasicFlow:
     def available_states(self) -> List[BasicState]:
         return []
 
-    def next_state(self) -> None:
+    @property
+    def state_index(self) -> int:
+        return self.states.index(self.state)
+
+    def restore(self, state_index: int, props: Dict[str, Any]) -> None:
+        """Resume a flow at a given state with the results gathered so far."""
+        # States hold a reference to self.props, so update it in place
+        self.props.update(props)
+        self.state = self.states[state_index]
+
+    async def next_state(self) -> None:
         try:
             index = self.states.index(self.state)
         except ValueError:
             raise ValueError(f"Illegal state: {self.state}")
 
         if index == len(self.states) - 1:
-            self.done_callback()
+            await self.done_callback()
             return
 
         self.state = self.states[index + 1]
 
-    @property
-    def prompt(self) -> str:
-        return self.state.prompt
+    async def prompt(self) -> Union[str, List[str]]:
+        # Long prompts are split into several messages
+        return await self.state.prompt()
 
-    def send(self, value: str):
-        validated, reason = self.state.send_input(value)
+    async def send(self, value: str):
+        validated, reason = await self.state.send_input(value)
 
         if validated:
-            self.next_state()
+            await self.next_state()
             return True, reason
 
         return validated, reason
 
-    def done_callback(self):
+    async def done_callback(self):
         self.done = True
 
 
 class HelpFlow(BasicFlow):
     class HelpState(BasicFlow.BasicState):
-        @property
-        def prompt(self) -> str:
+        async def prompt(self) -> str:
             self.flow.done = True
             return HELP_MESSAGE
 
@@ -93,38 +148,37 @@ class HelpFlow(BasicFlow):
 
 class RegisterDeviceFlow(BasicFlow):
     class DeviceNameState(BasicFlow.BasicState):
-        def validate(self, value: str):
+        async def validate(self, value: str):
             if len(value) > 30:
                 return False, "❌  Device name too long (max 30 characters)"
 
-            with Session() as db:
-                if db.query(Entity).filter(Entity.name == value).first():
-                    return False, "❌  Device with the same name already exists"
+            if await get_entity_by_name(value):
+                return False, "❌  Device with the same name already exists"
 
             return True, None
 
-        @property
-        def prompt(self) -> str:
+        async def prompt(self) -> str:
             return "What is the device name?"
 
     class DeviceHostState(BasicFlow.BasicState):
-        def validate(self, value: str):
+        async def validate(self, value: str):
             if not checkers.is_url(value, allow_special_ips=True):
                 return False, "❌  Host is not a valid URL"
 
-            r = requests.get(f"{value}/api/v1/ping")
-            if r.status_code != 200:
+            response = await ping_device(value)
+            if response["error"]["code"] != "OK":
                 return False, "❌  Could not reach device"
-            
-            r = requests.get(f"{value}/api/v1/commands")
-            if r.status_code != 200:
+
+            response = await get_available_device_commands(value)
+            if response["error"]["code"] != "OK":
                 return False, "❌  Could not fetch available commands"
-        
-            print(f"--------------HERE----------", r.json(), r.text)
-            return True, r.text
 
-        @property
-        def prompt(self) -> str:
+            # Warm the command cache, the device room will need it right away
+            command_catalogs.put(value, response["response"], response["etag"])
+
+            return True, json.dumps(response["response"])
+
+        async def prompt(self) -> str:
             return "What is the device host? (e.g. http://192.168.1.5:35329)"
 
     def available_states(self) -> List[BasicFlow.BasicState]:
@@ -133,36 +187,112 @@ class RegisterDeviceFlow(BasicFlow):
             RegisterDeviceFlow.DeviceHostState(self, "device_host", self.props, self.args),
         ]
 
-    @retry_rate_limited
-    def done_callback(self) -> None:
-        super().done_callback()
+    async def done_callback(self) -> None:
+        await super().done_callback()
 
-        register_new_device(self.props, self.room_id, self.room_peer)
+        await register_new_device(self.props, self.room_id, self.room_peer)
 
 
-class ListDevicesFlow(BasicFlow):
-    class ListState(BasicFlow.BasicState):
-        @property
-        def prompt(self) -> str:
+class ImportDevicesFlow(BasicFlow):
+    class ImportState(BasicFlow.BasicState):
+        async def prompt(self) -> str:
             self.flow.done = True
 
-            with Session() as db:
-                devices = db.query(Entity).filter(Entity.is_device == True).all()
+            if len(self.args) == 0:
+                return "❌  Usage: import <em>&lt;file&gt;</em>"
 
-                if len(devices) == 0:
-                    return "There are no registered devices."
-                
-                return self._format_devices_list(devices)
-            
-        def _format_devices_list(self, devices: List[Entity]) -> str:
-            message = "<ul> <br> "
+            if device_importer.running:
+                return "❌  An import is already running."
 
-            for device in devices:
-                message += DEVICE_MESSAGE_FORMAT(device.id, device.name, device.host, device.room_id)
-            message += " </ul> "
+            # Only manifests put in the import directory, not any file the bridge can read
+            directory = Path(CONF.get("devices", {}).get("import_directory", "manifests")).resolve()
+            path = (directory / " ".join(self.args)).resolve()
+            if not path.is_relative_to(directory) or not path.is_file():
+                return "❌  There is no such manifest in the import directory."
+
+            try:
+                entries = load_manifest(str(path))
+            except (OSError, UnicodeDecodeError, yaml.YAMLError, csv.Error) as error:
+                # The parser's message may quote the file, it only goes to the log
+                logger.warning("Could not read the manifest %s: %s", path, error)
+                return "❌  Could not read the manifest, check that it is valid YAML or CSV."
+            except ValueError as error:
+                return f"❌  {html.escape(str(error))}"
+
+            if len(entries) == 0:
+                return "There are no devices in the manifest."
+
+            device_importer.start(entries, self.flow.room_id, self.flow.room_peer)
+
+            return f"Importing {len(entries)} devices, progress will be posted here."
+
+    def available_states(self) -> List[BasicFlow.BasicState]:
+        return [
+            ImportDevicesFlow.ImportState(self, "", self.props, self.args),
+        ]
+
+
+class ListDevicesFlow(BasicFlow):
+    class ListState(BasicFlow.BasicState):
+        async def prompt(self) -> Union[str, List[str]]:
+            self.flow.done = True
+
+            group, args = _option(self.args, "--group")
+            name_filter, args = _option(args, "--filter")
+            if group == "" or name_filter == "":
+                return "❌  Usage: list <em>[page]</em> <em>[--group &lt;group&gt;]</em> <em>[--filter &lt;text&gt;]</em>"
+
+            page = 1
+            if len(args) > 0:
+                if not args[0].isdigit() or int(args[0]) < 1:
+                    return "❌  Page must be a positive number."
+                page = int(args[0])
+
+            page_size = CONF.get("devices", {}).get("list_page_size", 50)
+            total = await count_devices(name_filter, group)
+
+            if total == 0:
+                if group is not None or name_filter is not None:
+                    return "There are no devices matching the filters."
+                return "There are no registered devices."
+
+            after_id = await get_device_page_start(page, page_size, name_filter, group)
+            if after_id is None:
+                return f"❌  There are only {-(-total // page_size)} pages."
+
+            devices = await get_device_page(after_id, page_size, name_filter, group)
+
+            return self._format_devices_list(devices, page, page_size, total)
+
+        def _format_devices_list(self, devices, page: int, page_size: int, total: int) -> List[str]:
+            first = (page - 1) * page_size + 1
+            header = f"Devices {first}-{first + len(devices) - 1} of {total}: "
+            footer = ""
+
+            if first + len(devices) - 1 < total:
+                options = " ".join(self.args[1:] if self.args and self.args[0].isdigit() else self.args)
+                footer = f" Send <strong> list {page + 1} {options} </strong> for the next page."
+
+            messages = split_message(
+                [
+                    DEVICE_MESSAGE_FORMAT(
+                        device.id,
+                        device.name,
+                        device.host,
+                        device.room_id,
+                        format_health(device.health_status, device.last_seen),
+                    )
+                    for device in devices
+                ],
+                dispatcher.max_text_size - len(header) - len(footer),
+                prefix="<ul> <br> ",
+                suffix=" </ul> ",
+            )
+            messages[0] = header + messages[0]
+            messages[-1] += footer
+
+            return messages
 
-            return message
-        
     def available_states(self) -> List[BasicFlow.BasicState]:
         return [
             ListDevicesFlow.ListState(self, "", self.props, self.args),
@@ -171,32 +301,48 @@ class ListDevicesFlow(BasicFlow):
         
 class InfoDeviceFlow(BasicFlow):
     class InfoState(BasicFlow.BasicState):
-        @property
-        def prompt(self) -> str:
+        async def prompt(self) -> Union[str, List[str]]:
             self.flow.done = True
 
-            if len(self.args) != 1:
+            group, args = _option(self.args, "--group")
+
+            if group is not None:
+                if group == "":
+                    return "❌  Provide a group name after --group."
+
+                devices = await get_devices(group=group)
+                if len(devices) == 0:
+                    return f"There are no devices in the group <strong> {group} </strong>."
+
+                return split_message(
+                    [self._format_device(device) for device in devices], dispatcher.max_text_size
+                )
+
+            if len(args) != 1:
                 return "❌  Provide a registered device name."
             
-            device_name = self.args[0]
+            device_name = args[0]
             
-            with Session() as db:
-                device = db.query(Entity).filter(Entity.name == device_name).first()
-
-                if device is None:
-                    return f"❌ There is no registered device with the name <strong> {device_name} </strong>."
-                
-                return f"""
-                    <ul>
-                       <li> <strong> ID: </strong> {device.id} </li>
-                       <li> <strong> Name: </strong> {device.name} </li>
-                       <li> <strong> Description: </strong> {device.description} </li>
-                       <li> <strong> Host: </strong> {device.host} </li>
-                       <li> <strong> User: </strong> <a href="https://matrix.to/#/@{device.matrix_id}:{CONF['homeserver']['domain']}"> {device.matrix_id} </a> </li>
-                       <li> <strong> Room: </strong> <a href="https://matrix.to/#/{device.room_id}"> {device.room_id} </a> </li>
-                       <li> <strong> Access token: </strong> {10 * '*'}{device.access_token[-6:]} </li>
-                    </ul>
-                """
+            device = await get_entity_by_name(device_name)
+
+            if device is None:
+                return f"❌ There is no registered device with the name <strong> {device_name} </strong>."
+
+            return self._format_device(device)
+
+        def _format_device(self, device: Entity) -> str:
+            return f"""
+                <ul>
+                   <li> <strong> ID: </strong> {device.id} </li>
+                   <li> <strong> Name: </strong> {device.name} </li>
+                   <li> <strong> Description: </strong> {device.description} </li>
+                   <li> <strong> Host: </strong> {device.host} </li>
+                   <li> <strong> Health: </strong> {format_health(device.health_status, device.last_seen, device.last_latency_ms)} </li>
+                   <li> <strong> User: </strong> <a href="https://matrix.to/#/@{device.matrix_id}:{CONF['homeserver']['domain']}"> {device.matrix_id} </a> </li>
+                   <li> <strong> Room: </strong> <a href="https://matrix.to/#/{device.room_id}"> {device.room_id} </a> </li>
+                   <li> <strong> Access token: </strong> {10 * '*'}{device.access_token[-6:]} </li>
+                </ul>
+            """
         
     def available_states(self) -> List[BasicFlow.BasicState]:
         return [
@@ -204,10 +350,279 @@ class InfoDeviceFlow(BasicFlow):
         ]
 
 
+class RefreshDeviceFlow(BasicFlow):
+    class RefreshState(BasicFlow.BasicState):
+        async def prompt(self) -> str:
+            self.flow.done = True
+
+            if len(self.args) == 0:
+                command_catalogs.invalidate()
+                return "Commands of all devices will be fetched again."
+
+            device_name = self.args[0]
+
+            device = await get_entity_by_name(device_name)
+
+            if device is None:
+                return f"❌ There is no registered device with the name <strong> {device_name} </strong>."
+
+            command_catalogs.invalidate(device.host)
+            return f"Commands of <strong> {device_name} </strong> will be fetched again."
+
+    def available_states(self) -> List[BasicFlow.BasicState]:
+        return [
+            RefreshDeviceFlow.RefreshState(self, "", self.props, self.args),
+        ]
+
+
+class TokenFlow(BasicFlow):
+    class TokenState(BasicFlow.BasicState):
+        async def prompt(self) -> str:
+            self.flow.done = True
+
+            if len(self.args) not in (1, 2) or self.args[1:] not in ([], ["rotate"]):
+                return "❌  Usage: token <em>&lt;name&gt;</em> <em>[rotate]</em>"
+
+            device_name = self.args[0]
+            device = await get_entity_by_name(device_name)
+
+            if device is None or not device.is_device:
+                return f"❌ There is no registered device with the name <strong> {device_name} </strong>."
+
+            token = device.ingest_token
+            if token is None or self.args[1:] == ["rotate"]:
+                token = secrets.token_urlsafe(32)
+                await set_ingest_token(device_name, token)
+                routing_index.set_ingest_token(device.matrix_id, token)
+
+            return INGEST_TOKEN_MESSAGE(device_name, token)
+
+    def available_states(self) -> List[BasicFlow.BasicState]:
+        return [
+            TokenFlow.TokenState(self, "", self.props, self.args),
+        ]
+
+
+class BroadcastFlow(BasicFlow):
+    class BroadcastState(BasicFlow.BasicState):
+        async def prompt(self) -> str:
+            self.flow.done = True
+
+            if len(self.args) < 2:
+                return "❌  Usage: broadcast <em>&lt;all|group|name,...&gt;</em> <em>&lt;command&gt;</em> <em>[args]</em>"
+
+            target, command, *args = self.args
+
+            if target == "all":
+                devices = await get_devices()
+            elif await get_group_by_name(target) is not None:
+                devices = await get_devices(group=target)
+            else:
+                devices = await get_devices_by_names(target.split(","))
+
+            if len(devices) == 0:
+                return f"❌ No registered devices match <strong> {target} </strong>."
+
+            results = await broadcast_command(devices, command, args)
+
+            # Jobs devices run on their own are followed like in a device room, and
+            # the outcome is posted in each device's room
+            accepted = [
+                (device, response["response"])
+                for device, response in results
+                if response["error"]["code"] == "ACCEPTED"
+            ]
+            jobs = await asyncio.gather(
+                *(
+                    job_manager.track(
+                        DeviceRecord.from_entity(device), job_id, command, args, device.room_id, None
+                    )
+                    for device, job_id in accepted
+                )
+            )
+            job_ids = {device.id: job.id for (device, _), job in zip(accepted, jobs)}
+
+            return self._format_results(command, results, job_ids)
+
+        def _format_results(self, command: str, results, job_ids: Dict[int, str]) -> List[str]:
+            failed = sum(
+                1
+                for _, response in results
+                if response["error"]["code"] not in ("OK", "ACCEPTED")
+            )
+            header = (
+                f"Sent <strong> {command} </strong> to {len(results)} devices: "
+                f"{len(results) - failed} succeeded, {failed} failed."
+            )
+            lines = []
+
+            for device, response in sorted(results, key=lambda result: result[0].name):
+                if response["error"]["code"] == "OK":
+                    lines.append(BROADCAST_RESULT_FORMAT(device.name, "✅", response["response"]))
+                elif response["error"]["code"] == "ACCEPTED":
+                    lines.append(
+                        BROADCAST_RESULT_FORMAT(
+                            device.name, "⏳", f"running as job <code>{job_ids[device.id]}</code>"
+                        )
+                    )
+                else:
+                    lines.append(BROADCAST_RESULT_FORMAT(device.name, "❌", response["error"]["message"]))
+
+            messages = split_message(
+                lines, dispatcher.max_text_size - len(header), prefix="\n<ul>", suffix="\n</ul>"
+            )
+            messages[0] = header + messages[0]
+
+            return messages
+
+    def available_states(self) -> List[BasicFlow.BasicState]:
+        return [
+            BroadcastFlow.BroadcastState(self, "", self.props, self.args),
+        ]
+
+
+class GroupFlow(BasicFlow):
+    class GroupState(BasicFlow.BasicState):
+        async def prompt(self) -> str:
+            self.flow.done = True
+
+            if len(self.args) == 0 or self.args[0] == "list":
+                return await self._list()
+
+            action, *args = self.args
+            if len(args) == 0:
+                return "❌  Provide a group name."
+
+            name = args[0]
+
+            if action == "create":
+                if await get_group_by_name(name) is not None:
+                    return f"❌  Group <strong> {name} </strong> already exists."
+
+                await create_group(name)
+                return f"Group <strong> {name} </strong> created."
+
+            group = await get_group_by_name(name)
+            if group is None:
+                return f"❌ There is no group with the name <strong> {name} </strong>."
+
+            if action == "delete":
+                await delete_group(name)
+                return f"Group <strong> {name} </strong> deleted."
+
+            if action == "members":
+                devices = await get_devices(group=name)
+                if len(devices) == 0:
+                    return f"There are no devices in the group <strong> {name} </strong>."
+
+                return f"<strong> {name}: </strong> " + ", ".join(device.name for device in devices)
+
+            if action in ("add", "remove"):
+                if len(args) != 2:
+                    return f"❌  Usage: group {action} <em>&lt;group&gt;</em> <em>&lt;name,...&gt;</em>"
+
+                names = args[1].split(",")
+                devices = await get_devices_by_names(names)
+                unknown = set(names) - {device.name for device in devices}
+                if unknown:
+                    return f"❌ There are no registered devices named <strong> {', '.join(sorted(unknown))} </strong>."
+
+                if action == "add":
+                    count = await add_group_members(group, devices)
+                    return f"Added {count} devices to <strong> {name} </strong>."
+
+                count = await remove_group_members(group, devices)
+                return f"Removed {count} devices from <strong> {name} </strong>."
+
+            return f"❌  Unknown group action <strong> {action} </strong>."
+
+        async def _list(self) -> str:
+            groups = await get_groups()
+
+            if len(groups) == 0:
+                return "There are no groups."
+
+            return "<ul> " + "".join(
+                f"<li> <strong> {name} </strong> ({count} devices) </li>" for name, count in groups
+            ) + " </ul>"
+
+    def available_states(self) -> List[BasicFlow.BasicState]:
+        return [
+            GroupFlow.GroupState(self, "", self.props, self.args),
+        ]
+
+
+class JobsFlow(BasicFlow):
+    class JobsState(BasicFlow.BasicState):
+        async def prompt(self) -> str:
+            self.flow.done = True
+
+            jobs = await get_recent_jobs(CONF.get("jobs", {}).get("list_limit", 20))
+
+            if len(jobs) == 0:
+                return "There are no jobs."
+
+            return "<ul> " + "".join(
+                JOB_MESSAGE_FORMAT(
+                    job.id,
+                    job.entity.name if job.entity else "?",
+                    job.command,
+                    job.status,
+                    job.created_at,
+                )
+                for job in jobs
+            ) + " </ul>"
+
+    def available_states(self) -> List[BasicFlow.BasicState]:
+        return [
+            JobsFlow.JobsState(self, "", self.props, self.args),
+        ]
+
+
+class JobFlow(BasicFlow):
+    class JobState(BasicFlow.BasicState):
+        async def prompt(self) -> str:
+            self.flow.done = True
+
+            if len(self.args) != 1:
+                return "❌  Provide a job ID."
+
+            job = await get_job(self.args[0])
+
+            if job is None:
+                return f"❌ There is no job with the ID <code>{self.args[0]}</code>."
+
+            finished = f"{job.finished_at:%Y-%m-%d %H:%M:%S} UTC" if job.finished_at else "-"
+
+            return f"""
+                <ul>
+                   <li> <strong> ID: </strong> <code>{job.id}</code> </li>
+                   <li> <strong> Device: </strong> {job.entity.name if job.entity else "?"} </li>
+                   <li> <strong> Command: </strong> {" ".join([job.command, *job.args])} </li>
+                   <li> <strong> Status: </strong> {JOB_STATUS_ICONS.get(job.status, "")} {job.status.replace("_", " ")} </li>
+                   <li> <strong> Device job: </strong> {job.device_job_id or "-"} </li>
+                   <li> <strong> Started: </strong> {job.created_at:%Y-%m-%d %H:%M:%S} UTC </li>
+                   <li> <strong> Finished: </strong> {finished} </li>
+                   <li> <strong> Result: </strong> {job.result or "-"} </li>
+                </ul>
+            """
+
+    def available_states(self) -> List[BasicFlow.BasicState]:
+        return [
+            JobFlow.JobState(self, "", self.props, self.args),
+        ]
+
 
 COMMANDS = {
     "help": HelpFlow,
     "register": RegisterDeviceFlow,
+    "import": ImportDevicesFlow,
     "list": ListDevicesFlow,
     "info": InfoDeviceFlow,
+    "refresh": RefreshDeviceFlow,
+    "broadcast": BroadcastFlow,
+    "token": TokenFlow,
+    "jobs": JobsFlow,
+    "job": JobFlow,
+    "group": GroupFlow,
 }
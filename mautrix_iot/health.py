@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from mautrix_iot.configuration import CONF
+from mautrix_iot.db.operations import get_device_health, update_device_health
+from mautrix_iot.device_api import ping_device
+from mautrix_iot.dispatcher import dispatcher
+from mautrix_iot.routing import DeviceRecord, routing_index
+
+logger = logging.getLogger(__name__)
+
+ONLINE = "online"
+OFFLINE = "offline"
+
+
+class HealthMonitor:
+    """Pings every registered device in the background.
+
+    Each round probes all devices, at most ``concurrency`` at a time, with
+    start times spread over ``jitter`` seconds so devices aren't hit all at
+    once. Results are saved on the entity, and the device's room is told
+    whenever a device goes offline or comes back.
+    """
+
+    def __init__(self, interval: float, jitter: float, concurrency: int):
+        self.interval = interval
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self._status: Dict[int, Optional[str]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._saving: Optional[asyncio.Future] = None
+
+        self.rounds = 0
+        self.probes = 0
+
+    @property
+    def online(self) -> int:
+        return sum(1 for status in self._status.values() if status == ONLINE)
+
+    @property
+    def offline(self) -> int:
+        return sum(1 for status in self._status.values() if status == OFFLINE)
+
+    async def start(self) -> None:
+        if self.interval <= 0:
+            return
+
+        self._status = {row.id: row.health_status for row in await get_device_health()}
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        # Pings are dropped on shutdown, but a started write is let through
+        if self._saving is not None:
+            await asyncio.gather(self._saving, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            started = time.monotonic()
+
+            try:
+                await self.probe_all()
+            except Exception:
+                logger.exception("Device health check failed")
+
+            await asyncio.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+    async def probe_all(self) -> None:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        devices = [device for device in routing_index.devices() if device.host]
+
+        results = await asyncio.gather(
+            *(self._probe(device, semaphore) for device in devices)
+        )
+        self._saving = asyncio.ensure_future(update_device_health(results))
+        await asyncio.shield(self._saving)
+
+        self.rounds += 1
+        self.probes += len(results)
+
+    async def _probe(
+        self, device: DeviceRecord, semaphore: asyncio.Semaphore
+    ) -> Dict[str, Any]:
+        await asyncio.sleep(random.uniform(0, self.jitter))
+
+        async with semaphore:
+            start = time.perf_counter()
+            response = await ping_device(device.host)
+            latency_ms = int((time.perf_counter() - start) * 1000)
+
+        if response["error"]["code"] == "OK":
+            result = {
+                "id": device.id,
+                "health_status": ONLINE,
+                "last_seen": datetime.utcnow(),
+                "last_latency_ms": latency_ms,
+            }
+        else:
+            result = {"id": device.id, "health_status": OFFLINE}
+
+        self._record(device, result["health_status"], response["error"]["message"])
+        return result
+
+    def _record(self, device: DeviceRecord, status: str, reason: str) -> None:
+        previous = self._status.get(device.id)
+        self._status[device.id] = status
+
+        # A newly registered device coming up isn't worth a message
+        if previous == status or (previous is None and status == ONLINE):
+            return
+
+        logger.info("Device %s is %s", device.name, status)
+
+        if device.room_id is None:
+            return
+
+        if status == ONLINE:
+            message = "✅ Device is back online."
+        else:
+            message = f"⚠️ Device is offline: {reason or 'no answer to ping'}"
+
+        dispatcher.send(
+            body=message,
+            room_id=device.room_id,
+            sender=device.matrix_id,
+            access_token=device.access_token,
+        )
+
+
+health_monitor = HealthMonitor(
+    interval=CONF.get("devices", {}).get("health_interval", 60),
+    jitter=CONF.get("devices", {}).get("health_jitter", 10),
+    concurrency=CONF.get("devices", {}).get("health_concurrency", 20),
+)
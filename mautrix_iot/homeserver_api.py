@@ -1,39 +1,142 @@
-from typing import Any, Dict, List, Literal, Optional, Tuple
+import asyncio
+import logging
+from typing import Any, Dict, Literal, Optional, Tuple
 from uuid import uuid4
 
-import requests
+import aiohttp
 
 from mautrix_iot.configuration import CONF
 from mautrix_iot.exceptions import RateLimitedError
+from mautrix_iot.metrics import HOMESERVER_REQUEST_TIME, homeserver_endpoint_label
+from mautrix_iot.ratelimit import RateLimiter
 
 
-def _make_request(
+class HomeserverClient:
+    """Keep-alive connection pool shared by every request to the homeserver."""
+
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Created lazily, the session has to be bound to the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=CONF.homeserver.get("connection_limit", 100),
+                ssl=None if CONF.homeserver.get("verify_ssl", True) else False,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+client = HomeserverClient()
+rate_limiter = RateLimiter(
+    rate=CONF.homeserver.get("requests_per_second", 10),
+    burst=CONF.homeserver.get("request_burst", 20),
+    max_retries=CONF.appservice.get("rate_limit_retry", 5),
+)
+
+logger = logging.getLogger(__name__)
+
+# Repeating these has no further effect, PUTs carry their transaction ID
+_IDEMPOTENT_METHODS = {"get", "head", "put", "delete"}
+
+
+def _retry_after(
+    response: aiohttp.ClientResponse, content: Dict[str, Any]
+) -> Optional[float]:
+    if "retry_after_ms" in content:
+        return content["retry_after_ms"] / 1000
+
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+async def _make_request(
     endpoint: str,
     method: Literal["get", "head", "post", "put", "patch", "delete"],
     payload: Optional[Dict[str, Any]] = None,
     version: str = "v3",
     access_token: Optional[str] = None,
-) -> requests.Response:
-    response = getattr(requests, method)(
-        f"{CONF.homeserver['address']}/_matrix/client/{version}/{endpoint}",
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {access_token or CONF.appservice['as_token']}",
-        },
-        json=payload or {},
-    )
-
-    if response.status_code == 429:
-        raise RateLimitedError()
-
-    return response
+) -> Tuple[int, Dict[str, Any]]:
+    with HOMESERVER_REQUEST_TIME.labels(
+        homeserver_endpoint_label(endpoint), method
+    ).time():
+        return await _request_with_retries(
+            endpoint, method, payload, version, access_token
+        )
 
 
-def send_message(
+async def _request_with_retries(
+    endpoint: str,
+    method: str,
+    payload: Optional[Dict[str, Any]],
+    version: str,
+    access_token: Optional[str],
+) -> Tuple[int, Dict[str, Any]]:
+    token = access_token or CONF.appservice["as_token"]
+    retries = CONF.homeserver.get("http_retry_count", 4)
+    attempt = 0
+    rate_limited = 0
+
+    while True:
+        # Every bridge user has its own budget on the homeserver
+        await rate_limiter.acquire(token)
+
+        try:
+            async with client.session.request(
+                method.upper(),
+                f"{CONF.homeserver['address']}/_matrix/client/{version}/{endpoint}",
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {token}",
+                },
+                json=payload or {},
+            ) as response:
+                try:
+                    content = await response.json(content_type=None) or {}
+                except ValueError:
+                    content = {}
+
+                if response.status != 429:
+                    return (response.status, content)
+
+                retry_after = _retry_after(response, content)
+        except aiohttp.ClientConnectionError as error:
+            # A POST may have been acted on before the connection dropped,
+            # it's only sent again if it never reached the homeserver
+            sent = not isinstance(error, aiohttp.ClientConnectorError)
+            if attempt >= retries or (sent and method not in _IDEMPOTENT_METHODS):
+                raise
+
+            # Homeserver isn't reachable, back off before trying again
+            attempt += 1
+            await asyncio.sleep(min(2**attempt, 30))
+            continue
+
+        # Only this request is repeated, with the same payload and txnId
+        if rate_limited >= rate_limiter.max_retries:
+            raise RateLimitedError()
+
+        await rate_limiter.wait_before_retry(rate_limited, retry_after)
+        rate_limited += 1
+
+
+async def send_message(
     body: str,
     room_id: str,
     sender: str,
     formatted_body: Optional[str] = None,
+    txn_id: Optional[str] = None,
+    reply_to: Optional[str] = None,
     **kwargs,
 ) -> Tuple[int, Dict[str, Any]]:
     formatted_params = {}
@@ -42,9 +145,11 @@ def send_message(
             "format": "org.matrix.custom.html",
             "formatted_body": formatted_body,
         }
+    if reply_to is not None:
+        formatted_params["m.relates_to"] = {"m.in_reply_to": {"event_id": reply_to}}
 
-    response = _make_request(
-        endpoint=f"rooms/{room_id}/send/m.room.message/{uuid4()}",
+    status_code, response = await _make_request(
+        endpoint=f"rooms/{room_id}/send/m.room.message/{txn_id or uuid4()}",
         method="put",
         payload={
             "msgtype": "m.text",
@@ -54,13 +159,13 @@ def send_message(
         **kwargs,
     )
 
-    print(response)
+    logger.debug("Sent message to %s: %s %s", room_id, status_code, response)
 
-    return (response.status_code, response.json())
+    return (status_code, response)
 
 
-def create_room(name: str, room_peer: str, is_direct: bool = True, **kwargs):
-    response = _make_request(
+async def create_room(name: str, room_peer: str, is_direct: bool = True, **kwargs):
+    return await _make_request(
         endpoint="createRoom",
         method="post",
         payload={
@@ -72,11 +177,9 @@ def create_room(name: str, room_peer: str, is_direct: bool = True, **kwargs):
         **kwargs,
     )
 
-    return (response.status_code, response.json())
-
 
-def register_user(username: str, **kwargs) -> Tuple[int, Dict[str, Any]]:
-    response = _make_request(
+async def register_user(username: str, **kwargs) -> Tuple[int, Dict[str, Any]]:
+    return await _make_request(
         endpoint="register",
         method="post",
         payload={
@@ -86,24 +189,31 @@ def register_user(username: str, **kwargs) -> Tuple[int, Dict[str, Any]]:
         **kwargs,
     )
 
-    return (response.status_code, response.json())
 
+async def login_user(username: str, **kwargs) -> Tuple[int, Dict[str, Any]]:
+    """Get a new access token for a user the appservice registered earlier."""
+    return await _make_request(
+        endpoint="login",
+        method="post",
+        payload={
+            "type": "m.login.application_service",
+            "identifier": {"type": "m.id.user", "user": username},
+        },
+        **kwargs,
+    )
 
-def join_room(room_id: str, **kwargs) -> Tuple[int, Dict[str, Any]]:
-    response = _make_request(
+
+async def join_room(room_id: str, **kwargs) -> Tuple[int, Dict[str, Any]]:
+    return await _make_request(
         f"rooms/{room_id}/join",
         "post",
         **kwargs,
     )
 
-    return (response.status_code, response.json())
-
 
-def leave_room(room_id: str, **kwargs) -> Tuple[int, Dict[str, Any]]:
-    response = _make_request(
+async def leave_room(room_id: str, **kwargs) -> Tuple[int, Dict[str, Any]]:
+    return await _make_request(
         f"rooms/{room_id}/leave",
         "post",
         **kwargs,
     )
-
-    return (response.status_code, response.json())
@@ -0,0 +1,125 @@
+import asyncio
+import html
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, List
+
+from mautrix_iot.configuration import CONF
+from mautrix_iot.dispatcher import dispatcher
+from mautrix_iot.ratelimit import TokenBucket
+from mautrix_iot.routing import DeviceRecord
+from mautrix_iot.utils import split_message
+
+logger = logging.getLogger(__name__)
+
+
+def format_event(event: Dict[str, Any]) -> str:
+    """One line of a telemetry message. Everything the device sent is escaped."""
+    line = f"<strong>{html.escape(str(event.get('type', 'event')))}</strong>"
+
+    if event.get("message"):
+        line += f" {html.escape(str(event['message']))}"
+
+    data = event.get("data") or {}
+    if isinstance(data, dict) and data:
+        line += " " + ", ".join(
+            f"{html.escape(str(key))}=<code>{html.escape(str(value))}</code>"
+            for key, value in data.items()
+        )
+
+    return line + "<br>"
+
+
+class IngestBuffer:
+    """Posts events pushed by devices to their rooms, in batches.
+
+    Each device has a token bucket for its requests. Accepted events wait
+    ``batch_window`` seconds so a burst turns into a single message, sent
+    as the device itself. At most ``max_pending`` events are held per
+    device, the oldest are dropped beyond that.
+    """
+
+    def __init__(self, rate: float, burst: float, batch_window: float, max_pending: int):
+        self.rate = rate
+        self.burst = burst
+        self.batch_window = batch_window
+        self.max_pending = max_pending
+
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._pending: Dict[int, Deque[str]] = {}
+        self._devices: Dict[int, DeviceRecord] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+        self.accepted = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.batches = 0
+
+    @property
+    def depth(self) -> int:
+        return sum(len(pending) for pending in self._pending.values())
+
+    def allow(self, device: DeviceRecord) -> bool:
+        bucket = self._buckets.setdefault(device.id, TokenBucket(self.rate, self.burst))
+
+        if bucket.try_acquire():
+            return True
+
+        self.rejected += 1
+        return False
+
+    def add(self, device: DeviceRecord, events: List[Dict[str, Any]]) -> None:
+        pending = self._pending.setdefault(device.id, deque(maxlen=self.max_pending))
+
+        self.dropped += max(0, len(pending) + len(events) - self.max_pending)
+        self.accepted += len(events)
+        pending.extend(format_event(event) for event in events)
+        self._devices[device.id] = device
+
+        if device.id not in self._tasks:
+            self._tasks[device.id] = asyncio.create_task(self._flush_later(device))
+
+    async def _flush_later(self, device: DeviceRecord) -> None:
+        await asyncio.sleep(self.batch_window)
+        self._flush(device)
+
+    def _flush(self, device: DeviceRecord) -> None:
+        self._tasks.pop(device.id, None)
+        self._devices.pop(device.id, None)
+        pending = self._pending.pop(device.id, None)
+
+        if not pending:
+            return
+
+        if device.room_id is None:
+            logger.warning("Dropping events from %s, it has no room", device.name)
+            self.dropped += len(pending)
+            return
+
+        for message in split_message(list(pending), dispatcher.max_text_size):
+            dispatcher.send(
+                body=message,
+                formatted_body=message,
+                room_id=device.room_id,
+                sender=device.matrix_id,
+                access_token=device.access_token,
+            )
+            self.batches += 1
+
+    async def close(self) -> None:
+        """Send whatever is still waiting, without waiting for the window."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for device in list(self._devices.values()):
+            self._flush(device)
+
+
+ingest_buffer = IngestBuffer(
+    rate=CONF.get("ingest", {}).get("requests_per_second", 1),
+    burst=CONF.get("ingest", {}).get("request_burst", 10),
+    batch_window=CONF.get("ingest", {}).get("batch_window", 5),
+    max_pending=CONF.get("ingest", {}).get("max_pending_events", 500),
+)
@@ -0,0 +1,251 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set
+from uuid import uuid4
+
+import aiohttp
+
+from mautrix_iot.configuration import CONF
+from mautrix_iot.consts import JOB_FINISHED_MESSAGE
+from mautrix_iot.db.models import Job
+from mautrix_iot.db.operations import (
+    create_job,
+    fail_interrupted_jobs,
+    finish_job,
+    get_running_device_jobs,
+    set_device_job_id,
+)
+from mautrix_iot.device_api import client, get_job_status, send_command
+from mautrix_iot.dispatcher import dispatcher
+from mautrix_iot.routing import DeviceRecord, routing_index
+from mautrix_iot.utils import instance_url
+
+logger = logging.getLogger(__name__)
+
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+TIMED_OUT = "timed_out"
+
+# Job states as reported by devices
+_DEVICE_STATUSES = {"done": SUCCEEDED, "failed": FAILED}
+
+
+class JobManager:
+    """Tracks device commands that finish after the message that started them.
+
+    Jobs running on a device are polled every ``poll_interval`` seconds, at
+    most ``poll_concurrency`` at a time, unless the device reports back
+    first. Commands can also be run in the background on the bridge. Either
+    way, the original message is answered once the job is done, and jobs
+    still running after ``timeout`` seconds are given up on.
+
+    Background commands belong to the instance running them. Polling is
+    started separately, in a cluster only one instance does it.
+    """
+
+    def __init__(self, poll_interval: float, poll_concurrency: int, timeout: float):
+        self.poll_interval = poll_interval
+        self.poll_concurrency = poll_concurrency
+        self.timeout = timeout
+        self._background: Set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+
+        self.started = 0
+        self.finished = 0
+
+    @property
+    def background(self) -> int:
+        return len(self._background)
+
+    async def start(self) -> None:
+        await self.recover(instance_url())
+
+    async def recover(self, instance: Optional[str]) -> None:
+        """Fail the background commands of an instance that stopped while running them."""
+        for job in await fail_interrupted_jobs(
+            "The bridge restarted while the job was running", instance
+        ):
+            self._reply(job, FAILED, job.result)
+
+    async def start_polling(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._poll_forever())
+
+    async def stop_polling(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def stop(self) -> None:
+        await self.stop_polling()
+
+        tasks = list(self._background)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def track(
+        self,
+        device: DeviceRecord,
+        device_job_id: str,
+        command: str,
+        args: List[str],
+        room_id: str,
+        event_id: Optional[str],
+    ) -> Job:
+        """Follow a job the device accepted to run on its own."""
+        self.started += 1
+        return await create_job(
+            Job(
+                id=uuid4().hex[:10],
+                entity_id=device.id,
+                device_job_id=device_job_id,
+                command=command,
+                args=args,
+                room_id=room_id,
+                event_id=event_id,
+                status=RUNNING,
+            )
+        )
+
+    async def run_in_background(
+        self,
+        device: DeviceRecord,
+        command: str,
+        args: List[str],
+        room_id: str,
+        event_id: Optional[str],
+    ) -> Job:
+        """Send a command without holding up the room until the device answers."""
+        job = await create_job(
+            Job(
+                id=uuid4().hex[:10],
+                entity_id=device.id,
+                command=command,
+                args=args,
+                room_id=room_id,
+                event_id=event_id,
+                status=RUNNING,
+                instance=instance_url(),
+            )
+        )
+        self.started += 1
+
+        task = asyncio.create_task(self._run(job, device))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+        return job
+
+    async def _run(self, job: Job, device: DeviceRecord) -> None:
+        # The device may only answer once the command is done, well past the usual read timeout
+        timeout = aiohttp.ClientTimeout(sock_connect=client.connect_timeout, sock_read=self.timeout)
+
+        try:
+            response = await asyncio.wait_for(
+                send_command(device.host, job.command, job.args, timeout), self.timeout
+            )
+        except asyncio.TimeoutError:
+            await self.finish(job, TIMED_OUT, None, device)
+            return
+
+        if response["error"]["code"] == "TIMEOUT":
+            await self.finish(job, TIMED_OUT, None, device)
+        elif response["error"]["code"] == "ACCEPTED":
+            # The device runs it as a job of its own, polling takes over from here
+            await set_device_job_id(job.id, response["response"])
+        elif response["error"]["code"] == "OK":
+            await self.finish(job, SUCCEEDED, response["response"], device)
+        else:
+            await self.finish(job, FAILED, response["error"]["message"], device)
+
+    async def report(self, job: Job, payload: Dict[str, Any]) -> bool:
+        """Status pushed by the device for one of its jobs."""
+        status = _DEVICE_STATUSES.get(payload.get("status"))
+        if status is None:
+            return False
+
+        await self.finish(job, status, _result_text(payload.get("result")))
+        return True
+
+    async def finish(
+        self,
+        job: Job,
+        status: str,
+        result: Optional[str],
+        device: Optional[DeviceRecord] = None,
+    ) -> None:
+        # Polling and the device's own report can race, only the first counts
+        if not await finish_job(job.id, status, result):
+            return
+
+        self.finished += 1
+        self._reply(job, status, result, device)
+
+    def _reply(
+        self,
+        job: Job,
+        status: str,
+        result: Optional[str],
+        device: Optional[DeviceRecord] = None,
+    ) -> None:
+        if device is None and job.entity is not None:
+            device = routing_index.for_matrix_id(job.entity.matrix_id)
+        if device is None:
+            return
+
+        message = JOB_FINISHED_MESSAGE(job.id, job.command, status, result)
+        dispatcher.send(
+            body=message,
+            formatted_body=message,
+            room_id=job.room_id,
+            sender=device.matrix_id,
+            access_token=device.access_token,
+            reply_to=job.event_id,
+        )
+
+    async def _poll_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+
+            try:
+                await self.poll()
+            except Exception:
+                logger.exception("Polling device jobs failed")
+
+    async def poll(self) -> None:
+        semaphore = asyncio.Semaphore(self.poll_concurrency)
+        jobs = await get_running_device_jobs()
+
+        await asyncio.gather(*(self._poll(job, semaphore) for job in jobs))
+
+    async def _poll(self, job: Job, semaphore: asyncio.Semaphore) -> None:
+        if datetime.utcnow() - job.created_at > timedelta(seconds=self.timeout):
+            await self.finish(job, TIMED_OUT, None)
+            return
+
+        async with semaphore:
+            response = await get_job_status(job.entity.host, job.device_job_id)
+
+        # Unreachable devices are asked again on the next round
+        if response["error"]["code"] != "OK":
+            return
+
+        await self.report(job, response["response"])
+
+
+def _result_text(result: Any) -> Optional[str]:
+    if result is None or isinstance(result, str):
+        return result
+
+    return str(result)
+
+
+job_manager = JobManager(
+    poll_interval=CONF.get("jobs", {}).get("poll_interval", 10),
+    poll_concurrency=CONF.get("jobs", {}).get("poll_concurrency", 10),
+    timeout=CONF.get("jobs", {}).get("timeout", 3600),
+)
@@ -0,0 +1,133 @@
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import sys
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from mautrix_iot.configuration import CONF
+
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+txn_id: ContextVar[Optional[str]] = ContextVar("txn_id", default=None)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+_TOKEN_PATTERNS = [
+    re.compile(r"(Bearer\s+)[^\s'\"]+", re.IGNORECASE),
+    re.compile(r"""(["']?(?:access_token|as_token|hs_token)["']?\s*[:=]\s*["']?)[^\s'",}]+"""),
+]
+
+
+class ContextFilter(logging.Filter):
+    """Adds the request and transaction IDs, and hides tokens in the message.
+
+    Attached to the queue handler, so context variables and message arguments
+    are resolved by the code that logs, before the record changes threads.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.secrets = [
+            CONF.appservice[key]
+            for key in ("as_token", "hs_token")
+            if CONF.appservice.get(key)
+        ]
+
+    def redact(self, message: str) -> str:
+        for secret in self.secrets:
+            message = message.replace(secret, "<redacted>")
+        for pattern in _TOKEN_PATTERNS:
+            message = pattern.sub(r"\1<redacted>", message)
+        return message
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        record.txn_id = txn_id.get()
+
+        record.msg = self.redact(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.redact(
+                logging.Formatter().formatException(record.exc_info)
+            )
+            record.exc_info = None
+
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # ContextFilter already resolved the message, keep the exception apart
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        for key in ("request_id", "txn_id"):
+            if getattr(record, key, None):
+                entry[key] = getattr(record, key)
+
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(name)s] %(context)s%(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        context = " ".join(
+            f"{key}={getattr(record, key)}"
+            for key in ("request_id", "txn_id")
+            if getattr(record, key, None)
+        )
+        record.context = f"({context}) " if context else ""
+        return super().format(record)
+
+
+def setup_logging() -> None:
+    """Send all records through a queue, written out by a background thread."""
+    global _listener
+
+    conf = CONF.get("logging", {})
+
+    output: logging.Handler = logging.StreamHandler(sys.stderr)
+    if conf.get("file"):
+        output = logging.handlers.WatchedFileHandler(conf["file"])
+    output.setFormatter(
+        TextFormatter() if conf.get("format", "json") == "text" else JSONFormatter()
+    )
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(conf.get("level", "INFO"))
+
+    for name, level in (conf.get("levels") or {}).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,15 +1,62 @@
-from fastapi import FastAPI, Request
+from contextlib import asynccontextmanager
+from uuid import uuid4
+
+from fastapi import Depends, FastAPI, Request
 from fastapi.responses import JSONResponse
 
-from mautrix_iot.db import models
-from mautrix_iot.db.database import _initial_db_population, engine
+from mautrix_iot import device_api, homeserver_api, log
+from mautrix_iot.cluster import cluster
+from mautrix_iot.configuration import CONF
+from mautrix_iot.dispatcher import dispatcher
+from mautrix_iot.db.database import _initial_db_population, engine, upgrade_database
+from mautrix_iot.dependencies import check_authorization_header
 from mautrix_iot.exceptions import MatrixError
-from mautrix_iot.routers import api
+from mautrix_iot.ingest import ingest_buffer
+from mautrix_iot.jobs import job_manager
+from mautrix_iot.provisioning import device_importer
+from mautrix_iot.routers import api, cluster as cluster_router, ingest, metrics
+from mautrix_iot.routing import routing_index
+from mautrix_iot.sessions import flow_sessions
+from mautrix_iot.telemetry import telemetry_store
+from mautrix_iot.transactions import transaction_store
+
+
+log.setup_logging()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await upgrade_database()
+    await _initial_db_population()
+    await routing_index.load()
+    await transaction_store.prune()
+    await flow_sessions.prune()
+
+    await api.work_queue.start()
+    await telemetry_store.start()
+    await job_manager.start()
+    await cluster.start()
+    yield
+    await cluster.stop()
+    await api.work_queue.stop(CONF.appservice.get("shutdown_timeout", 30))
+    await job_manager.stop()
+    await device_importer.stop()
+    await ingest_buffer.close()
+    await telemetry_store.stop()
+    await dispatcher.close(CONF.appservice.get("shutdown_timeout", 30))
+    await device_api.client.close()
+    await homeserver_api.client.close()
+    await engine.dispose()
+    log.stop_logging()
 
-models.Base.metadata.create_all(bind=engine)
-_initial_db_population()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def correlate_request(request: Request, call_next):
+    log.request_id.set(uuid4().hex[:12])
+    return await call_next(request)
 
 
 @app.exception_handler(MatrixError)
@@ -21,3 +68,19 @@ async def matrix_exception_handler(request: Request, exc: MatrixError):
 
 
 app.include_router(api.router)
+
+if cluster.enabled:
+    app.include_router(cluster_router.router)
+
+if CONF.get("ingest", {}).get("enabled", True):
+    app.include_router(ingest.router)
+
+if CONF.get("metrics", {}).get("enabled", True):
+    app.include_router(
+        metrics.router,
+        dependencies=(
+            [Depends(check_authorization_header)]
+            if CONF.get("metrics", {}).get("require_token", True)
+            else []
+        ),
+    )
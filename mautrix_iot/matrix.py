@@ -1,49 +1,97 @@
-from typing import Any, Dict
-
-import requests
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Union
 
+from mautrix_iot.catalog import command_catalogs
 from mautrix_iot.configuration import CONF
 from mautrix_iot.consts import (
     BRIDGE_USERS_PREFIX,
-    HELP_MESSAGE,
+    CANCELLED_MESSAGE,
+    DEVICE_ROOM_HELP_MESSAGE,
+    JOB_STARTED_MESSAGE,
+    STATS_MESSAGE_FORMAT,
     UNKNOWN_COMMAND_MESSAGE,
     MatrixEventType,
 )
-from mautrix_iot.db.database import get_bot_entity, get_entity_for_room
-from mautrix_iot.db.models import Entity
-from mautrix_iot.db.operations import delete_bot_room, get_bot_entity, update_bot_room
-from mautrix_iot.device_api import get_available_device_commands, send_command
+from mautrix_iot.db.operations import delete_bot_room, update_bot_room
+from mautrix_iot.device_api import send_command
 from mautrix_iot.exceptions import BadJsonError
-from mautrix_iot.flows import COMMANDS, BasicFlow
-from mautrix_iot.homeserver_api import create_room, join_room, leave_room, send_message
-from mautrix_iot.utils import bot_full_name, format_commands, retry_rate_limited
+from mautrix_iot.flows import COMMANDS
+from mautrix_iot.dispatcher import dispatcher
+from mautrix_iot.homeserver_api import join_room, leave_room
+from mautrix_iot.cluster import cluster
+from mautrix_iot.jobs import job_manager
+from mautrix_iot.membership import unknown_rooms
+from mautrix_iot.metrics import EVENTS, TRANSACTION_TIME
+from mautrix_iot.routing import DeviceRecord, routing_index
+from mautrix_iot.sessions import flow_sessions
+from mautrix_iot.telemetry import parse_range, telemetry_store
+from mautrix_iot.utils import (
+    KeyedLock,
+    bot_full_name,
+    format_commands,
+)
+
+logger = logging.getLogger(__name__)
 
 
 class EventHandler:
     def __init__(self):
-        self.flow: BasicFlow = None
+        self._room_locks = KeyedLock()
 
-    def determine_and_handle_event(self, request):
+    async def determine_and_handle_event(self, request):
         events = request.get("events", [])
         if len(events) == 0:
             return
 
-        latest_event = events[0]
+        with TRANSACTION_TIME.time():
+            await self._handle_events(events)
+
+    async def _handle_events(self, events: List[Dict[str, Any]]):
+        # Events of the same room keep their order, rooms are handled concurrently
+        events_by_room: Dict[Optional[str], List[Dict[str, Any]]] = {}
+        for event in events:
+            EVENTS.labels(event.get("type", "unknown")).inc()
+            events_by_room.setdefault(event.get("room_id"), []).append(event)
+
+        await asyncio.gather(
+            *(
+                self._handle_room_events(room_id, room_events)
+                for room_id, room_events in events_by_room.items()
+            )
+        )
 
-        if "type" not in latest_event:
+    async def _handle_room_events(
+        self, room_id: Optional[str], events: List[Dict[str, Any]]
+    ):
+        # The lock also orders this room's events across transactions
+        async with self._room_locks(room_id):
+            for event in events:
+                try:
+                    await self._handle_event(event)
+                except Exception:
+                    logger.exception(
+                        "Failed to handle event %s in %s", event.get("event_id"), room_id
+                    )
+
+    async def _handle_event(self, event: Dict[str, Any]):
+        if "type" not in event:
             return
 
-        if latest_event["type"] == MatrixEventType.ROOM.value:
-            if latest_event.get("content", {}).get("membership") == "invite":
-                self._handle_bot_invite(latest_event)
-            elif latest_event.get("content", {}).get("membership") == "leave":
-                self._handle_room_leave(latest_event)
+        if event["type"] == MatrixEventType.ROOM.value:
+            # Whatever changed, joining the room may work (or fail) differently now
+            if "room_id" in event:
+                unknown_rooms.forget(event["room_id"])
+
+            if event.get("content", {}).get("membership") == "invite":
+                await self._handle_bot_invite(event)
+            elif event.get("content", {}).get("membership") == "leave":
+                await self._handle_room_leave(event)
 
-        elif latest_event["type"] == MatrixEventType.MESSAGE.value:
-            self._handle_message(latest_event)
+        elif event["type"] == MatrixEventType.MESSAGE.value:
+            await self._handle_message(event)
 
-    @retry_rate_limited
-    def _handle_message(self, event):
+    async def _handle_message(self, event):
         if "room_id" not in event:
             raise BadJsonError()
 
@@ -53,77 +101,116 @@ class EventHandler:
 
         room_id = event["room_id"]
 
-        device = get_entity_for_room(room_id)
+        device = routing_index.for_room(room_id)
 
         # No bot registered with this room
+        if device is None:
+            # Joining failed recently, don't ask the homeserver on every message
+            if room_id in unknown_rooms:
+                return
+
+            # Another instance may have registered it
+            if cluster.enabled:
+                device = await routing_index.load_room(room_id)
+
         if device is None:
             # Try to see if management bot is invited
-            status_code, _ = join_room(room_id)
+            status_code, _ = await join_room(room_id)
 
             # If this succeeded, then this is the new management room
             if status_code == 200:
-                update_bot_room(room_id, bot_full_name())
-                device = get_bot_entity()
+                await update_bot_room(room_id, bot_full_name(), event.get("sender"))
+                routing_index.set_room(bot_full_name(), room_id)
+                device = routing_index.bot
             # Do not know with whom to respond, abort
             else:
+                unknown_rooms.remember(room_id)
                 return
 
         # Management command
         if not device.is_device:
-            self._handle_message_with_bot(event, device, room_id)
+            await self._handle_message_with_bot(event, device, room_id)
         else:
-            self._handle_message_with_device(event, device, room_id)
+            await self._handle_message_with_device(event, device, room_id)
 
-    @retry_rate_limited
-    def _handle_message_with_bot(
-        self, event: Dict[str, Any], bot: Entity, room_id: str
+    async def _handle_message_with_bot(
+        self, event: Dict[str, Any], bot: DeviceRecord, room_id: str
     ):
         message = event["content"]["body"]
         command, *args = message.split()
 
+        sender = event["sender"]
+
         if command in COMMANDS:
-            self.flow = COMMANDS[command](room_id, event["sender"], args)
-            send_message(
-                body=self.flow.prompt,
-                formatted_body=self.flow.prompt,
+            flow = COMMANDS[command](room_id, sender, args)
+            prompt = await flow.prompt()
+            await flow_sessions.save(room_id, sender, flow)
+
+            self._send_prompt(prompt, room_id, bot)
+        elif command == "cancel":
+            await flow_sessions.discard(room_id, sender)
+            dispatcher.send(
+                body=CANCELLED_MESSAGE,
+                formatted_body=CANCELLED_MESSAGE,
                 room_id=room_id,
                 sender=bot.matrix_id,
             )
-        elif self.flow and not self.flow.done:
-            validated, reason = self.flow.send(message)
-            print(reason)
+        elif flow := await flow_sessions.get(room_id, sender):
+            validated, reason = await flow.send(message)
+            await flow_sessions.save(room_id, sender, flow)
 
             if reason:
-                send_message(
+                dispatcher.send(
                     body=reason,
                     formatted_body=reason,
                     room_id=room_id,
                     sender=bot.matrix_id,
                 )
 
-            if not self.flow.done:
-                send_message(
-                    body=self.flow.prompt,
-                    formatted_body=self.flow.prompt,
-                    room_id=room_id,
-                    sender=bot.matrix_id,
-                )
+            if not flow.done:
+                self._send_prompt(await flow.prompt(), room_id, bot)
         else:
-            send_message(
+            dispatcher.send(
                 UNKNOWN_COMMAND_MESSAGE,
                 formatted_body=UNKNOWN_COMMAND_MESSAGE,
                 room_id=room_id,
                 sender=bot.matrix_id,
             )
 
-    @retry_rate_limited
-    def _handle_message_with_device(
-        self, event: Dict[str, Any], device: Entity, room_id: str
+    def _send_prompt(
+        self, prompt: Union[str, List[str]], room_id: str, bot: DeviceRecord
+    ) -> None:
+        for message in [prompt] if isinstance(prompt, str) else prompt:
+            dispatcher.send(
+                body=message,
+                formatted_body=message,
+                room_id=room_id,
+                sender=bot.matrix_id,
+            )
+
+    async def _handle_message_with_device(
+        self, event: Dict[str, Any], device: DeviceRecord, room_id: str
     ):
-        response = get_available_device_commands(device)
+        message = event["content"]["body"]
+        command, *args = message.split()
+
+        catalog = await command_catalogs.get(device)
 
-        if response["error"]["code"] != "OK":
-            send_message(
+        # Answered by the bridge, even while the device is down, unless the
+        # device has a stats command of its own
+        if command == "stats" and (catalog is None or command not in catalog):
+            reply = await self._device_stats(device, args)
+            dispatcher.send(
+                body=reply,
+                formatted_body=reply,
+                room_id=room_id,
+                sender=device.matrix_id,
+                access_token=device.access_token,
+            )
+            return
+
+        if catalog is None:
+            dispatcher.send(
                 body="Could not retrieve commands from device.",
                 formatted_body="Could not retrieve commands from device.",
                 room_id=room_id,
@@ -132,29 +219,44 @@ class EventHandler:
             )
             return
 
-        message = event["content"]["body"]
-        command, *args = message.split()
-        available_commands = response["response"]
-
         if command == "help":
-            send_message(
-                body=format_commands(available_commands),
-                formatted_body=format_commands(available_commands),
+            dispatcher.send(
+                body=format_commands(catalog.list()) + DEVICE_ROOM_HELP_MESSAGE,
+                formatted_body=format_commands(catalog.list()) + DEVICE_ROOM_HELP_MESSAGE,
+                room_id=room_id,
+                sender=device.matrix_id,
+                access_token=device.access_token,
+            )
+
+        elif command == "bg" and len(args) > 0 and args[0] in catalog:
+            job = await job_manager.run_in_background(
+                device, args[0], args[1:], room_id, event.get("event_id")
+            )
+
+            dispatcher.send(
+                body=JOB_STARTED_MESSAGE(job.id, job.command),
+                formatted_body=JOB_STARTED_MESSAGE(job.id, job.command),
                 room_id=room_id,
                 sender=device.matrix_id,
                 access_token=device.access_token,
+                reply_to=event.get("event_id"),
             )
 
-        elif command in (comm["name"] for comm in available_commands):
+        elif command in catalog:
             # self.flow = COMMANDS[command](room_id, event["sender"], args)
-            response = send_command(device, command, args)
+            response = await send_command(device.host, command, args)
 
-            if response["error"]["code"] != "OK":
+            if response["error"]["code"] == "ACCEPTED":
+                job = await job_manager.track(
+                    device, response["response"], command, args, room_id, event.get("event_id")
+                )
+                body = JOB_STARTED_MESSAGE(job.id, command)
+            elif response["error"]["code"] != "OK":
                 body = response["error"]["message"]
             else:
                 body = response["response"]
 
-            send_message(
+            dispatcher.send(
                 body=body,
                 formatted_body=body,
                 room_id=room_id,
@@ -162,7 +264,7 @@ class EventHandler:
                 access_token=device.access_token,
             )
         else:
-            send_message(
+            dispatcher.send(
                 UNKNOWN_COMMAND_MESSAGE,
                 formatted_body=UNKNOWN_COMMAND_MESSAGE,
                 room_id=room_id,
@@ -170,8 +272,26 @@ class EventHandler:
                 access_token=device.access_token,
             )
 
-    @retry_rate_limited
-    def _handle_bot_invite(self, event):
+    async def _device_stats(self, device: DeviceRecord, args: List[str]) -> str:
+        if len(args) == 0:
+            metrics = await telemetry_store.metrics(device.id)
+            if len(metrics) == 0:
+                return "The device has not pushed any readings."
+
+            return "Metrics: " + ", ".join(f"<strong> {metric} </strong>" for metric in metrics)
+
+        metric, period = args[0], args[1] if len(args) > 1 else "24h"
+        seconds = parse_range(period)
+        if seconds is None:
+            return "❌  Range must look like <em>30m</em>, <em>24h</em> or <em>7d</em>."
+
+        summary = await telemetry_store.summary(device.id, metric, seconds)
+        if summary is None:
+            return f"No readings of <strong> {metric} </strong> over the last {period}."
+
+        return STATS_MESSAGE_FORMAT(metric, period, summary)
+
+    async def _handle_bot_invite(self, event):
         if "room_id" not in event:
             raise BadJsonError()
 
@@ -180,32 +300,33 @@ class EventHandler:
         if event.get("state_key", "") != bot_full_name():
             return
 
-        status_code, _ = join_room(room_id)
+        status_code, _ = await join_room(room_id)
 
         # Not allowed to join, log this
         if status_code == 403:
-            pass
+            logger.warning("Not allowed to join %s", room_id)
 
-        bot = get_bot_entity()
-        if bot.room:
-            if bot.room.id != room_id:
-                send_message(
+        bot = routing_index.bot
+        if bot.room_id:
+            if bot.room_id != room_id:
+                # Make sure the message is out before leaving the room
+                await dispatcher.send(
                     "You already have private chat portal at "
-                    f"https://matrix.to/#/{bot.room.id}:{CONF.homeserver['domain']}",
+                    f"https://matrix.to/#/{bot.room_id}:{CONF.homeserver['domain']}",
                     formatted_body=(
                         "You already have private chat portal at "
-                        f'<a href="https://matrix.to/#/{bot.room.id}">'
-                        f"{bot.room.id}</a>"
+                        f'<a href="https://matrix.to/#/{bot.room_id}">'
+                        f"{bot.room_id}</a>"
                     ),
                     room_id=room_id,
                     sender=bot_full_name(),
                 )
-                leave_room(room_id)
+                await leave_room(room_id)
         else:
-            update_bot_room(room_id, bot_full_name())
+            await update_bot_room(room_id, bot_full_name(), event.get("sender"))
+            routing_index.set_room(bot_full_name(), room_id)
 
-    @retry_rate_limited
-    def _handle_room_leave(self, event):
+    async def _handle_room_leave(self, event):
         if "room_id" not in event:
             raise BadJsonError()
 
@@ -213,6 +334,7 @@ class EventHandler:
         if event.get("user_id", "") == bot_full_name():
             return
 
-        status_code, _ = leave_room(event["room_id"])
+        await leave_room(event["room_id"])
 
-        delete_bot_room()
+        await delete_bot_room()
+        routing_index.set_room(bot_full_name(), None)
@@ -0,0 +1,54 @@
+import time
+from collections import OrderedDict
+
+from mautrix_iot.configuration import CONF
+
+
+class UnknownRoomCache:
+    """Rooms the bot could not join, so messages there don't retry the join.
+
+    Entries expire after ``ttl`` seconds, and at most ``max_size`` rooms
+    are remembered, the oldest are forgotten first. A membership event in a
+    room forgets it right away, since it may have made the room joinable.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._expires: "OrderedDict[str, float]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._expires)
+
+    def __contains__(self, room_id: str) -> bool:
+        expires = self._expires.get(room_id)
+
+        if expires is not None and expires <= time.monotonic():
+            del self._expires[room_id]
+            expires = None
+
+        if expires is None:
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        return True
+
+    def remember(self, room_id: str) -> None:
+        self._expires[room_id] = time.monotonic() + self.ttl
+        self._expires.move_to_end(room_id)
+
+        while len(self._expires) > self.max_size:
+            self._expires.popitem(last=False)
+
+    def forget(self, room_id: str) -> None:
+        self._expires.pop(room_id, None)
+
+
+unknown_rooms = UnknownRoomCache(
+    ttl=CONF.appservice.get("unknown_room_ttl", 300),
+    max_size=CONF.appservice.get("unknown_room_cache_size", 10000),
+)
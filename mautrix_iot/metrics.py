@@ -0,0 +1,96 @@
+import time
+from typing import Callable, Dict, Iterable, Tuple
+
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+TRANSACTION_TIME = Histogram(
+    "mautrix_iot_transaction_processing_seconds",
+    "Time spent handling all events of an appservice transaction",
+)
+EVENTS = Counter(
+    "mautrix_iot_events_total",
+    "Events received from the homeserver",
+    ["type"],
+)
+HOMESERVER_REQUEST_TIME = Histogram(
+    "mautrix_iot_homeserver_request_seconds",
+    "Latency of requests to the homeserver, retries included",
+    ["endpoint", "method"],
+)
+DEVICE_COMMAND_TIME = Histogram(
+    "mautrix_iot_device_command_seconds",
+    "Latency of commands sent to devices",
+    ["device"],
+)
+DEVICE_COMMAND_ERRORS = Counter(
+    "mautrix_iot_device_command_errors_total",
+    "Device commands that did not succeed",
+    ["device", "code"],
+)
+DB_QUERY_TIME = Histogram(
+    "mautrix_iot_db_query_seconds",
+    "Latency of database statements",
+    ["statement"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
+
+def homeserver_endpoint_label(endpoint: str) -> str:
+    """Drop room IDs and txnIds so the label has a bounded set of values."""
+    parts = endpoint.split("/")
+    if parts[0] == "rooms" and len(parts) >= 3:
+        return f"rooms/{parts[2]}"
+    return parts[0]
+
+
+def instrument_engine(engine) -> None:
+    """Time every statement executed through a SQLAlchemy engine."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        DB_QUERY_TIME.labels(statement.split(None, 1)[0].upper()).observe(elapsed)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        # A failed statement never reaches after_cursor_execute
+        if context.execution_context is not None and context.connection is not None:
+            starts = context.connection.info.get("query_start")
+            if starts:
+                starts.pop()
+
+
+class StatsCollector(Collector):
+    """Exposes counters kept by the bridge's own components.
+
+    ``gauges`` and ``counters`` map a metric name to its help text and a
+    callable returning ``{label value: number}`` for the ``source`` label.
+    """
+
+    def __init__(
+        self,
+        gauges: Dict[str, Tuple[str, Callable[[], Dict[str, float]]]],
+        counters: Dict[str, Tuple[str, Callable[[], Dict[str, float]]]],
+    ):
+        self.gauges = gauges
+        self.counters = counters
+
+    def collect(self) -> Iterable:
+        for name, (documentation, values) in self.gauges.items():
+            family = GaugeMetricFamily(name, documentation, labels=["source"])
+            for source, value in values().items():
+                family.add_metric([source], value)
+            yield family
+
+        for name, (documentation, values) in self.counters.items():
+            family = CounterMetricFamily(name, documentation, labels=["source"])
+            for source, value in values().items():
+                family.add_metric([source], value)
+            yield family
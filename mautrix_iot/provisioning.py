@@ -0,0 +1,364 @@
+"""Register many devices at once from a YAML or CSV manifest.
+
+Run it offline, while the bridge is stopped, e.g.:
+
+    python -m mautrix_iot.provisioning devices.yaml --peer @alice:example.com
+
+The bridge picks up the new devices when it starts. From the management
+room, the same import runs with the ``import <file>`` command, for
+manifests in the ``devices.import_directory`` directory.
+"""
+import argparse
+import asyncio
+import csv
+import logging
+import secrets
+import sys
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional
+from uuid import NAMESPACE_URL, uuid5
+
+import yaml
+from validator_collection import checkers
+
+from mautrix_iot import device_api, homeserver_api
+from mautrix_iot.catalog import command_catalogs
+from mautrix_iot.configuration import CONF
+from mautrix_iot.db.database import _initial_db_population, engine, upgrade_database
+from mautrix_iot.db.models import Entity
+from mautrix_iot.db.operations import (
+    add_device_rooms,
+    add_group_members,
+    create_devices,
+    create_group,
+    get_bot_entity,
+    get_devices_by_names,
+    get_entities_by_names,
+    get_group_by_name,
+)
+from mautrix_iot.device_api import get_available_device_commands, ping_device
+from mautrix_iot.dispatcher import dispatcher
+from mautrix_iot.homeserver_api import create_room, login_user, register_user
+from mautrix_iot.routing import DeviceRecord, routing_index
+from mautrix_iot.utils import bot_full_name
+
+logger = logging.getLogger(__name__)
+
+
+class ManifestEntry(NamedTuple):
+    name: str
+    host: str
+    group: Optional[str] = None
+
+
+class ImportResult:
+    def __init__(self, total: int):
+        self.total = total
+        self.registered: List[str] = []
+        self.skipped: List[str] = []
+        self.failed: Dict[str, str] = {}
+
+    @property
+    def done(self) -> int:
+        return len(self.registered) + len(self.skipped) + len(self.failed)
+
+    def summary(self) -> List[str]:
+        lines = [
+            f"Registered {len(self.registered)} of {self.total} devices, "
+            f"{len(self.skipped)} were already registered, {len(self.failed)} failed."
+        ]
+        lines.extend(f"{name}: {reason}" for name, reason in sorted(self.failed.items()))
+
+        return lines
+
+
+def load_manifest(path: str) -> List[ManifestEntry]:
+    """Read the devices to register, a list of name, host and optional group.
+
+    YAML manifests hold a list of mappings, either at the top level or under
+    ``devices``. CSV manifests have a header row naming the columns.
+    """
+    suffix = Path(path).suffix.lower()
+
+    with open(path, newline="") as f:
+        if suffix == ".csv":
+            rows = list(csv.DictReader(f))
+        elif suffix in (".yaml", ".yml"):
+            rows = yaml.safe_load(f) or []
+            if isinstance(rows, dict):
+                rows = rows.get("devices") or []
+        else:
+            raise ValueError("The manifest must be a .yaml, .yml or .csv file")
+
+    if not isinstance(rows, list):
+        raise ValueError("The manifest must be a list of devices")
+
+    entries = []
+    names = set()
+
+    for number, row in enumerate(rows, start=1):
+        if not isinstance(row, dict) or not row.get("name") or not row.get("host"):
+            raise ValueError(f"Device {number} needs a name and a host")
+
+        entry = ManifestEntry(
+            name=str(row["name"]).strip(),
+            host=str(row["host"]).strip(),
+            group=str(row["group"]).strip() if row.get("group") else None,
+        )
+        if entry.name in names:
+            raise ValueError(f"Device {entry.name} is listed twice")
+
+        names.add(entry.name)
+        entries.append(entry)
+
+    return entries
+
+
+def _matrix_username(name: str) -> str:
+    # The same for every run, so a user registered by an interrupted import
+    # is logged in again instead of registered twice
+    domain = CONF.homeserver["domain"]
+    return f"iot_{uuid5(NAMESPACE_URL, f'{domain}/{name}')}"
+
+
+class DeviceImporter:
+    """Registers the devices of a manifest, ``batch_size`` at a time.
+
+    Hosts are checked, Matrix users registered and rooms created at most
+    ``concurrency`` at a time, within the homeserver rate limits. Each batch
+    is committed in a transaction per step, and devices already in the
+    database are picked up where they were left, so an import that stopped
+    halfway can simply be run again.
+    """
+
+    def __init__(self, concurrency: int, batch_size: int):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, entries: List[ManifestEntry], room_id: str, room_peer: str) -> None:
+        """Import in the background, reporting progress to a room."""
+        self._task = asyncio.create_task(self._run_for_room(entries, room_id, room_peer))
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run_for_room(self, entries: List[ManifestEntry], room_id: str, room_peer: str) -> None:
+        def send(message: str) -> None:
+            dispatcher.send(message, formatted_body=message, room_id=room_id, sender=bot_full_name())
+
+        try:
+            result = await self.run(entries, room_peer, send)
+        except Exception:
+            logger.exception("Importing devices failed")
+            send("❌ The import stopped on an error, run it again to continue.")
+            return
+
+        send("<br>".join(result.summary()))
+
+    async def run(
+        self,
+        entries: List[ManifestEntry],
+        room_peer: str,
+        progress: Optional[Callable[[str], None]] = None,
+    ) -> ImportResult:
+        result = ImportResult(len(entries))
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        for start in range(0, len(entries), self.batch_size):
+            await self._import_batch(
+                entries[start:start + self.batch_size], room_peer, semaphore, result
+            )
+
+            if progress is not None and result.done < result.total:
+                progress(f"Imported {result.done} of {result.total} devices...")
+
+        return result
+
+    async def _import_batch(
+        self,
+        entries: List[ManifestEntry],
+        room_peer: str,
+        semaphore: asyncio.Semaphore,
+        result: ImportResult,
+    ) -> None:
+        existing = {entity.name: entity for entity in await get_entities_by_names([e.name for e in entries])}
+        new: List[ManifestEntry] = []
+        without_room: List[Entity] = []
+
+        for entry in entries:
+            entity = existing.get(entry.name)
+
+            if entity is None:
+                new.append(entry)
+            elif not entity.is_device or entity.host != entry.host:
+                result.failed[entry.name] = "Another device with the same name already exists"
+            elif entity.room_id is None:
+                # Registered by an earlier run that stopped before creating its room
+                without_room.append(entity)
+            else:
+                result.skipped.append(entry.name)
+
+        checked = await asyncio.gather(*(self._check(entry, semaphore) for entry in new))
+        valid = []
+        for entry, reason in zip(new, checked):
+            if reason is None:
+                valid.append(entry)
+            else:
+                result.failed[entry.name] = reason
+
+        registered = await asyncio.gather(*(self._register(entry, semaphore) for entry in valid))
+        devices = []
+        for entry, (device, reason) in zip(valid, registered):
+            if device is None:
+                result.failed[entry.name] = reason
+            else:
+                devices.append(device)
+
+        if devices:
+            await create_devices(devices)
+
+        devices.extend(without_room)
+        rooms = await asyncio.gather(*(self._create_room(device, room_peer, semaphore) for device in devices))
+        room_ids = {}
+        for device, (room_id, reason) in zip(devices, rooms):
+            if room_id is None:
+                result.failed[device.name] = reason
+            else:
+                room_ids[device.name] = room_id
+
+        if room_ids:
+            for device in await add_device_rooms(room_ids, room_peer):
+                routing_index.add(DeviceRecord.from_entity(device))
+                result.registered.append(device.name)
+
+        # Also for devices an earlier run registered, it may have stopped before this
+        added = set(result.registered) | set(result.skipped)
+        await self._add_to_groups([entry for entry in entries if entry.group and entry.name in added])
+
+    async def _check(self, entry: ManifestEntry, semaphore: asyncio.Semaphore) -> Optional[str]:
+        if len(entry.name) > 30:
+            return "Device name too long (max 30 characters)"
+        if entry.name.split() != [entry.name]:
+            return "Device name can't contain spaces"
+        if not checkers.is_url(entry.host, allow_special_ips=True):
+            return "Host is not a valid URL"
+
+        async with semaphore:
+            response = await ping_device(entry.host)
+            if response["error"]["code"] != "OK":
+                return "Could not reach device"
+
+            response = await get_available_device_commands(entry.host)
+            if response["error"]["code"] != "OK":
+                return "Could not fetch available commands"
+
+        command_catalogs.put(entry.host, response["response"], response["etag"])
+
+        return None
+
+    async def _register(self, entry: ManifestEntry, semaphore: asyncio.Semaphore):
+        username = _matrix_username(entry.name)
+
+        async with semaphore:
+            status_code, response = await register_user(username=username)
+            if status_code == 400 and response.get("errcode") == "M_USER_IN_USE":
+                status_code, response = await login_user(username)
+
+        if status_code != 200:
+            return None, f"Unable to register the Matrix user: ({status_code}) {response.get('error', '')}"
+
+        return (
+            Entity(
+                name=entry.name,
+                host=entry.host,
+                matrix_id=username,
+                access_token=response["access_token"],
+                ingest_token=secrets.token_urlsafe(32),
+                is_device=True,
+            ),
+            None,
+        )
+
+    async def _create_room(self, device: Entity, room_peer: str, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            status_code, response = await create_room(
+                name=device.name, room_peer=room_peer, access_token=device.access_token
+            )
+
+        if status_code != 200:
+            return None, f"Could not create room: ({status_code}) {response.get('error', '')}"
+
+        return response["room_id"], None
+
+    async def _add_to_groups(self, entries: List[ManifestEntry]) -> None:
+        by_group: Dict[str, List[str]] = {}
+        for entry in entries:
+            by_group.setdefault(entry.group, []).append(entry.name)
+
+        for name, members in by_group.items():
+            group = await get_group_by_name(name) or await create_group(name)
+            await add_group_members(group, await get_devices_by_names(members))
+
+
+device_importer = DeviceImporter(
+    concurrency=CONF.get("devices", {}).get("import_concurrency", 20),
+    batch_size=CONF.get("devices", {}).get("import_batch_size", 50),
+)
+
+
+def _arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m mautrix_iot.provisioning", description=__doc__.splitlines()[0]
+    )
+    parser.add_argument("manifest", help="YAML or CSV file listing the devices")
+    parser.add_argument(
+        "--peer",
+        help="Matrix user invited to the device rooms, by default the user of the management room",
+    )
+    return parser.parse_args()
+
+
+async def main() -> int:
+    args = _arguments()
+
+    try:
+        entries = load_manifest(args.manifest)
+    except (OSError, ValueError, yaml.YAMLError, csv.Error) as error:
+        print(f"Could not read the manifest: {error}", file=sys.stderr)
+        return 2
+
+    try:
+        await upgrade_database()
+        await _initial_db_population()
+
+        room_peer = args.peer
+        if room_peer is None:
+            bot = await get_bot_entity()
+            room_peer = bot.room.user_matrix_id if bot.room is not None else None
+        if room_peer is None:
+            print("No user is known from the management room, pass --peer", file=sys.stderr)
+            return 2
+
+        result = await device_importer.run(entries, room_peer, print)
+    finally:
+        await device_api.client.close()
+        await homeserver_api.client.close()
+        await engine.dispose()
+
+    print("\n".join(result.summary()))
+
+    return 1 if result.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,86 @@
+import asyncio
+import random
+import time
+from typing import Dict, Hashable, Optional
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        self._refill()
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+
+        return False
+
+    async def acquire(self) -> float:
+        """Take a token, waiting for one if needed. Returns the seconds waited."""
+        waited = 0.0
+
+        while not self.try_acquire():
+            delay = (1 - self.tokens) / self.rate
+            await asyncio.sleep(delay)
+            waited += delay
+
+        return waited
+
+
+class RateLimiter:
+    """Token bucket per identity, plus backoff for requests that got throttled."""
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        max_retries: int,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+
+        self.throttled_requests = 0
+        self.throttled_seconds = 0.0
+        self.retries = 0
+
+    async def acquire(self, identity: Hashable) -> None:
+        bucket = self._buckets.get(identity)
+        if bucket is None:
+            bucket = self._buckets[identity] = TokenBucket(self.rate, self.burst)
+
+        waited = await bucket.acquire()
+        if waited:
+            self.throttled_requests += 1
+            self.throttled_seconds += waited
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        # Honor the server's hint, with a bit of jitter so retries don't line up
+        if retry_after is not None:
+            return retry_after + random.uniform(0, min(retry_after, 1.0) * 0.25)
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    async def wait_before_retry(
+        self, attempt: int, retry_after: Optional[float] = None
+    ) -> None:
+        delay = self.backoff(attempt, retry_after)
+
+        self.retries += 1
+        self.throttled_seconds += delay
+        await asyncio.sleep(delay)
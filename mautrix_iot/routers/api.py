@@ -1,15 +1,67 @@
-from typing import Annotated, Optional, Union
+import asyncio
+import logging
+from typing import Annotated, Any, Dict, List, Optional, Tuple, Union
 
 from fastapi import APIRouter, Depends, Header
 from fastapi.responses import JSONResponse
 
+from mautrix_iot import log
+from mautrix_iot.cluster import cluster, forwarded_txn_id
+from mautrix_iot.configuration import CONF
 from mautrix_iot.dependencies import check_authorization_header
 from mautrix_iot.matrix import EventHandler
+from mautrix_iot.transactions import transaction_store
+from mautrix_iot.work_queue import WorkQueue
 
 router = APIRouter(
     prefix="/_matrix/app/v1", dependencies=[Depends(check_authorization_header)]
 )
 event_handler = EventHandler()
+logger = logging.getLogger(__name__)
+
+
+async def handle_transaction(item: Tuple[str, Dict[str, Any]]) -> None:
+    txd, body = item
+    # Workers outlive requests, so the transaction ID is carried with the item
+    log.txn_id.set(txd)
+    await event_handler.determine_and_handle_event(body)
+
+
+work_queue = WorkQueue(
+    handle_transaction,
+    max_size=CONF.appservice.get("queue_size", 1000),
+    workers=CONF.appservice.get("queue_workers", 8),
+    name="transactions",
+)
+
+
+async def queue_transaction(txd: str, body: Dict[str, Any]) -> None:
+    """Queue a transaction unless it was already handled, once per ID."""
+    if not await transaction_store.begin(txd):
+        logger.debug("Transaction was already handled")
+        return
+
+    try:
+        await work_queue.put((txd, body))
+    except BaseException:
+        await transaction_store.abort(txd)
+        raise
+
+    await transaction_store.finish(txd)
+
+
+async def _forward(txd: str, url: str, events: List[Dict[str, Any]]) -> None:
+    if not await cluster.forward(url, txd, events):
+        # Better handled by the wrong instance than not at all
+        await queue_transaction(forwarded_txn_id(txd, url), {"events": events})
+
+
+async def _queue_sharded(txd: str, body: Dict[str, Any]) -> None:
+    local, remote = cluster.partition(body.get("events", []))
+
+    await asyncio.gather(*(_forward(txd, url, events) for url, events in remote.items()))
+    if local:
+        await work_queue.put((txd, {**body, "events": local}))
 
 
 @router.post(f"/ping")
@@ -23,10 +75,28 @@ async def ping(
     txd: str,
     authorization: Annotated[Union[str, None], Header()] = None,
 ):
-    print(txd)
-    print(authorization)
-    print(body)
+    log.txn_id.set(txd)
+    logger.debug(
+        "Received transaction with %d events", len(body.get("events", []))
+    )
+
+    # Acknowledge as soon as the transaction is queued, workers handle the events
+    if not cluster.enabled:
+        await queue_transaction(txd, body)
+        return JSONResponse({})
+
+    # Homeserver retried a transaction we already handled
+    if not await transaction_store.begin(txd):
+        logger.debug("Transaction was already handled")
+        return JSONResponse({})
+
+    # Rooms owned by other instances are handed over to them
+    try:
+        await _queue_sharded(txd, body)
+    except BaseException:
+        await transaction_store.abort(txd)
+        raise
 
-    event_handler.determine_and_handle_event(body)
+    await transaction_store.finish(txd)
 
     return JSONResponse({})
@@ -0,0 +1,24 @@
+import logging
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import JSONResponse
+
+from mautrix_iot import log
+from mautrix_iot.dependencies import check_authorization_header
+from mautrix_iot.routers.api import queue_transaction
+
+router = APIRouter(
+    prefix="/_iot/v1/cluster", dependencies=[Depends(check_authorization_header)]
+)
+logger = logging.getLogger(__name__)
+
+
+@router.put("/transactions/{txd}")
+async def forwarded_transaction(body: dict, txd: str):
+    """Events of rooms owned here, received by another instance of the cluster."""
+    log.txn_id.set(txd)
+    logger.debug("Received %d forwarded events", len(body.get("events", [])))
+
+    await queue_transaction(txd, body)
+
+    return JSONResponse({})
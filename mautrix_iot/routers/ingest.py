@@ -0,0 +1,56 @@
+import logging
+from typing import Annotated
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import JSONResponse
+
+from mautrix_iot.configuration import CONF
+from mautrix_iot.dependencies import check_device_token
+from mautrix_iot.db.operations import get_job_by_device_job_id
+from mautrix_iot.exceptions import BadJsonError, NotFoundError, RateLimitedError
+from mautrix_iot.ingest import ingest_buffer
+from mautrix_iot.jobs import job_manager
+from mautrix_iot.routing import DeviceRecord
+from mautrix_iot.telemetry import telemetry_store
+
+router = APIRouter(prefix="/_iot/v1")
+logger = logging.getLogger(__name__)
+
+
+@router.post("/devices/{name}/events")
+async def push_events(
+    body: dict,
+    device: Annotated[DeviceRecord, Depends(check_device_token)],
+):
+    events = body.get("events")
+    if (
+        not isinstance(events, list)
+        or len(events) > CONF.get("ingest", {}).get("max_events_per_request", 100)
+        or not all(isinstance(event, dict) for event in events)
+    ):
+        raise BadJsonError()
+
+    if not ingest_buffer.allow(device):
+        logger.debug("Rate limited events from %s", device.name)
+        raise RateLimitedError()
+
+    ingest_buffer.add(device, events)
+    telemetry_store.record_events(device.id, events)
+
+    return JSONResponse({"accepted": len(events)})
+
+
+@router.post("/devices/{name}/jobs/{job_id}")
+async def report_job(
+    body: dict,
+    job_id: str,
+    device: Annotated[DeviceRecord, Depends(check_device_token)],
+):
+    job = await get_job_by_device_job_id(device.id, job_id)
+    if job is None:
+        raise NotFoundError("Job")
+
+    if not await job_manager.report(job, body):
+        raise BadJsonError()
+
+    return JSONResponse({})
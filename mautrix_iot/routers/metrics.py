@@ -0,0 +1,175 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+
+from mautrix_iot.catalog import command_catalogs
+from mautrix_iot.cluster import cluster
+from mautrix_iot.device_api import client as device_client
+from mautrix_iot.dispatcher import dispatcher
+from mautrix_iot.health import health_monitor
+from mautrix_iot.homeserver_api import rate_limiter
+from mautrix_iot.ingest import ingest_buffer
+from mautrix_iot.jobs import job_manager
+from mautrix_iot.membership import unknown_rooms
+from mautrix_iot.metrics import StatsCollector
+from mautrix_iot.routers.api import work_queue
+from mautrix_iot.routing import routing_index
+from mautrix_iot.sessions import flow_sessions
+from mautrix_iot.telemetry import telemetry_store
+from mautrix_iot.transactions import transaction_store
+
+router = APIRouter()
+
+
+def _ratio(hits: int, misses: int) -> float:
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+REGISTRY.register(
+    StatsCollector(
+        gauges={
+            "mautrix_iot_queue_depth": (
+                "Items waiting in the bridge's internal queues",
+                lambda: {
+                    "transactions": work_queue.depth,
+                    "messages": dispatcher.depth,
+                    "ingest": ingest_buffer.depth,
+                    "telemetry": telemetry_store.depth,
+                },
+            ),
+            "mautrix_iot_queue_busy_workers": (
+                "Workers currently handling a queued item",
+                lambda: {"transactions": work_queue.busy_workers},
+            ),
+            "mautrix_iot_cache_entries": (
+                "Entries held by the bridge's in-memory caches",
+                lambda: {
+                    "routing": len(routing_index),
+                    "flow_sessions": len(flow_sessions),
+                    "transactions": len(transaction_store),
+                    "unknown_rooms": len(unknown_rooms),
+                },
+            ),
+            "mautrix_iot_cache_hit_ratio": (
+                "Share of lookups answered from memory",
+                lambda: {
+                    "routing": _ratio(routing_index.hits, routing_index.misses),
+                    "unknown_rooms": _ratio(unknown_rooms.hits, unknown_rooms.misses),
+                    "command_catalog": _ratio(
+                        command_catalogs.hits, command_catalogs.misses
+                    ),
+                },
+            ),
+            "mautrix_iot_devices_unreachable": (
+                "Devices whose circuit breaker is open",
+                lambda: {"devices": device_client.unreachable},
+            ),
+            "mautrix_iot_jobs_background": (
+                "Commands running in the background on the bridge",
+                lambda: {"bridge": job_manager.background},
+            ),
+            "mautrix_iot_cluster_instances": (
+                "Bridge instances sharing the rooms",
+                lambda: {"live": cluster.instances},
+            ),
+            "mautrix_iot_cluster_leader": (
+                "Whether this instance runs the background duties",
+                lambda: {"instance": int(cluster.leader)},
+            ),
+            "mautrix_iot_devices_health": (
+                "Devices by the result of their last health check",
+                lambda: {
+                    "online": health_monitor.online,
+                    "offline": health_monitor.offline,
+                },
+            ),
+        },
+        counters={
+            "mautrix_iot_cache_hits": (
+                "Lookups answered from memory",
+                lambda: {
+                    "routing": routing_index.hits,
+                    "command_catalog": command_catalogs.hits,
+                    "unknown_rooms": unknown_rooms.hits,
+                },
+            ),
+            "mautrix_iot_cache_misses": (
+                "Lookups that missed the in-memory cache",
+                lambda: {
+                    "routing": routing_index.misses,
+                    "command_catalog": command_catalogs.misses,
+                    "unknown_rooms": unknown_rooms.misses,
+                },
+            ),
+            "mautrix_iot_queue_items": (
+                "Items that went through the transaction queue",
+                lambda: {
+                    "enqueued": work_queue.enqueued,
+                    "processed": work_queue.processed,
+                    "failed": work_queue.failed,
+                    "blocked": work_queue.blocked_puts,
+                },
+            ),
+            "mautrix_iot_queue_blocked_seconds": (
+                "Time the homeserver waited on a full transaction queue",
+                lambda: {"transactions": work_queue.blocked_seconds},
+            ),
+            "mautrix_iot_messages": (
+                "Messages handed to the outgoing dispatcher",
+                lambda: {
+                    "sent": dispatcher.sent,
+                    "coalesced": dispatcher.coalesced,
+                    "failed": dispatcher.failed,
+                },
+            ),
+            "mautrix_iot_health_probes": (
+                "Pings sent by the device health monitor",
+                lambda: {"devices": health_monitor.probes},
+            ),
+            "mautrix_iot_ingest_events": (
+                "Events pushed by devices",
+                lambda: {
+                    "accepted": ingest_buffer.accepted,
+                    "dropped": ingest_buffer.dropped,
+                },
+            ),
+            "mautrix_iot_ingest_rate_limited": (
+                "Device pushes refused by the per-device rate limit",
+                lambda: {"devices": ingest_buffer.rejected},
+            ),
+            "mautrix_iot_telemetry_readings": (
+                "Numeric readings pushed by devices",
+                lambda: {
+                    "received": telemetry_store.samples,
+                    "failed": telemetry_store.failed,
+                },
+            ),
+            "mautrix_iot_jobs": (
+                "Long running device commands",
+                lambda: {
+                    "started": job_manager.started,
+                    "finished": job_manager.finished,
+                },
+            ),
+            "mautrix_iot_cluster_forwarded_events": (
+                "Events handed to the instance owning their room",
+                lambda: {
+                    "forwarded": cluster.forwarded,
+                    "failed": cluster.forward_failures,
+                },
+            ),
+            "mautrix_iot_rate_limit_retries": (
+                "Homeserver requests retried after M_LIMIT_EXCEEDED",
+                lambda: {"homeserver": rate_limiter.retries},
+            ),
+            "mautrix_iot_rate_limit_throttled_seconds": (
+                "Time requests spent waiting on rate limits",
+                lambda: {"homeserver": rate_limiter.throttled_seconds},
+            ),
+        },
+    )
+)
+
+
+@router.get("/metrics")
+async def metrics():
+    return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,130 @@
+from typing import Dict, List, NamedTuple, Optional
+
+from mautrix_iot.db.database import get_entity_for_room
+from mautrix_iot.db.models import Entity
+from mautrix_iot.db.operations import get_entities
+
+
+class DeviceRecord(NamedTuple):
+    """Detached copy of the Entity columns needed to route a message."""
+
+    id: int
+    name: str
+    host: Optional[str]
+    matrix_id: str
+    access_token: Optional[str]
+    is_device: bool
+    room_id: Optional[str]
+    ingest_token: Optional[str] = None
+
+    @classmethod
+    def from_entity(cls, entity: Entity) -> "DeviceRecord":
+        return cls(
+            id=entity.id,
+            name=entity.name,
+            host=entity.host,
+            matrix_id=entity.matrix_id,
+            access_token=entity.access_token,
+            is_device=entity.is_device,
+            room_id=entity.room_id,
+            ingest_token=entity.ingest_token,
+        )
+
+
+class RoutingIndex:
+    """Maps room IDs and Matrix IDs to entities without touching the database.
+
+    Loaded once at startup, then kept up to date by every code path that
+    registers an entity or changes its room.
+    """
+
+    def __init__(self):
+        self._by_room: Dict[str, DeviceRecord] = {}
+        self._by_matrix_id: Dict[str, DeviceRecord] = {}
+        self._by_name: Dict[str, DeviceRecord] = {}
+        self._bot: Optional[DeviceRecord] = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._by_matrix_id)
+
+    async def load(self) -> None:
+        entities = await get_entities()
+
+        self._by_room.clear()
+        self._by_matrix_id.clear()
+        self._by_name.clear()
+        self._bot = None
+
+        for entity in entities:
+            self.add(DeviceRecord.from_entity(entity))
+
+    def add(self, record: DeviceRecord) -> None:
+        previous = self._by_matrix_id.get(record.matrix_id)
+        if previous is not None and previous.room_id is not None:
+            self._by_room.pop(previous.room_id, None)
+
+        self._by_matrix_id[record.matrix_id] = record
+        self._by_name[record.name] = record
+        if record.room_id is not None:
+            self._by_room[record.room_id] = record
+        if not record.is_device:
+            self._bot = record
+
+    def set_room(self, matrix_id: str, room_id: Optional[str]) -> None:
+        record = self._by_matrix_id.get(matrix_id)
+        if record is not None:
+            self.add(record._replace(room_id=room_id))
+
+    def remove(self, matrix_id: str) -> None:
+        record = self._by_matrix_id.pop(matrix_id, None)
+        if record is not None:
+            self._by_name.pop(record.name, None)
+        if record is not None and record.room_id is not None:
+            self._by_room.pop(record.room_id, None)
+
+    def for_room(self, room_id: str) -> Optional[DeviceRecord]:
+        record = self._by_room.get(room_id)
+
+        if record is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return record
+
+    async def load_room(self, room_id: str) -> Optional[DeviceRecord]:
+        """Look up a room in the database, for entities registered by another instance."""
+        entity = await get_entity_for_room(room_id)
+        if entity is None:
+            return None
+
+        record = DeviceRecord.from_entity(entity)
+        self.add(record)
+        return record
+
+    def for_matrix_id(self, matrix_id: str) -> Optional[DeviceRecord]:
+        return self._by_matrix_id.get(matrix_id)
+
+    def for_name(self, name: str) -> Optional[DeviceRecord]:
+        return self._by_name.get(name)
+
+    def set_ingest_token(self, matrix_id: str, token: str) -> None:
+        record = self._by_matrix_id.get(matrix_id)
+        if record is not None:
+            self.add(record._replace(ingest_token=token))
+
+    def devices(self) -> List[DeviceRecord]:
+        return [record for record in self._by_matrix_id.values() if record.is_device]
+
+    @property
+    def bot(self) -> DeviceRecord:
+        if self._bot is None:
+            raise Exception("No default bot in database")
+
+        return self._bot
+
+
+routing_index = RoutingIndex()
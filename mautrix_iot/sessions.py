@@ -0,0 +1,123 @@
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from mautrix_iot.configuration import CONF
+from mautrix_iot.db.operations import (
+    delete_flow_session,
+    get_flow_session,
+    prune_flow_sessions,
+    save_flow_session,
+)
+from mautrix_iot.flows import COMMANDS, BasicFlow
+
+_FLOW_COMMANDS = {flow_class: command for command, flow_class in COMMANDS.items()}
+
+
+class FlowSessionManager:
+    """Running flows, one per (room_id, sender).
+
+    Flows that are not touched for ``ttl`` seconds are dropped, and at most
+    ``max_sessions`` are kept in memory. With ``persist`` enabled, flows are
+    also saved to the database so a restart resumes them. When ``shared``
+    with other instances, the database is the only copy, since the next
+    message of a flow may be handled by another instance.
+    """
+
+    def __init__(self, ttl: int, max_sessions: int, persist: bool, shared: bool = False):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.persist = persist or shared
+        self.shared = shared
+        self._sessions: "OrderedDict[Tuple[str, str], Tuple[BasicFlow, float]]" = (
+            OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _evict_expired(self) -> None:
+        # Least recently used sessions are at the front
+        deadline = time.monotonic() - self.ttl
+        while self._sessions:
+            key, (_, last_used) = next(iter(self._sessions.items()))
+            if last_used > deadline:
+                break
+            self._sessions.popitem(last=False)
+
+    async def _load(self, room_id: str, sender: str) -> Optional[BasicFlow]:
+        record = await get_flow_session(room_id, sender)
+        if record is None:
+            return None
+
+        expired = record.updated_at < datetime.utcnow() - timedelta(seconds=self.ttl)
+        if expired or record.command not in COMMANDS:
+            await delete_flow_session(room_id, sender)
+            return None
+
+        flow = COMMANDS[record.command](room_id, sender, record.args or [])
+        flow.restore(record.state, record.props or {})
+        return flow
+
+    async def get(self, room_id: str, sender: str) -> Optional[BasicFlow]:
+        self._evict_expired()
+
+        key = (room_id, sender)
+        if key in self._sessions:
+            flow, _ = self._sessions.pop(key)
+        elif self.persist:
+            flow = await self._load(room_id, sender)
+        else:
+            flow = None
+
+        if flow is None or flow.done:
+            return None
+
+        if not self.shared:
+            self._sessions[key] = (flow, time.monotonic())
+        return flow
+
+    async def save(self, room_id: str, sender: str, flow: BasicFlow) -> None:
+        """Store the flow after it changed state, finished flows are discarded."""
+        if flow.done:
+            await self.discard(room_id, sender)
+            return
+
+        key = (room_id, sender)
+        self._sessions.pop(key, None)
+        if not self.shared:
+            self._sessions[key] = (flow, time.monotonic())
+
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+        if self.persist:
+            await save_flow_session(
+                room_id,
+                sender,
+                _FLOW_COMMANDS[type(flow)],
+                flow.state_index,
+                flow.props,
+                flow.args,
+            )
+
+    async def discard(self, room_id: str, sender: str) -> None:
+        self._sessions.pop((room_id, sender), None)
+
+        if self.persist:
+            await delete_flow_session(room_id, sender)
+
+    async def prune(self) -> None:
+        self._evict_expired()
+
+        if self.persist:
+            await prune_flow_sessions(datetime.utcnow() - timedelta(seconds=self.ttl))
+
+
+flow_sessions = FlowSessionManager(
+    ttl=CONF.appservice.get("flow_ttl", 900),
+    max_sessions=CONF.appservice.get("flow_max_sessions", 1000),
+    persist=CONF.appservice.get("persist_flows", False),
+    shared=CONF.get("cluster", {}).get("enabled", False),
+)
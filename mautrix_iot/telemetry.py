@@ -0,0 +1,287 @@
+import asyncio
+import logging
+import re
+import time
+from array import array
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from mautrix_iot.configuration import CONF
+from mautrix_iot.db.operations import (
+    downsample_telemetry,
+    get_telemetry_metrics,
+    get_telemetry_summary,
+    insert_telemetry,
+    prune_telemetry,
+)
+
+logger = logging.getLogger(__name__)
+
+MINUTE = 60
+HOUR = 3600
+
+_RANGE = re.compile(r"^(\d+)([mhd])$")
+_RANGE_UNITS = {"m": MINUTE, "h": HOUR, "d": 24 * HOUR}
+
+# Seconds of readings in one raw chunk, the most uint32 millisecond offsets can hold
+MAX_CHUNK_SPAN = (2**32 - 1) // 1000
+
+
+def parse_range(text: str) -> Optional[int]:
+    """Seconds in a range such as ``30m``, ``24h`` or ``7d``."""
+    match = _RANGE.match(text)
+    if match is None or int(match.group(1)) == 0:
+        return None
+
+    return int(match.group(1)) * _RANGE_UNITS[match.group(2)]
+
+
+def _spans(times: array, values: array) -> Iterator[Tuple[float, array, array]]:
+    """Split readings into chunks short enough for their offsets to fit a uint32.
+
+    Yields the start of each chunk, its offsets in milliseconds and its values.
+    """
+    first = min(times)
+    spans: Dict[int, Tuple[array, array]] = {}
+    for t, value in zip(times, values):
+        span_times, span_values = spans.setdefault(
+            int((t - first) // MAX_CHUNK_SPAN), (array("d"), array("d"))
+        )
+        span_times.append(t)
+        span_values.append(value)
+
+    for span_times, span_values in spans.values():
+        start = min(span_times)
+        yield start, array("I", (int((t - start) * 1000) for t in span_times)), span_values
+
+
+class Summary(NamedTuple):
+    count: int
+    min: float
+    max: float
+    sum: float
+
+    @property
+    def avg(self) -> float:
+        return self.sum / self.count
+
+
+class TelemetryStore:
+    """Numeric readings pushed by devices, kept raw for a while and as rollups after.
+
+    Readings are buffered in memory and written every ``flush_interval``
+    seconds, or sooner once ``max_buffered`` readings are waiting. A flush
+    only inserts rows: one packed chunk per metric (more for readings over
+    ``MAX_CHUNK_SPAN``) and one per-minute rollup per bucket. Retention
+    drops raw chunks after ``raw_retention`` seconds, merges minute rollups
+    into hourly ones after ``minute_retention``, and drops hourly rollups
+    after ``hour_retention``.
+    """
+
+    def __init__(
+        self,
+        flush_interval: float,
+        max_buffered: int,
+        raw_retention: int,
+        minute_retention: int,
+        hour_retention: int,
+        retention_interval: float,
+    ):
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.raw_retention = raw_retention
+        self.minute_retention = minute_retention
+        self.hour_retention = hour_retention
+        self.retention_interval = retention_interval
+
+        self._buffer: Dict[Tuple[int, str], Tuple[array, array]] = {}
+        self._buffered = 0
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        self._retention_task: Optional[asyncio.Task] = None
+
+        self.samples = 0
+        self.flushes = 0
+        self.failed = 0
+
+    @property
+    def depth(self) -> int:
+        return self._buffered
+
+    def record(self, device_id: int, metric: str, value: float, timestamp: float) -> None:
+        times, values = self._buffer.setdefault(
+            (device_id, metric), (array("d"), array("d"))
+        )
+        times.append(timestamp)
+        values.append(value)
+
+        self._buffered += 1
+        self.samples += 1
+        if self._buffered >= self.max_buffered:
+            self._wakeup.set()
+
+    def record_events(self, device_id: int, events: List[Dict[str, Any]]) -> None:
+        """Keep the numeric values found in the ``data`` of pushed events."""
+        now = time.time()
+
+        for event in events:
+            timestamp = event.get("ts")
+            # Readings from too far back or from the future are taken as current
+            if not isinstance(timestamp, (int, float)) or not (
+                now - self.raw_retention < timestamp <= now + MINUTE
+            ):
+                timestamp = now
+
+            data = event.get("data")
+            if not isinstance(data, dict):
+                continue
+
+            for metric, value in data.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self.record(device_id, str(metric), float(value), timestamp)
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        await self.stop_retention()
+
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+        await self.flush()
+
+    async def start_retention(self) -> None:
+        """Apply retention every ``retention_interval``, in a cluster only one instance does."""
+        if self._retention_task is None:
+            self._retention_task = asyncio.create_task(self._retain_forever())
+
+    async def stop_retention(self) -> None:
+        if self._retention_task is not None:
+            self._retention_task.cancel()
+            await asyncio.gather(self._retention_task, return_exceptions=True)
+            self._retention_task = None
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            await self.flush()
+
+    async def _retain_forever(self) -> None:
+        while True:
+            try:
+                await self.apply_retention()
+            except Exception:
+                logger.exception("Telemetry retention failed")
+
+            await asyncio.sleep(self.retention_interval)
+
+    async def flush(self) -> None:
+        buffer, self._buffer = self._buffer, {}
+        count, self._buffered = self._buffered, 0
+        if not buffer:
+            return
+
+        try:
+            chunks, rollups = self._pack(buffer)
+            await insert_telemetry(chunks, rollups)
+        except Exception:
+            self.failed += count
+            logger.exception("Failed to store %d telemetry readings", count)
+        else:
+            self.flushes += 1
+
+    def _pack(
+        self, buffer: Dict[Tuple[int, str], Tuple[array, array]]
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        chunks = []
+        rollups = []
+
+        for (device_id, metric), (times, values) in buffer.items():
+            chunks.extend(
+                {
+                    "entity_id": device_id,
+                    "metric": metric,
+                    "start": start,
+                    "count": len(span_values),
+                    "offsets": offsets.tobytes(),
+                    "values": span_values.tobytes(),
+                }
+                for start, offsets, span_values in _spans(times, values)
+            )
+
+            buckets: Dict[int, List[float]] = {}
+            for t, value in zip(times, values):
+                buckets.setdefault(int(t - t % MINUTE), []).append(value)
+
+            rollups.extend(
+                {
+                    "entity_id": device_id,
+                    "metric": metric,
+                    "resolution": MINUTE,
+                    "bucket": bucket,
+                    "count": len(readings),
+                    "min": min(readings),
+                    "max": max(readings),
+                    "sum": sum(readings),
+                }
+                for bucket, readings in buckets.items()
+            )
+
+        return chunks, rollups
+
+    async def apply_retention(self) -> None:
+        now = time.time()
+        # Aligned on the hour, so an hour is never half minutes and half hourly
+        before = int(now - self.minute_retention) // HOUR * HOUR
+
+        await downsample_telemetry(MINUTE, HOUR, before)
+        await prune_telemetry(
+            chunks_before=now - self.raw_retention,
+            rollups_before=int(now - self.hour_retention),
+            resolution=HOUR,
+        )
+
+    async def summary(self, device_id: int, metric: str, seconds: int) -> Optional[Summary]:
+        since = time.time() - seconds
+        count, low, high, total = await get_telemetry_summary(
+            device_id, metric, int(since - since % MINUTE), [MINUTE, HOUR]
+        )
+
+        # Readings not flushed yet are counted as well
+        times, values = self._buffer.get((device_id, metric), ((), ()))
+        recent = [value for t, value in zip(times, values) if t >= since]
+        if recent:
+            count = (count or 0) + len(recent)
+            low = min(recent) if low is None else min(low, *recent)
+            high = max(recent) if high is None else max(high, *recent)
+            total = (total or 0) + sum(recent)
+
+        if not count:
+            return None
+
+        return Summary(count, low, high, total)
+
+    async def metrics(self, device_id: int) -> List[str]:
+        stored = await get_telemetry_metrics(device_id)
+        buffered = {metric for device, metric in self._buffer if device == device_id}
+
+        return sorted(buffered.union(stored))
+
+
+telemetry_store = TelemetryStore(
+    flush_interval=CONF.get("telemetry", {}).get("flush_interval", 5),
+    max_buffered=CONF.get("telemetry", {}).get("max_buffered", 10000),
+    raw_retention=CONF.get("telemetry", {}).get("raw_retention_hours", 24) * HOUR,
+    minute_retention=CONF.get("telemetry", {}).get("minute_retention_days", 7) * 24 * HOUR,
+    hour_retention=CONF.get("telemetry", {}).get("hour_retention_days", 365) * 24 * HOUR,
+    retention_interval=HOUR,
+)
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Set
+
+from mautrix_iot.configuration import CONF
+from mautrix_iot.db.operations import (
+    claim_transaction,
+    is_transaction_processed,
+    mark_transaction_processed,
+    prune_transactions,
+    release_transaction,
+)
+
+
+class TransactionStore:
+    """Remembers which homeserver transactions were already handled.
+
+    Recent IDs are kept in a bounded LRU, the database holds the rest so
+    retries are still recognized after a restart. When ``shared`` with
+    other instances, a transaction is claimed in the database before it is
+    handled, as a retry may be delivered to another instance.
+    """
+
+    def __init__(self, cache_size: int, shared: bool = False):
+        self.cache_size = cache_size
+        self.shared = shared
+        self._cache: "OrderedDict[str, None]" = OrderedDict()
+        self._pending: Set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def _remember(self, txn_id: str) -> None:
+        self._cache[txn_id] = None
+        self._cache.move_to_end(txn_id)
+
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def is_processed(self, txn_id: str) -> bool:
+        if txn_id in self._cache:
+            self._cache.move_to_end(txn_id)
+            return True
+
+        if await is_transaction_processed(txn_id):
+            self._remember(txn_id)
+            return True
+
+        return False
+
+    async def begin(self, txn_id: str) -> bool:
+        """Claim a transaction, False if it is already done or being handled."""
+        if txn_id in self._pending:
+            return False
+
+        if not self.shared:
+            if await self.is_processed(txn_id):
+                return False
+        # Claimed and handled transactions look the same in the database. Only
+        # those finished here are remembered, the instance holding a claim may
+        # still give it up and leave the retry to this one
+        elif txn_id in self._cache or not await claim_transaction(txn_id):
+            return False
+
+        self._pending.add(txn_id)
+        return True
+
+    async def abort(self, txn_id: str) -> None:
+        self._pending.discard(txn_id)
+
+        if self.shared:
+            await release_transaction(txn_id)
+
+    async def finish(self, txn_id: str) -> None:
+        if not self.shared:
+            await mark_transaction_processed(txn_id)
+        self._remember(txn_id)
+        self._pending.discard(txn_id)
+
+    async def prune(self) -> None:
+        await prune_transactions(
+            datetime.utcnow()
+            - timedelta(days=CONF.appservice.get("txn_retention_days", 7))
+        )
+
+
+transaction_store = TransactionStore(
+    CONF.appservice.get("txn_cache_size", 1000),
+    shared=CONF.get("cluster", {}).get("enabled", False),
+)
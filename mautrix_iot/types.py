@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, TypedDict
+from typing import Any, Dict, List, Optional, TypedDict
 
 
 class _DeviceAPIResponseError(TypedDict):
@@ -20,7 +20,18 @@ class _DeviceAPIResponseCommand(TypedDict):
 
 class DeviceAPIResponseCommands(DeviceAPIResponse):
     response: List[_DeviceAPIResponseCommand]
+    etag: Optional[str]
 
 
 class DeviceAPIResponseSendCommand(DeviceAPIResponse):
     response: str
+
+
+class _DeviceAPIResponseJob(TypedDict, total=False):
+    # "running", "done" or "failed"
+    status: str
+    result: Any
+
+
+class DeviceAPIResponseJob(DeviceAPIResponse):
+    response: _DeviceAPIResponseJob
@@ -1,32 +1,49 @@
-import time
+import asyncio
+import json
+from contextlib import asynccontextmanager
 from functools import reduce
-from typing import List
+from datetime import datetime
+from typing import AsyncIterator, Dict, Hashable, List, Optional, Tuple
 
 from mautrix_iot.configuration import CONF
-from mautrix_iot.exceptions import RateLimitedError
 from mautrix_iot.types import _DeviceAPIResponseCommand
 
 
-def retry_rate_limited(func):
-    def wrapper(*args, **kwargs):
-        retries = 1
+class KeyedLock:
+    """One asyncio.Lock per key, dropped once nobody holds or waits on it."""
 
-        while retries <= CONF.appservice["rate_limit_retry"]:
-            try:
-                func(*args, **kwargs)
-            except RateLimitedError:
-                retries += 1
-                time.sleep(1)
-            else:
-                break
+    def __init__(self):
+        self._locks: Dict[Hashable, Tuple[asyncio.Lock, int]] = {}
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable) -> AsyncIterator[None]:
+        lock, users = self._locks.get(key, (asyncio.Lock(), 0))
+        self._locks[key] = (lock, users + 1)
 
-    return wrapper
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[key]
+            if users == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, users - 1)
 
 
 def bot_full_name() -> str:
     return f"@{CONF.appservice['bot_username']}:{CONF.homeserver['domain']}"
 
 
+def instance_url() -> Optional[str]:
+    """Address of this bridge instance in a cluster, None when it runs alone."""
+    cluster = CONF.get("cluster", {})
+    if not cluster.get("enabled", False):
+        return None
+
+    return cluster["instance_url"].rstrip("/")
+
+
 def format_commands(commands: List[_DeviceAPIResponseCommand]) -> str:
     return reduce(
         lambda a, b: a + b,
@@ -41,5 +58,55 @@ def format_commands(commands: List[_DeviceAPIResponseCommand]) -> str:
     )
 
 
+def format_health(
+    status: Optional[str],
+    last_seen: Optional[datetime],
+    latency_ms: Optional[int] = None,
+) -> str:
+    if status is None:
+        return "unknown"
+
+    health = f"🟢 {status}" if status == "online" else f"🔴 {status}"
+    if latency_ms is not None and status == "online":
+        health += f", {latency_ms} ms"
+    if last_seen is not None:
+        health += f", last seen {last_seen:%Y-%m-%d %H:%M:%S} UTC"
+
+    return health
+
+
+def _encoded_size(text: str) -> int:
+    # Size of the text once it's serialized into an event
+    return len(json.dumps(text)) - 2
+
+
+def split_message(
+    parts: List[str], max_size: int, prefix: str = "", suffix: str = ""
+) -> List[str]:
+    """Join ``parts`` into as few messages as possible of at most ``max_size`` bytes.
+
+    Every message is wrapped in ``prefix`` and ``suffix`` so markup such as
+    a list stays balanced. Parts are never cut, even when larger than ``max_size``.
+    """
+    overhead = _encoded_size(prefix + suffix)
+    messages: List[str] = []
+    current: List[str] = []
+    size = overhead
+
+    for part in parts:
+        part_size = _encoded_size(part)
+        if current and size + part_size > max_size:
+            messages.append(prefix + "".join(current) + suffix)
+            current, size = [], overhead
+
+        current.append(part)
+        size += part_size
+
+    if current or not messages:
+        messages.append(prefix + "".join(current) + suffix)
+
+    return messages
+
+
 def format_body_for_room():
     pass
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue:
+    """Bounded queue drained by a fixed number of background workers.
+
+    ``put`` waits while the queue is full, which pushes back on the
+    homeserver instead of buffering without limit.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Any], Awaitable[None]],
+        max_size: int,
+        workers: int,
+        name: str = "work",
+    ):
+        self.handler = handler
+        self.max_size = max_size
+        self.worker_count = workers
+        self.name = name
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._accepting = False
+
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.busy_workers = 0
+        self.max_depth = 0
+        self.blocked_puts = 0
+        self.blocked_seconds = 0.0
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self.depth,
+            "max_size": self.max_size,
+            "max_depth": self.max_depth,
+            "workers": self.worker_count,
+            "busy_workers": self.busy_workers,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "blocked_puts": self.blocked_puts,
+            "blocked_seconds": self.blocked_seconds,
+        }
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._accepting = True
+        self._workers = [
+            asyncio.create_task(self._work(), name=f"{self.name}-worker-{i}")
+            for i in range(self.worker_count)
+        ]
+
+    async def put(self, item: Any) -> None:
+        if not self._accepting:
+            raise RuntimeError(f"{self.name} queue is not accepting work")
+
+        if self._queue.full():
+            self.blocked_puts += 1
+            logger.warning("%s queue is full (%d items)", self.name, self.max_size)
+
+            start = time.monotonic()
+            await self._queue.put(item)
+            self.blocked_seconds += time.monotonic() - start
+        else:
+            self._queue.put_nowait(item)
+
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    async def stop(self, timeout: float) -> None:
+        """Stop accepting work and give the workers ``timeout`` seconds to drain."""
+        if self._queue is None:
+            return
+
+        self._accepting = False
+
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "%s queue did not drain in time, dropping %d items",
+                self.name,
+                self._queue.qsize(),
+            )
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _work(self) -> None:
+        while True:
+            item = await self._queue.get()
+            self.busy_workers += 1
+
+            try:
+                await self.handler(item)
+            except Exception:
+                self.failed += 1
+                logger.exception("%s queue handler failed", self.name)
+            else:
+                self.processed += 1
+            finally:
+                self.busy_workers -= 1
+                self._queue.task_done()
@@ -0,0 +1,90 @@
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+import yaml
+from aiohttp import web
+
+ROOT = Path(__file__).resolve().parent.parent
+WORKDIR = Path(tempfile.mkdtemp(prefix="mautrix-iot-tests-"))
+DATABASE = WORKDIR / "bridge.db"
+
+# The configuration is read from the working directory when mautrix_iot is imported
+with open(ROOT / "bridge.yaml.sample") as f:
+    _conf = yaml.safe_load(f)
+_conf["appservice"]["database"] = f"sqlite:///{DATABASE}"
+_conf["appservice"]["persist_flows"] = False
+_conf["logging"] = {"format": "text", "level": "WARNING"}
+with open(WORKDIR / "bridge.yaml", "w") as f:
+    yaml.safe_dump(_conf, f)
+
+os.chdir(WORKDIR)
+sys.path.insert(0, str(ROOT))
+
+from mautrix_iot import device_api  # noqa: E402
+from mautrix_iot.db.database import _initial_db_population, engine, upgrade_database  # noqa: E402
+from mautrix_iot.dispatcher import dispatcher  # noqa: E402
+from mautrix_iot.routing import routing_index  # noqa: E402
+
+
+@pytest.fixture
+def run():
+    """Run a coroutine on a new event loop, against a new database."""
+    for path in WORKDIR.glob("bridge.db*"):
+        path.unlink()
+
+    def run(coroutine):
+        async def main():
+            try:
+                await upgrade_database()
+                await _initial_db_population()
+                await routing_index.load()
+                return await coroutine
+            finally:
+                await device_api.client.close()
+                await engine.dispose()
+
+        return asyncio.run(main())
+
+    return run
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Messages sent to rooms as (room ID, body), the homeserver is never contacted."""
+    messages = []
+
+    def send(body, room_id, sender, **kwargs):
+        messages.append((room_id, body))
+        future = asyncio.get_running_loop().create_future()
+        future.set_result((200, {}))
+        return future
+
+    monkeypatch.setattr(dispatcher, "send", send)
+
+    return messages
+
+
+@pytest.fixture
+def device_server():
+    """Starts a device answering ``{(method, path): handler}``, returns its URL.
+
+    Runs on the test's event loop and stops with it.
+    """
+
+    async def serve(routes) -> str:
+        app = web.Application()
+        for (method, path), handler in routes.items():
+            app.router.add_route(method, path, handler)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+
+        host, port = runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    return serve
@@ -0,0 +1,67 @@
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from bench.homeserver import FakeHomeserver
+from bench.load import LoadGenerator, percentile
+
+
+def test_percentile():
+    values = [float(value) for value in range(1, 101)]
+
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([3.0], 95) == 3
+    assert percentile([], 50) is None
+
+
+def test_replies_are_matched_to_commands():
+    generator = LoadGenerator(
+        bridge_url="http://bridge",
+        hs_token="token",
+        device_rooms=["!lamp:x"],
+        management_room="!management:x",
+        sender="@alice:x",
+        rate=1,
+        duration=1,
+        management_ratio=0,
+    )
+    first, second = (generator._event()["content"]["body"].split()[1] for _ in range(2))
+
+    generator.on_message("!lamp:x", {"body": f"ok {first}"}, generator._pending[first] + 0.5)
+    # Replies to unknown or already answered commands are ignored
+    generator.on_message("!lamp:x", {"body": f"ok {first} failed r000000000000"}, 0)
+
+    assert generator.reply_latencies == [0.5]
+    assert (generator.commands, generator.lost, generator.device_errors) == (2, 1, 0)
+    assert list(generator._pending) == [second]
+
+
+def test_retried_sends_get_the_same_event():
+    received = []
+    homeserver = FakeHomeserver("x", on_message=lambda room_id, content, at: received.append(content))
+
+    async def scenario():
+        runner = web.AppRunner(homeserver.app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        host, port = runner.addresses[0][:2]
+        url = f"http://{host}:{port}/_matrix/client/v3/rooms/!lamp:x/send/m.room.message/txn1"
+
+        try:
+            async with aiohttp.ClientSession() as session:
+                events = []
+                for _ in range(2):
+                    async with session.put(url, json={"body": "on"}) as response:
+                        events.append((await response.json())["event_id"])
+                return events
+        finally:
+            await runner.cleanup()
+
+    first, retried = asyncio.run(scenario())
+
+    assert first == retried
+    assert received == [{"body": "on"}]
+    assert homeserver.requests == {"/_matrix/client/v3/rooms/{room}/send": 2}
@@ -0,0 +1,90 @@
+import asyncio
+
+from mautrix_iot import devices as devices_module
+from mautrix_iot import flows
+from mautrix_iot.configuration import CONF
+from mautrix_iot.db.models import Entity
+from mautrix_iot.db.operations import create_devices
+from mautrix_iot.devices import broadcast_command
+from mautrix_iot.dispatcher import dispatcher
+from mautrix_iot.flows import BroadcastFlow
+
+ROOM = "!management:matrix.example.com"
+ALICE = "@alice:matrix.example.com"
+
+
+def _devices(count):
+    return [
+        Entity(
+            name=f"lamp{index:02}",
+            host=f"http://lamp{index:02}.example.com",
+            matrix_id=f"@iot_lamp{index:02}:matrix.example.com",
+            access_token="token",
+            is_device=True,
+        )
+        for index in range(count)
+    ]
+
+
+def test_broadcast_is_limited_and_times_out(monkeypatch):
+    monkeypatch.setitem(
+        CONF.conf, "devices", {"broadcast_concurrency": 3, "broadcast_timeout": 0.05}
+    )
+    running = [0, 0]
+
+    async def send_command(host, command, args):
+        running[0] += 1
+        running[1] = max(running)
+        try:
+            await asyncio.sleep(1 if host == "http://lamp07.example.com" else 0.01)
+        finally:
+            running[0] -= 1
+        return {"error": {"code": "OK", "message": ""}, "response": f"{command} {host}"}
+
+    monkeypatch.setattr(devices_module, "send_command", send_command)
+    devices = _devices(10)
+
+    results = asyncio.run(broadcast_command(devices, "on", []))
+
+    assert running[1] == 3
+    assert [device for device, _ in results] == devices
+    codes = [response["error"]["code"] for _, response in results]
+    assert codes == ["OK"] * 7 + ["TIMEOUT"] + ["OK"] * 2
+    assert results[0][1]["response"] == "on http://lamp00.example.com"
+
+
+def test_broadcast_results_are_split(run, sent, monkeypatch):
+    monkeypatch.setattr(dispatcher, "max_event_size", 2000)
+
+    async def broadcast_command(devices, command, args):
+        return [
+            (
+                device,
+                {"error": {"code": "OK", "message": ""}, "response": "on"}
+                if int(device.name[4:]) % 2
+                else {"error": {"code": "CONN_ERR", "message": "refused"}, "response": {}},
+            )
+            for device in devices
+        ]
+
+    monkeypatch.setattr(flows, "broadcast_command", broadcast_command)
+
+    async def scenario():
+        await create_devices(_devices(40)[1:])
+        return await BroadcastFlow(ROOM, ALICE, ["all", "on"]).prompt()
+
+    messages = run(scenario())
+
+    assert len(messages) > 1
+    assert all(len(message) <= dispatcher.max_text_size for message in messages)
+    assert messages[0].startswith("Sent <strong> on </strong> to 39 devices: 20 succeeded, 19 failed.")
+    text = "".join(messages)
+    assert text.count("<li>") == 39
+    assert text.index("lamp01") < text.index("lamp39")
+
+
+def test_broadcast_to_unknown_devices(run):
+    async def scenario():
+        return await BroadcastFlow(ROOM, ALICE, ["kitchen", "on"]).prompt()
+
+    assert run(scenario()) == "❌ No registered devices match <strong> kitchen </strong>."
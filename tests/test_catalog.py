@@ -0,0 +1,89 @@
+import asyncio
+
+from mautrix_iot import catalog
+from mautrix_iot.catalog import CommandCatalogCache
+from mautrix_iot.routing import DeviceRecord
+
+LAMP = DeviceRecord(
+    id=1,
+    name="lamp",
+    host="http://lamp.example.com",
+    matrix_id="@iot_lamp:matrix.example.com",
+    access_token="token",
+    is_device=True,
+    room_id="!lamp:matrix.example.com",
+)
+
+
+def _command(name):
+    return {"name": name, "alias": name, "description": "", "args": []}
+
+
+class Device:
+    """Answers command list requests, recording the ETag each one sent."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.etags = []
+
+    async def __call__(self, host, etag=None):
+        self.etags.append(etag)
+        return self.responses.pop(0)
+
+
+def _ok(commands, etag):
+    return {"error": {"code": "OK", "message": ""}, "response": commands, "etag": etag}
+
+
+NOT_MODIFIED = {"error": {"code": "NOT_MODIFIED", "message": ""}, "response": [], "etag": None}
+UNREACHABLE = {"error": {"code": "CONN_ERR", "message": "refused"}, "response": [], "etag": None}
+
+
+def test_catalog_is_revalidated_with_its_etag(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(catalog.time, "monotonic", lambda: now[0])
+    device = Device(_ok([_command("on")], '"v1"'), NOT_MODIFIED, _ok([_command("off")], '"v2"'))
+    monkeypatch.setattr(catalog, "get_available_device_commands", device)
+    cache = CommandCatalogCache(ttl=60)
+
+    async def scenario():
+        first = await cache.get(LAMP)
+        # Fresh, not asked again
+        assert await cache.get(LAMP) is first
+
+        now[0] += 61
+        assert await cache.get(LAMP) is first
+        assert await cache.get(LAMP) is first
+
+        now[0] += 61
+        return first, await cache.get(LAMP)
+
+    first, changed = asyncio.run(scenario())
+
+    assert device.etags == [None, '"v1"', '"v1"']
+    assert "on" in first and "off" not in first
+    assert "off" in changed and changed.etag == '"v2"'
+    assert (cache.hits, cache.misses, cache.revalidations) == (2, 3, 1)
+
+
+def test_unreachable_device_has_no_catalog(monkeypatch):
+    monkeypatch.setattr(catalog, "get_available_device_commands", Device(UNREACHABLE))
+    cache = CommandCatalogCache(ttl=60)
+
+    assert asyncio.run(cache.get(LAMP)) is None
+
+
+def test_invalidated_catalog_is_fetched_again(monkeypatch):
+    device = Device(_ok([_command("on")], '"v1"'), _ok([_command("on")], '"v1"'))
+    monkeypatch.setattr(catalog, "get_available_device_commands", device)
+    cache = CommandCatalogCache(ttl=60)
+
+    async def scenario():
+        await cache.get(LAMP)
+        cache.invalidate(LAMP.host)
+        await cache.get(LAMP)
+
+    asyncio.run(scenario())
+
+    # Nothing left to revalidate, the whole list is fetched
+    assert device.etags == [None, None]
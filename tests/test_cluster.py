@@ -0,0 +1,68 @@
+from collections import Counter
+
+from mautrix_iot.cluster import Cluster, HashRing, forwarded_txn_id
+
+NODES = ["http://a:8080", "http://b:8080", "http://c:8080"]
+ROOMS = [f"!room{i}:matrix.example.com" for i in range(2000)]
+
+
+def _owners(ring):
+    return {room: ring.owner(room) for room in ROOMS}
+
+
+def test_every_node_owns_rooms():
+    counts = Counter(_owners(HashRing(NODES, 64)).values())
+
+    assert set(counts) == set(NODES)
+    # Virtual nodes keep the shares close to even
+    assert min(counts.values()) > len(ROOMS) / len(NODES) / 2
+
+
+def test_ring_ignores_node_order_and_duplicates():
+    assert _owners(HashRing(NODES, 64)) == _owners(HashRing(NODES[::-1] + NODES[:1], 64))
+
+
+def test_added_node_only_takes_rooms():
+    before = _owners(HashRing(NODES, 64))
+    after = _owners(HashRing(NODES + ["http://d:8080"], 64))
+
+    moved = [room for room in ROOMS if before[room] != after[room]]
+    assert moved
+    assert all(after[room] == "http://d:8080" for room in moved)
+    assert len(moved) < len(ROOMS) / 2
+
+
+def test_removed_node_only_gives_away_its_rooms():
+    before = _owners(HashRing(NODES, 64))
+    after = _owners(HashRing(NODES[:2], 64))
+
+    for room in ROOMS:
+        if before[room] == "http://c:8080":
+            assert after[room] in NODES[:2]
+        else:
+            assert after[room] == before[room]
+
+
+def test_empty_ring():
+    assert HashRing([], 64).owner(ROOMS[0]) is None
+
+
+def test_forwarded_txn_id_is_stable():
+    assert forwarded_txn_id("42", NODES[0]) == forwarded_txn_id("42", NODES[0])
+    assert forwarded_txn_id("42", NODES[0]) != forwarded_txn_id("42", NODES[1])
+    assert forwarded_txn_id("42", NODES[0]).startswith("42.")
+
+
+def test_partition():
+    cluster = Cluster(NODES[0], 10, 30, 64, 10, 60)
+    cluster.ring = HashRing(NODES, 64)
+    events = [{"room_id": room} for room in ROOMS[:50]] + [{"type": "m.presence"}]
+
+    local, remote = cluster.partition(events)
+
+    assert {"type": "m.presence"} in local
+    assert all(cluster.ring.owner(event["room_id"]) == NODES[0] for event in local if "room_id" in event)
+    for url, forwarded in remote.items():
+        assert url != NODES[0]
+        assert all(cluster.ring.owner(event["room_id"]) == url for event in forwarded)
+    assert len(local) + sum(len(forwarded) for forwarded in remote.values()) == len(events)
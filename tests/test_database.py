@@ -0,0 +1,127 @@
+from pathlib import Path
+
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import text
+
+from mautrix_iot.db import database
+from mautrix_iot.db.database import Session, _upgrade, engine
+from mautrix_iot.db.models import Base, Entity
+from mautrix_iot.db.operations import get_entity_by_name
+
+
+def test_migrations_match_models(run):
+    async def scenario():
+        async with engine.connect() as connection:
+            return await connection.run_sync(
+                lambda sync: compare_metadata(MigrationContext.configure(sync), Base.metadata)
+            )
+
+    assert run(scenario()) == []
+
+
+def _config(connection=None) -> Config:
+    config = Config()
+    config.set_main_option("script_location", str(Path(database.__file__).parent / "migrations"))
+    config.attributes["connection"] = connection
+    return config
+
+
+def _baseline_schema(connection) -> None:
+    """Tables as created by bridges from before migrations, without alembic_version."""
+    Base.metadata.drop_all(connection)
+    connection.execute(text("DROP TABLE alembic_version"))
+
+    command.upgrade(_config(connection), "0001")
+    connection.execute(text("DROP TABLE alembic_version"))
+
+    connection.execute(
+        text("INSERT INTO entities (name, matrix_id, is_device) VALUES ('lamp', '@iot_lamp:x', 1)")
+    )
+
+
+def test_database_without_migrations_is_upgraded(run):
+    async def scenario():
+        async with engine.begin() as connection:
+            await connection.run_sync(_baseline_schema)
+            await connection.run_sync(_upgrade)
+
+            return (
+                (await connection.execute(text("SELECT version_num FROM alembic_version"))).scalar(),
+                (await connection.execute(text("SELECT name, ingest_token FROM entities"))).all(),
+            )
+
+    version, entities = run(scenario())
+
+    assert version == ScriptDirectory.from_config(_config()).get_current_head()
+    assert entities == [("lamp", None)]
+
+
+def test_room_lookup_uses_an_index(run):
+    async def scenario():
+        async with engine.connect() as connection:
+            return (
+                await connection.execute(
+                    text("EXPLAIN QUERY PLAN SELECT * FROM entities WHERE room_id = :room_id"),
+                    {"room_id": "!lamp:matrix.example.com"},
+                )
+            ).all()
+
+    plan = " ".join(row[-1] for row in run(scenario()))
+
+    assert "USING INDEX" in plan
+
+
+def test_async_database_urls():
+    assert database._async_database_url("sqlite:///bridge.db") == "sqlite+aiosqlite:///bridge.db"
+    assert database._async_database_url("postgres://u@h/db") == "postgresql+asyncpg://u@h/db"
+    assert database._async_database_url("postgresql://u@h/db") == "postgresql+asyncpg://u@h/db"
+    assert database._async_database_url("postgresql+asyncpg://u@h/db") == "postgresql+asyncpg://u@h/db"
+
+
+def _lamp() -> Entity:
+    return Entity(name="lamp", matrix_id="@iot_lamp:matrix.example.com", is_device=True)
+
+
+def test_session_commits_on_exit(run):
+    async def scenario():
+        async with Session() as db:
+            db.add(_lamp())
+
+        return await get_entity_by_name("lamp")
+
+    assert run(scenario()).matrix_id == "@iot_lamp:matrix.example.com"
+
+
+def test_session_rolls_back_on_error(run):
+    async def scenario():
+        try:
+            async with Session() as db:
+                db.add(_lamp())
+                await db.flush()
+                raise ValueError("Rejected")
+        except ValueError:
+            pass
+
+        return await get_entity_by_name("lamp")
+
+    assert run(scenario()) is None
+
+
+def test_outer_session_is_left_to_its_owner(run):
+    async def scenario():
+        async with Session() as outer:
+            async with Session(session=outer) as db:
+                db.add(_lamp())
+            assert db is outer
+
+            # Not committed by the inner block
+            assert await get_entity_by_name("lamp") is None
+            await outer.rollback()
+
+        return await get_entity_by_name("lamp")
+
+    assert run(scenario()) is None
@@ -0,0 +1,159 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+
+from mautrix_iot import device_api
+from mautrix_iot.device_api import DeviceClient, DeviceUnavailableError
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = DeviceClient()
+    client.read_timeout = 0.1
+    client.failure_threshold = 2
+    client.probe_interval = 0.05
+    monkeypatch.setattr(device_api, "client", client)
+
+    return client
+
+
+def _run(client, coroutine):
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            await client.close()
+
+    return asyncio.run(main())
+
+
+def test_breaker_opens_and_recovers(client, device_server):
+    ping_ok = asyncio.Event()
+
+    async def command(request):
+        await asyncio.sleep(1)
+        return web.Response(text="too late")
+
+    async def ping(request):
+        return web.Response(status=200 if ping_ok.is_set() else 503)
+
+    async def scenario():
+        host = await device_server(
+            {("POST", "/api/v1/command"): command, ("GET", "/api/v1/ping"): ping}
+        )
+
+        for _ in range(2):
+            response = await device_api.send_command(host, "on", [])
+            assert response["error"]["code"] == "TIMEOUT"
+        assert client.breaker(host).is_open and client.unreachable == 1
+
+        # Refused right away while the device is unreachable
+        with pytest.raises(DeviceUnavailableError):
+            await client.request(host, "GET", "/api/v1/ping")
+        assert (await device_api.ping_device(host))["error"]["code"] == "UNAVAILABLE"
+
+        # Probes keep failing until the device answers again
+        await asyncio.sleep(0.15)
+        assert client.breaker(host).is_open
+
+        ping_ok.set()
+        await asyncio.sleep(0.15)
+        return host, await device_api.ping_device(host)
+
+    host, response = _run(client, scenario())
+
+    assert response["error"]["code"] == "OK"
+    assert not client.breaker(host).is_open
+    assert client.breaker(host).failures == 0
+
+
+def test_success_resets_failures(client, device_server):
+    slow = [True]
+
+    async def command(request):
+        if slow[0]:
+            await asyncio.sleep(1)
+        return web.Response(text="done")
+
+    async def scenario():
+        host = await device_server({("POST", "/api/v1/command"): command})
+
+        await device_api.send_command(host, "on", [])
+        assert client.breaker(host).failures == 1
+
+        slow[0] = False
+        response = await device_api.send_command(host, "on", [])
+        return host, response
+
+    host, response = _run(client, scenario())
+
+    assert response == {"error": {"code": "OK", "message": ""}, "response": "done"}
+    assert client.breaker(host).failures == 0
+
+
+def test_requests_per_device_are_limited(client, device_server):
+    client.concurrency = 2
+    running = [0, 0]
+
+    async def command(request):
+        running[0] += 1
+        running[1] = max(running)
+        await asyncio.sleep(0.02)
+        running[0] -= 1
+        return web.Response(text="done")
+
+    async def scenario():
+        host = await device_server({("POST", "/api/v1/command"): command})
+        return await asyncio.gather(*(device_api.send_command(host, "on", []) for _ in range(6)))
+
+    responses = _run(client, scenario())
+
+    assert all(response["error"]["code"] == "OK" for response in responses)
+    assert running[1] == 2
+
+
+def test_unchanged_commands_answer_not_modified(client, device_server):
+    commands = [{"name": "on", "alias": "on", "description": "", "args": []}]
+
+    async def list_commands(request):
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.json_response(commands, headers={"ETag": '"v1"'})
+
+    async def scenario():
+        host = await device_server({("GET", "/api/v1/commands"): list_commands})
+        return (
+            await device_api.get_available_device_commands(host),
+            await device_api.get_available_device_commands(host, etag='"v1"'),
+        )
+
+    fetched, revalidated = _run(client, scenario())
+
+    assert fetched == {"error": {"code": "OK", "message": ""}, "response": commands, "etag": '"v1"'}
+    assert revalidated["error"]["code"] == "NOT_MODIFIED"
+    assert revalidated["etag"] == '"v1"'
+
+
+@pytest.mark.parametrize(
+    "status, body, code, response",
+    [
+        (200, "on", "OK", "on"),
+        (202, json.dumps({"job_id": 42}), "ACCEPTED", "42"),
+        (202, "not json", "BAD_RESPONSE", {}),
+        (400, "Unknown command", 400, {}),
+    ],
+)
+def test_command_responses(client, device_server, status, body, code, response):
+    async def command(request):
+        return web.Response(status=status, text=body)
+
+    async def scenario():
+        host = await device_server({("POST", "/api/v1/command"): command})
+        return await device_api.send_command(host, "on", [])
+
+    result = _run(client, scenario())
+
+    assert result["error"]["code"] == code
+    assert result["response"] == response
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from mautrix_iot import dispatcher as dispatcher_module
+from mautrix_iot.dispatcher import MessageDispatcher
+
+LAMP_ROOM = "!lamp:matrix.example.com"
+FAN_ROOM = "!fan:matrix.example.com"
+
+
+class Homeserver:
+    """Stands in for send_message, recording every event sent."""
+
+    def __init__(self, fail=False):
+        self.events = []
+        self.fail = fail
+
+    async def __call__(self, body, room_id, sender, **kwargs):
+        self.events.append((room_id, sender, body, kwargs))
+        await asyncio.sleep(0)
+        if self.fail:
+            raise ConnectionError("Homeserver is down")
+        return (200, {"event_id": f"$event{len(self.events)}"})
+
+
+@pytest.fixture
+def homeserver(monkeypatch):
+    homeserver = Homeserver()
+    monkeypatch.setattr(dispatcher_module, "send_message", homeserver)
+    return homeserver
+
+
+def test_messages_are_coalesced(homeserver):
+    dispatcher = MessageDispatcher(coalesce_window=0.01, max_event_size=60000)
+
+    async def scenario():
+        futures = [
+            dispatcher.send("one", LAMP_ROOM, "@bot"),
+            dispatcher.send("<two>", LAMP_ROOM, "@bot"),
+            dispatcher.send("three", LAMP_ROOM, "@bot", formatted_body="<b>three</b>"),
+        ]
+        txn_id = dispatcher._queues[LAMP_ROOM][0].txn_id
+        return txn_id, await asyncio.gather(*futures)
+
+    txn_id, results = asyncio.run(scenario())
+
+    assert len(homeserver.events) == 1
+    room_id, sender, body, kwargs = homeserver.events[0]
+    assert (room_id, sender, body) == (LAMP_ROOM, "@bot", "one\n<two>\nthree")
+    assert kwargs["formatted_body"] == "one<br>&lt;two&gt;<br><b>three</b>"
+    # The event keeps the transaction ID of its first message
+    assert kwargs["txn_id"] == txn_id
+    assert results == [(200, {"event_id": "$event1"})] * 3
+    assert (dispatcher.sent, dispatcher.coalesced, dispatcher.depth) == (1, 2, 0)
+
+
+def test_rooms_keep_their_order(homeserver):
+    dispatcher = MessageDispatcher(coalesce_window=0, max_event_size=60000)
+
+    async def scenario():
+        futures = [
+            dispatcher.send("one", LAMP_ROOM, "@bot"),
+            dispatcher.send("fan", FAN_ROOM, "@bot"),
+            dispatcher.send("two", LAMP_ROOM, "@iot_lamp"),
+            dispatcher.send("three", LAMP_ROOM, "@bot"),
+        ]
+        await asyncio.gather(*futures)
+
+    asyncio.run(scenario())
+
+    # Only messages from the same sender are joined, and never out of order
+    lamp = [(sender, body) for room_id, sender, body, _ in homeserver.events if room_id == LAMP_ROOM]
+    assert lamp == [("@bot", "one"), ("@iot_lamp", "two"), ("@bot", "three")]
+    assert [body for room_id, _, body, _ in homeserver.events if room_id == FAN_ROOM] == ["fan"]
+    assert dispatcher._tasks == {} and dispatcher._queues == {}
+
+
+def test_events_stay_under_the_size_limit(homeserver):
+    dispatcher = MessageDispatcher(coalesce_window=0.01, max_event_size=70)
+
+    async def scenario():
+        await asyncio.gather(*(dispatcher.send("x" * 20, LAMP_ROOM, "@bot") for _ in range(4)))
+
+    asyncio.run(scenario())
+
+    assert [body.count("x") for _, _, body, _ in homeserver.events] == [40, 40]
+    assert len({kwargs["txn_id"] for *_, kwargs in homeserver.events}) == 2
+
+
+def test_failed_send_fails_every_message(monkeypatch):
+    homeserver = Homeserver(fail=True)
+    monkeypatch.setattr(dispatcher_module, "send_message", homeserver)
+    dispatcher = MessageDispatcher(coalesce_window=0.01, max_event_size=60000)
+
+    async def scenario():
+        futures = [dispatcher.send(body, LAMP_ROOM, "@bot") for body in ("one", "two")]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    results = asyncio.run(scenario())
+
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert (dispatcher.sent, dispatcher.failed) == (0, 2)
@@ -0,0 +1,74 @@
+from mautrix_iot.db.models import Entity
+from mautrix_iot.db.operations import add_group_members, create_devices, create_group
+from mautrix_iot.dispatcher import dispatcher
+from mautrix_iot.flows import GroupFlow, InfoDeviceFlow
+
+ROOM = "!management:matrix.example.com"
+USER = "@alice:matrix.example.com"
+
+
+async def _devices(count: int, group: str = None):
+    devices = await create_devices(
+        [
+            Entity(
+                name=f"lamp{i}",
+                host=f"http://lamp{i}.example.com",
+                matrix_id=f"@iot_lamp{i}:matrix.example.com",
+                access_token=f"token{i}",
+                is_device=True,
+            )
+            for i in range(count)
+        ]
+    )
+    if group is not None:
+        await add_group_members(await create_group(group), devices)
+
+    return devices
+
+
+def test_group_info_is_split(run, monkeypatch):
+    monkeypatch.setattr(dispatcher, "max_event_size", 4000)
+
+    async def scenario():
+        await _devices(30, "kitchen")
+        return await InfoDeviceFlow(ROOM, USER, ["--group", "kitchen"]).prompt()
+
+    messages = run(scenario())
+
+    assert isinstance(messages, list) and len(messages) > 1
+    assert all(len(message.encode()) <= 2000 for message in messages)
+    assert all(f"lamp{i} </li>" in "".join(messages) for i in range(30))
+
+
+def test_group_membership(run):
+    async def group(*args):
+        return await GroupFlow(ROOM, USER, list(args)).prompt()
+
+    async def scenario():
+        await _devices(3)
+        return [
+            await group("create", "kitchen"),
+            await group("create", "kitchen"),
+            await group("add", "kitchen", "lamp0,lamp1"),
+            # Members already in the group aren't added twice
+            await group("add", "kitchen", "lamp1,lamp2"),
+            await group("add", "kitchen", "lamp1,oven"),
+            await group("remove", "kitchen", "lamp0"),
+            await group("members", "kitchen"),
+            await group("list"),
+            await group("delete", "kitchen"),
+            await group("members", "kitchen"),
+        ]
+
+    assert run(scenario()) == [
+        "Group <strong> kitchen </strong> created.",
+        "❌  Group <strong> kitchen </strong> already exists.",
+        "Added 2 devices to <strong> kitchen </strong>.",
+        "Added 1 devices to <strong> kitchen </strong>.",
+        "❌ There are no registered devices named <strong> oven </strong>.",
+        "Removed 1 devices from <strong> kitchen </strong>.",
+        "<strong> kitchen: </strong> lamp1, lamp2",
+        "<ul> <li> <strong> kitchen </strong> (2 devices) </li> </ul>",
+        "Group <strong> kitchen </strong> deleted.",
+        "❌ There is no group with the name <strong> kitchen </strong>.",
+    ]
@@ -0,0 +1,117 @@
+import asyncio
+
+from mautrix_iot import health
+from mautrix_iot.db.models import Entity
+from mautrix_iot.db.operations import add_device_rooms, create_devices, get_entity_by_name
+from mautrix_iot.health import OFFLINE, ONLINE, HealthMonitor
+from mautrix_iot.routing import DeviceRecord, routing_index
+
+
+class Devices:
+    """Answers pings for the hosts that are up, counting the pings running at once."""
+
+    def __init__(self):
+        self.up = set()
+        self.running = [0, 0]
+
+    async def __call__(self, host):
+        self.running[0] += 1
+        self.running[1] = max(self.running)
+        await asyncio.sleep(0.01)
+        self.running[0] -= 1
+
+        if host in self.up:
+            return {"error": {"code": "OK", "message": ""}, "response": {}}
+        return {"error": {"code": "CONN_ERR", "message": "refused"}, "response": {}}
+
+
+async def _devices(names):
+    await create_devices(
+        [
+            Entity(
+                name=name,
+                host=f"http://{name}.example.com",
+                matrix_id=f"@iot_{name}:matrix.example.com",
+                access_token="token",
+                is_device=True,
+            )
+            for name in names
+        ]
+    )
+    for device in await add_device_rooms(
+        {name: f"!{name}:matrix.example.com" for name in names}, "@alice:matrix.example.com"
+    ):
+        routing_index.add(DeviceRecord.from_entity(device))
+
+
+def test_rooms_hear_about_changes(run, sent, monkeypatch):
+    devices = Devices()
+    devices.up = {"http://lamp.example.com"}
+    monkeypatch.setattr(health, "ping_device", devices)
+    monitor = HealthMonitor(interval=60, jitter=0, concurrency=1)
+
+    async def scenario():
+        await _devices(["lamp", "fan"])
+
+        await monitor.probe_all()
+        first = list(sent)
+        lamp = await get_entity_by_name("lamp")
+        assert (lamp.health_status, lamp.last_latency_ms is not None) == (ONLINE, True)
+
+        # Nothing changed, nothing to say
+        await monitor.probe_all()
+        assert sent == first
+
+        devices.up = {"http://fan.example.com"}
+        await monitor.probe_all()
+        return first, sent[len(first):], await get_entity_by_name("lamp")
+
+    first, changes, lamp = run(scenario())
+
+    assert first == [("!fan:matrix.example.com", "⚠️ Device is offline: refused")]
+    assert sorted(changes) == [
+        ("!fan:matrix.example.com", "✅ Device is back online."),
+        ("!lamp:matrix.example.com", "⚠️ Device is offline: refused"),
+    ]
+    # The last time it was seen is kept while it's down
+    assert (lamp.health_status, lamp.last_seen is not None) == (OFFLINE, True)
+    assert (monitor.rounds, monitor.probes, monitor.online, monitor.offline) == (3, 6, 1, 1)
+    assert devices.running[1] == 1
+
+
+def test_pings_are_limited(run, sent, monkeypatch):
+    devices = Devices()
+    monkeypatch.setattr(health, "ping_device", devices)
+    monitor = HealthMonitor(interval=60, jitter=0.01, concurrency=3)
+
+    async def scenario():
+        await _devices([f"lamp{index}" for index in range(10)])
+        await monitor.probe_all()
+
+    run(scenario())
+
+    assert devices.running[1] == 3
+    assert monitor.offline == 10
+
+
+def test_monitor_resumes_from_saved_status(run, sent, monkeypatch):
+    devices = Devices()
+    monkeypatch.setattr(health, "ping_device", devices)
+
+    async def scenario():
+        await _devices(["lamp"])
+        await HealthMonitor(interval=60, jitter=0, concurrency=1).probe_all()
+        del sent[:]
+
+        # A restarted bridge doesn't announce a device that was already down
+        monitor = HealthMonitor(interval=3600, jitter=0, concurrency=1)
+        await monitor.start()
+        await asyncio.sleep(0.05)
+        await monitor.stop()
+
+        return monitor
+
+    monitor = run(scenario())
+
+    assert sent == []
+    assert monitor.rounds == 1 and monitor.offline == 1
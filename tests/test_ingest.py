@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from mautrix_iot import ratelimit
+from mautrix_iot.ingest import IngestBuffer, format_event
+from mautrix_iot.main import app
+from mautrix_iot.routers import ingest as ingest_router
+from mautrix_iot.routing import DeviceRecord, routing_index
+
+LAMP = DeviceRecord(
+    id=2,
+    name="lamp",
+    host="http://lamp.example.com",
+    matrix_id="@iot_lamp:matrix.example.com",
+    access_token="token",
+    is_device=True,
+    room_id="!lamp:matrix.example.com",
+    ingest_token="ingest-secret",
+)
+
+
+def test_each_device_has_its_own_budget(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    buffer = IngestBuffer(rate=1, burst=2, batch_window=5, max_pending=10)
+    fan = LAMP._replace(id=3, name="fan")
+
+    assert [buffer.allow(LAMP) for _ in range(3)] == [True, True, False]
+    assert buffer.allow(fan)
+
+    now[0] += 1
+    assert buffer.allow(LAMP)
+    assert not buffer.allow(LAMP)
+    assert buffer.rejected == 2
+
+
+def test_events_are_batched(sent):
+    buffer = IngestBuffer(rate=1, burst=2, batch_window=0.01, max_pending=3)
+
+    async def scenario():
+        buffer.add(LAMP, [{"type": "motion"}, {"type": "door", "message": "<open>"}])
+        buffer.add(LAMP, [{"type": "temperature", "data": {"celsius": 21}}, {"type": "light"}])
+        assert buffer.depth == 3
+        await asyncio.sleep(0.05)
+
+    asyncio.run(scenario())
+
+    # The oldest event made room for the last one
+    assert sent == [
+        (
+            LAMP.room_id,
+            "<strong>door</strong> &lt;open&gt;<br>"
+            "<strong>temperature</strong> celsius=<code>21</code><br>"
+            "<strong>light</strong><br>",
+        )
+    ]
+    assert (buffer.accepted, buffer.dropped, buffer.batches, buffer.depth) == (4, 1, 1, 0)
+
+
+def test_closing_sends_what_is_waiting(sent):
+    buffer = IngestBuffer(rate=1, burst=2, batch_window=60, max_pending=10)
+
+    async def scenario():
+        buffer.add(LAMP, [{"type": "motion"}])
+        await buffer.close()
+
+    asyncio.run(scenario())
+
+    assert sent == [(LAMP.room_id, "<strong>motion</strong><br>")]
+
+
+def test_device_data_is_escaped():
+    event = {"type": "<b>", "data": {"<k>": "<v>"}}
+    assert format_event(event) == "<strong>&lt;b&gt;</strong> &lt;k&gt;=<code>&lt;v&gt;</code><br>"
+
+
+@pytest.fixture
+def pushed(monkeypatch):
+    """Events the endpoint accepted, the ingest buffer is left out."""
+    events = []
+    buffer = IngestBuffer(rate=0.001, burst=2, batch_window=60, max_pending=10)
+    monkeypatch.setattr(buffer, "add", lambda device, batch: events.append((device.name, batch)))
+    monkeypatch.setattr(ingest_router, "ingest_buffer", buffer)
+    monkeypatch.setattr(ingest_router.telemetry_store, "record_events", lambda *args: None)
+
+    routing_index.add(LAMP)
+    yield events
+    routing_index.remove(LAMP.matrix_id)
+
+
+@pytest.mark.parametrize(
+    "name, authorization, status",
+    [
+        ("lamp", None, 401),
+        ("lamp", "Bearer wrong", 403),
+        ("oven", "Bearer ingest-secret", 403),
+        ("lamp", "Bearer ingest-secret", 200),
+    ],
+)
+def test_push_needs_the_device_token(pushed, name, authorization, status):
+    headers = {"Authorization": authorization} if authorization else {}
+
+    response = TestClient(app).post(
+        f"/_iot/v1/devices/{name}/events", json={"events": [{"type": "motion"}]}, headers=headers
+    )
+
+    assert response.status_code == status
+
+
+def test_push_is_rate_limited(pushed):
+    client = TestClient(app)
+    headers = {"Authorization": "Bearer ingest-secret"}
+
+    statuses = [
+        client.post(
+            "/_iot/v1/devices/lamp/events", json={"events": [{"type": "motion"}]}, headers=headers
+        ).status_code
+        for _ in range(3)
+    ]
+    invalid = client.post("/_iot/v1/devices/lamp/events", json={"events": ["motion"]}, headers=headers)
+
+    assert statuses == [200, 200, 429]
+    assert invalid.status_code == 400
+    assert pushed == [("lamp", [{"type": "motion"}])] * 2
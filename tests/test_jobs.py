@@ -0,0 +1,226 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+from mautrix_iot import device_api, flows, jobs
+from mautrix_iot.db.models import Entity, Job
+from mautrix_iot.db.operations import (
+    add_device_rooms,
+    create_devices,
+    create_job,
+    get_job,
+    get_recent_jobs,
+)
+from mautrix_iot.flows import BroadcastFlow
+from mautrix_iot.jobs import FAILED, RUNNING, SUCCEEDED, TIMED_OUT, JobManager
+from mautrix_iot.routing import DeviceRecord, routing_index
+
+ROOM = "!lamp:matrix.example.com"
+
+
+async def _device(host: str = "http://lamp.example.com") -> DeviceRecord:
+    await create_devices(
+        [
+            Entity(
+                name="lamp",
+                host=host,
+                matrix_id="@iot_lamp:matrix.example.com",
+                access_token="token",
+                is_device=True,
+            )
+        ]
+    )
+    device, = await add_device_rooms({"lamp": ROOM}, "@alice:matrix.example.com")
+    record = DeviceRecord.from_entity(device)
+    routing_index.add(record)
+
+    return record
+
+
+def test_device_report_finishes_job_once(run, sent):
+    manager = JobManager(poll_interval=10, poll_concurrency=1, timeout=60)
+
+    async def scenario():
+        device = await _device()
+        job = await manager.track(device, "42", "update", [], ROOM, "$event")
+        assert (await get_job(job.id)).status == RUNNING
+
+        assert await manager.report(await get_job(job.id), {"status": "done", "result": {"version": 2}})
+        # A late failure report loses the race, the job stays done
+        assert await manager.report(await get_job(job.id), {"status": "failed"})
+
+        return await get_job(job.id)
+
+    job = run(scenario())
+
+    assert job.status == SUCCEEDED
+    assert job.result == "{'version': 2}"
+    assert job.finished_at is not None
+    assert manager.finished == 1
+    assert len(sent) == 1
+
+
+def test_unknown_report_status_is_ignored(run, sent):
+    manager = JobManager(poll_interval=10, poll_concurrency=1, timeout=60)
+
+    async def scenario():
+        device = await _device()
+        job = await manager.track(device, "42", "update", [], ROOM, None)
+        assert not await manager.report(await get_job(job.id), {"status": "running"})
+
+        return await get_job(job.id)
+
+    assert run(scenario()).status == RUNNING
+    assert sent == []
+
+
+def test_poll_times_out_old_jobs(run, sent, monkeypatch):
+    manager = JobManager(poll_interval=10, poll_concurrency=1, timeout=60)
+
+    async def get_job_status(host, device_job_id):
+        raise AssertionError("Jobs past their timeout are not polled")
+
+    monkeypatch.setattr(jobs, "get_job_status", get_job_status)
+
+    async def scenario():
+        device = await _device()
+        job = await create_job(
+            Job(
+                id="old",
+                entity_id=device.id,
+                device_job_id="42",
+                command="update",
+                args=[],
+                room_id=ROOM,
+                status=RUNNING,
+                created_at=datetime.utcnow() - timedelta(seconds=61),
+            )
+        )
+        await manager.poll()
+
+        return await get_job(job.id)
+
+    job = run(scenario())
+
+    assert job.status == TIMED_OUT
+    assert len(sent) == 1
+
+
+def test_poll_keeps_jobs_of_unreachable_devices(run, sent, monkeypatch):
+    manager = JobManager(poll_interval=10, poll_concurrency=1, timeout=60)
+
+    async def get_job_status(host, device_job_id):
+        return {"error": {"code": "UNREACHABLE", "message": "Could not reach device"}}
+
+    monkeypatch.setattr(jobs, "get_job_status", get_job_status)
+
+    async def scenario():
+        device = await _device()
+        job = await manager.track(device, "42", "update", [], ROOM, None)
+        await manager.poll()
+
+        return await get_job(job.id)
+
+    assert run(scenario()).status == RUNNING
+    assert sent == []
+
+
+def test_recover_fails_background_jobs_of_instance(run, sent):
+    manager = JobManager(poll_interval=10, poll_concurrency=1, timeout=60)
+
+    async def scenario():
+        device = await _device()
+        for id, instance in (("mine", "http://a:8080"), ("other", "http://b:8080")):
+            await create_job(
+                Job(
+                    id=id,
+                    entity_id=device.id,
+                    command="update",
+                    args=[],
+                    room_id=ROOM,
+                    status=RUNNING,
+                    instance=instance,
+                )
+            )
+        await manager.recover("http://a:8080")
+
+        return await get_job("mine"), await get_job("other")
+
+    mine, other = run(scenario())
+
+    assert mine.status == FAILED
+    assert other.status == RUNNING
+    assert len(sent) == 1
+
+
+def test_background_command_outlasts_read_timeout(run, sent, monkeypatch, device_server):
+    monkeypatch.setattr(device_api.client, "read_timeout", 0.1)
+    manager = JobManager(poll_interval=10, poll_concurrency=1, timeout=5)
+
+    async def calibrate(request):
+        await asyncio.sleep(0.3)
+        return web.Response(text="calibrated")
+
+    async def scenario():
+        host = await device_server({("POST", "/api/v1/command"): calibrate})
+        device = await _device(host)
+
+        # The usual timeout still applies to commands answered in the room
+        response = await device_api.send_command(host, "calibrate", [])
+        assert response["error"]["code"] == "TIMEOUT"
+        assert device_api.client.breaker(host).failures == 1
+
+        job = await manager.run_in_background(device, "calibrate", [], ROOM, None)
+        await asyncio.gather(*manager._background)
+
+        return await get_job(job.id), device_api.client.breaker(host).failures
+
+    job, failures = run(scenario())
+
+    assert job.status == SUCCEEDED
+    assert job.result == "calibrated"
+    assert failures == 0
+
+
+def test_background_command_times_out_without_tripping_breaker(
+    run, sent, monkeypatch, device_server
+):
+    manager = JobManager(poll_interval=10, poll_concurrency=1, timeout=0.2)
+
+    async def hang(request):
+        await asyncio.sleep(1)
+        return web.Response(text="too late")
+
+    async def scenario():
+        host = await device_server({("POST", "/api/v1/command"): hang})
+        job = await manager.run_in_background(await _device(host), "calibrate", [], ROOM, None)
+        await asyncio.gather(*manager._background)
+
+        return await get_job(job.id), device_api.client.breaker(host).failures
+
+    job, failures = run(scenario())
+
+    assert job.status == TIMED_OUT
+    assert failures == 0
+
+
+def test_broadcast_tracks_accepted_commands(run, sent, monkeypatch):
+    async def broadcast_command(devices, command, args):
+        accepted = {"error": {"code": "ACCEPTED", "message": ""}, "response": "42"}
+        return [(device, accepted) for device in devices]
+
+    monkeypatch.setattr(flows, "broadcast_command", broadcast_command)
+
+    async def scenario():
+        await _device()
+        flow = BroadcastFlow("!management:matrix.example.com", "@alice:matrix.example.com", ["all", "update"])
+        messages = await flow.prompt()
+        job, = await get_recent_jobs(10)
+
+        return messages, job
+
+    messages, job = run(scenario())
+
+    assert (job.device_job_id, job.command, job.room_id, job.status) == ("42", "update", ROOM, RUNNING)
+    assert f"running as job <code>{job.id}</code>" in messages[0]
@@ -0,0 +1,59 @@
+import json
+import logging
+import sys
+
+from mautrix_iot import log
+from mautrix_iot.configuration import CONF
+from mautrix_iot.log import ContextFilter, JSONFormatter, TextFormatter
+
+
+def _record(msg, *args, exc_info=None) -> logging.LogRecord:
+    return logging.LogRecord("mautrix_iot.test", logging.INFO, __file__, 1, msg, args, exc_info)
+
+
+def test_tokens_are_redacted():
+    context = ContextFilter()
+
+    record = _record(
+        "Sending %s with %s",
+        {"access_token": "secret1", "body": "on"},
+        f"Authorization: Bearer abc.def, hs_token={CONF.appservice['hs_token']}",
+    )
+    context.filter(record)
+
+    message = record.getMessage()
+    assert "secret1" not in message and "abc.def" not in message
+    assert CONF.appservice["hs_token"] not in message
+    assert "'body': 'on'" in message
+    assert message.count("<redacted>") == 3
+
+
+def test_json_entries_carry_the_context():
+    context = ContextFilter()
+    log.request_id.set("req1")
+    try:
+        raise ValueError(f"Rejected {CONF.appservice['as_token']}")
+    except ValueError:
+        record = _record("Failed", exc_info=sys.exc_info())
+        context.filter(record)
+    finally:
+        log.request_id.set(None)
+
+    entry = json.loads(JSONFormatter().format(record))
+
+    assert entry["message"] == "Failed"
+    assert entry["request_id"] == "req1"
+    assert "txn_id" not in entry
+    assert "ValueError: Rejected <redacted>" in entry["exception"]
+    assert record.exc_info is None
+
+
+def test_text_lines_show_the_context():
+    record = _record("Handled")
+    log.txn_id.set("txn1")
+    try:
+        ContextFilter().filter(record)
+    finally:
+        log.txn_id.set(None)
+
+    assert TextFormatter().format(record).endswith("INFO [mautrix_iot.test] (txn_id=txn1) Handled")
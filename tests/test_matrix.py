@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+
+from mautrix_iot import matrix
+from mautrix_iot.catalog import command_catalogs
+from mautrix_iot.db.operations import get_bot_entity
+from mautrix_iot.routing import DeviceRecord, routing_index
+from mautrix_iot.utils import bot_full_name
+
+USER = "@alice:matrix.example.com"
+
+
+@pytest.fixture
+def homeserver(monkeypatch, sent):
+    """Answers every call to the homeserver with 200, and records sent messages."""
+    calls = {"join": [], "leave": [], "sent": sent}
+
+    async def join_room(room_id, **kwargs):
+        calls["join"].append(room_id)
+        return 200, {"room_id": room_id}
+
+    async def leave_room(room_id, **kwargs):
+        calls["leave"].append(room_id)
+        return 200, {}
+
+    monkeypatch.setattr(matrix, "join_room", join_room)
+    monkeypatch.setattr(matrix, "leave_room", leave_room)
+
+    return calls
+
+
+def _invite(room_id):
+    return {
+        "type": "m.room.member",
+        "room_id": room_id,
+        "sender": USER,
+        "state_key": bot_full_name(),
+        "content": {"membership": "invite"},
+    }
+
+
+def _leave(room_id):
+    return {
+        "type": "m.room.member",
+        "room_id": room_id,
+        "sender": USER,
+        "state_key": USER,
+        "user_id": USER,
+        "content": {"membership": "leave"},
+    }
+
+
+def test_new_management_room_after_leave_and_restart(run, homeserver):
+    async def scenario():
+        handler = matrix.EventHandler()
+
+        await handler._handle_event(_invite("!first:matrix.example.com"))
+        assert routing_index.bot.room_id == "!first:matrix.example.com"
+
+        await handler._handle_event(_leave("!first:matrix.example.com"))
+        assert routing_index.bot.room_id is None
+
+        # A restart builds the index from the database again
+        await routing_index.load()
+        assert routing_index.bot.room_id is None
+        assert (await get_bot_entity()).room_id is None
+
+        await handler._handle_event(_invite("!second:matrix.example.com"))
+        assert routing_index.bot.room_id == "!second:matrix.example.com"
+        assert (await get_bot_entity()).room_id == "!second:matrix.example.com"
+
+    run(scenario())
+
+    assert homeserver["leave"] == ["!first:matrix.example.com"]
+    assert not any("already have" in body for _, body in homeserver["sent"])
+
+
+def test_management_room_remembers_inviting_user(run, homeserver):
+    async def scenario():
+        await matrix.EventHandler()._handle_event(_invite("!room:matrix.example.com"))
+
+        return await get_bot_entity()
+
+    bot = run(scenario())
+
+    # Offline provisioning invites this user to the new device rooms
+    assert bot.room.user_matrix_id == USER
+
+
+LAMP = DeviceRecord(
+    id=1,
+    name="lamp",
+    host="http://lamp.example.com",
+    matrix_id="@iot_lamp:matrix.example.com",
+    access_token="token",
+    is_device=True,
+    room_id="!lamp:matrix.example.com",
+)
+
+
+def _command(name):
+    return {"name": name, "alias": name, "description": "", "args": []}
+
+
+@pytest.mark.parametrize(
+    "commands, reply",
+    [
+        ([_command("on")], "The device has not pushed any readings."),
+        ([_command("on"), _command("stats")], "uptime 3d"),
+    ],
+)
+def test_stats_prefers_the_device_command(run, sent, monkeypatch, commands, reply):
+    async def send_command(host, command, args):
+        return {"error": {"code": "OK", "message": ""}, "response": "uptime 3d"}
+
+    monkeypatch.setattr(matrix, "send_command", send_command)
+    command_catalogs.put(LAMP.host, commands)
+
+    async def scenario():
+        event = {"room_id": LAMP.room_id, "sender": USER, "content": {"body": "stats"}}
+        await matrix.EventHandler()._handle_message_with_device(event, LAMP, LAMP.room_id)
+
+    try:
+        run(scenario())
+    finally:
+        command_catalogs.invalidate(LAMP.host)
+
+    assert sent == [(LAMP.room_id, reply)]
+
+
+def test_every_event_of_a_transaction_is_handled(run, monkeypatch):
+    handled = []
+
+    async def handle_event(event):
+        if event["event_id"] == "$broken":
+            raise ValueError("Malformed event")
+        await asyncio.sleep(0.01 if event["room_id"] == "!a" else 0)
+        handled.append(event["event_id"])
+
+    handler = matrix.EventHandler()
+    monkeypatch.setattr(handler, "_handle_event", handle_event)
+    events = [
+        {"type": "m.room.message", "room_id": "!a", "event_id": "$a1"},
+        {"type": "m.room.message", "room_id": "!b", "event_id": "$b1"},
+        {"type": "m.room.message", "room_id": "!a", "event_id": "$broken"},
+        {"type": "m.room.message", "room_id": "!a", "event_id": "$a2"},
+        {"type": "m.room.message", "room_id": "!b", "event_id": "$b2"},
+    ]
+
+    run(handler.determine_and_handle_event({"events": events}))
+
+    # A failing event doesn't stop the others, each room keeps its order
+    assert sorted(handled) == ["$a1", "$a2", "$b1", "$b2"]
+    assert handled.index("$a1") < handled.index("$a2")
+    assert handled.index("$b1") < handled.index("$b2")
+    # Rooms are handled concurrently, the slow room doesn't hold up the other
+    assert handled[:2] == ["$b1", "$b2"]
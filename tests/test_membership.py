@@ -0,0 +1,72 @@
+from mautrix_iot import matrix, membership
+from mautrix_iot.membership import UnknownRoomCache
+
+ROOM = "!unknown:matrix.example.com"
+USER = "@alice:matrix.example.com"
+
+
+def test_rooms_expire_and_are_evicted(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(membership.time, "monotonic", lambda: now[0])
+    cache = UnknownRoomCache(ttl=60, max_size=2)
+
+    cache.remember("!one:x")
+    cache.remember("!two:x")
+    assert "!one:x" in cache and "!two:x" in cache
+
+    # Remembering again moves a room to the back of the line
+    cache.remember("!one:x")
+    cache.remember("!three:x")
+    assert "!two:x" not in cache
+    assert len(cache) == 2
+
+    cache.forget("!three:x")
+    assert "!three:x" not in cache
+
+    now[0] += 61
+    assert "!one:x" not in cache
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def _message(body):
+    return {
+        "type": "m.room.message",
+        "room_id": ROOM,
+        "sender": USER,
+        "content": {"msgtype": "m.text", "body": body},
+    }
+
+
+def test_failed_join_is_not_retried_until_membership_changes(run, sent, monkeypatch):
+    joins = []
+
+    async def join_room(room_id, **kwargs):
+        joins.append(room_id)
+        return 403, {"errcode": "M_FORBIDDEN"}
+
+    monkeypatch.setattr(matrix, "join_room", join_room)
+    monkeypatch.setattr(matrix, "unknown_rooms", UnknownRoomCache(ttl=60, max_size=10))
+
+    async def scenario():
+        handler = matrix.EventHandler()
+
+        await handler._handle_event(_message("help"))
+        await handler._handle_event(_message("help"))
+        assert joins == [ROOM]
+
+        await handler._handle_event(
+            {
+                "type": "m.room.member",
+                "room_id": ROOM,
+                "sender": USER,
+                "state_key": USER,
+                "content": {"membership": "join"},
+            }
+        )
+        await handler._handle_event(_message("help"))
+
+    run(scenario())
+
+    assert joins == [ROOM, ROOM]
+    assert sent == []
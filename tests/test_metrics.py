@@ -0,0 +1,41 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from mautrix_iot.configuration import CONF
+from mautrix_iot.db.database import engine
+from mautrix_iot.main import app
+from mautrix_iot.metrics import homeserver_endpoint_label
+
+
+@pytest.mark.parametrize(
+    "authorization, status",
+    [(None, 401), ("Bearer wrong", 403), (f"Bearer {CONF.appservice['hs_token']}", 200)],
+)
+def test_metrics_need_the_hs_token(authorization, status):
+    headers = {"Authorization": authorization} if authorization else {}
+
+    response = TestClient(app).get("/metrics", headers=headers)
+
+    assert response.status_code == status
+    if status == 200:
+        assert 'mautrix_iot_queue_depth{source="transactions"}' in response.text
+
+
+def test_endpoint_labels_are_bounded():
+    assert homeserver_endpoint_label("rooms/!lamp:x/send/m.room.message/abc") == "rooms/send"
+    assert homeserver_endpoint_label("rooms/!lamp:x/join") == "rooms/join"
+    assert homeserver_endpoint_label("register") == "register"
+
+
+def test_failed_statement_is_not_left_timing(run):
+    async def scenario():
+        async with engine.connect() as connection:
+            with pytest.raises(OperationalError):
+                await connection.execute(text("SELECT * FROM missing"))
+            await connection.execute(text("SELECT 1"))
+
+            return list(connection.sync_connection.info["query_start"])
+
+    assert run(scenario()) == []
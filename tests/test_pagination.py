@@ -0,0 +1,108 @@
+from mautrix_iot.configuration import CONF
+from mautrix_iot.db.models import Entity
+from mautrix_iot.db.operations import (
+    add_group_members,
+    count_devices,
+    create_devices,
+    create_group,
+    get_device_page,
+    get_device_page_start,
+)
+from mautrix_iot.flows import ListDevicesFlow
+
+ROOM = "!management:matrix.example.com"
+USER = "@alice:matrix.example.com"
+NAMES = ["lamp1", "lamp2", "fan_1", "lamp3", "fanx1", "lamp4", "heater"]
+
+
+async def _devices():
+    devices = await create_devices(
+        [
+            Entity(
+                name=name,
+                host=f"http://{name}.example.com",
+                matrix_id=f"@iot_{name}:matrix.example.com",
+                access_token="token",
+                is_device=True,
+            )
+            for name in NAMES
+        ]
+    )
+    await add_group_members(await create_group("kitchen"), devices[::2])
+
+
+async def _pages(page_size, **filters):
+    pages = []
+    page = 1
+    while (after_id := await get_device_page_start(page, page_size, **filters)) is not None:
+        rows = await get_device_page(after_id, page_size, **filters)
+        if not rows:
+            break
+        pages.append([row.name for row in rows])
+        page += 1
+
+    return pages
+
+
+def test_pages_follow_the_id_order(run):
+    async def scenario():
+        await _devices()
+        return (
+            await _pages(3),
+            await _pages(2, group="kitchen"),
+            await _pages(3, name_filter="_"),
+            await count_devices(),
+            await count_devices(name_filter="1"),
+            await count_devices(group="kitchen"),
+            await get_device_page_start(5, 3),
+        )
+
+    everything, kitchen, underscore, total, ones, in_kitchen, past_the_end = run(scenario())
+
+    assert everything == [NAMES[0:3], NAMES[3:6], NAMES[6:]]
+    assert kitchen == [["lamp1", "fan_1"], ["fanx1", "heater"]]
+    # Wildcards in the filter are matched literally
+    assert underscore == [["fan_1"]]
+    assert (total, ones, in_kitchen) == (7, 3, 4)
+    assert past_the_end is None
+
+
+def test_list_pages(run, monkeypatch):
+    monkeypatch.setitem(CONF.conf, "devices", {"list_page_size": 2})
+
+    async def scenario():
+        await _devices()
+        return [
+            await ListDevicesFlow(ROOM, USER, args).prompt()
+            for args in (
+                ["2", "--group", "kitchen"],
+                ["--filter", "fan"],
+                ["3", "--filter", "fan"],
+                ["--filter", "oven"],
+                ["0"],
+            )
+        ]
+
+    second, fans, past_the_end, nothing, invalid = run(scenario())
+
+    text = "".join(second)
+    assert text.startswith("Devices 3-4 of 4: ")
+    assert "fanx1" in text and "heater" in text and "lamp1" not in text
+    assert "for the next page" not in text
+    assert "".join(fans).startswith("Devices 1-2 of 2: ")
+    assert past_the_end == "❌  There are only 1 pages."
+    assert nothing == "There are no devices matching the filters."
+    assert invalid == "❌  Page must be a positive number."
+
+
+def test_list_points_to_the_next_page(run, monkeypatch):
+    monkeypatch.setitem(CONF.conf, "devices", {"list_page_size": 3})
+
+    async def scenario():
+        await _devices()
+        return await ListDevicesFlow(ROOM, USER, ["--filter", "a"]).prompt()
+
+    text = "".join(run(scenario()))
+
+    assert text.startswith("Devices 1-3 of 7: ")
+    assert text.endswith(" Send <strong> list 2 --filter a </strong> for the next page.")
@@ -0,0 +1,108 @@
+import pytest
+
+from mautrix_iot import flows
+from mautrix_iot.configuration import CONF
+from mautrix_iot.flows import ImportDevicesFlow
+from mautrix_iot.provisioning import ManifestEntry, load_manifest
+
+
+def _write(path, content):
+    path.write_text(content)
+    return str(path)
+
+
+def test_yaml_manifest(tmp_path):
+    path = _write(
+        tmp_path / "devices.yaml",
+        "devices:\n"
+        "  - name: lamp\n"
+        "    host: http://lamp.example.com\n"
+        "    group: kitchen\n"
+        "  - {name: ' fan ', host: 'http://fan.example.com'}\n",
+    )
+
+    assert load_manifest(path) == [
+        ManifestEntry("lamp", "http://lamp.example.com", "kitchen"),
+        ManifestEntry("fan", "http://fan.example.com", None),
+    ]
+
+
+def test_yaml_manifest_top_level_list(tmp_path):
+    path = _write(tmp_path / "devices.yml", "- {name: lamp, host: 'http://lamp.example.com'}\n")
+
+    assert load_manifest(path) == [ManifestEntry("lamp", "http://lamp.example.com")]
+
+
+def test_csv_manifest(tmp_path):
+    path = _write(
+        tmp_path / "devices.csv",
+        "name,host,group\nlamp,http://lamp.example.com,kitchen\nfan,http://fan.example.com,\n",
+    )
+
+    assert load_manifest(path) == [
+        ManifestEntry("lamp", "http://lamp.example.com", "kitchen"),
+        ManifestEntry("fan", "http://fan.example.com", None),
+    ]
+
+
+def test_empty_manifest(tmp_path):
+    assert load_manifest(_write(tmp_path / "devices.yaml", "")) == []
+
+
+@pytest.mark.parametrize(
+    "name, content, message",
+    [
+        ("devices.json", "[]", "must be a .yaml, .yml or .csv file"),
+        ("devices.yaml", "devices: lamp\n", "must be a list of devices"),
+        ("devices.yaml", "- {name: lamp}\n", "Device 1 needs a name and a host"),
+        ("devices.yaml", "- {name: lamp, host: 'http://a'}\n- lamp\n", "Device 2 needs a name and a host"),
+        ("devices.csv", "name,host\n,http://lamp.example.com\n", "Device 1 needs a name and a host"),
+        (
+            "devices.yaml",
+            "- {name: lamp, host: 'http://a'}\n- {name: lamp, host: 'http://b'}\n",
+            "Device lamp is listed twice",
+        ),
+    ],
+)
+def test_invalid_manifest(tmp_path, name, content, message):
+    with pytest.raises(ValueError, match=message):
+        load_manifest(_write(tmp_path / name, content))
+
+
+@pytest.fixture
+def import_directory(tmp_path, monkeypatch):
+    directory = tmp_path / "manifests"
+    directory.mkdir()
+    monkeypatch.setitem(
+        CONF.conf, "devices", {**CONF.get("devices", {}), "import_directory": str(directory)}
+    )
+    monkeypatch.setattr(flows.device_importer, "start", lambda *args: None)
+
+    return directory
+
+
+def _import(run, *args):
+    flow = ImportDevicesFlow("!management:matrix.example.com", "@alice:matrix.example.com", list(args))
+    return run(flow.prompt())
+
+
+def test_import_from_directory(run, import_directory):
+    _write(import_directory / "devices.yaml", "- {name: lamp, host: 'http://lamp.example.com'}\n")
+
+    assert _import(run, "devices.yaml") == "Importing 1 devices, progress will be posted here."
+
+
+@pytest.mark.parametrize("path", ["../secret.yaml", "/etc/passwd", "missing.yaml"])
+def test_import_outside_directory(run, import_directory, path):
+    _write(import_directory.parent / "secret.yaml", "- {name: lamp, host: 'http://lamp.example.com'}\n")
+
+    assert "no such manifest" in _import(run, path)
+
+
+def test_import_hides_parser_errors(run, import_directory):
+    _write(import_directory / "devices.yaml", "- {name: lamp, host: [secret\n")
+
+    message = _import(run, "devices.yaml")
+
+    assert "Could not read the manifest" in message
+    assert "secret" not in message
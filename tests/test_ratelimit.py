@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from mautrix_iot import homeserver_api, ratelimit
+from mautrix_iot.configuration import CONF
+from mautrix_iot.exceptions import RateLimitedError
+from mautrix_iot.ratelimit import RateLimiter, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_allows_a_burst_then_refills(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+    clock.now += 0.5
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+
+    # Never more than the capacity, however long it stayed idle
+    clock.now += 60
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+
+def test_each_identity_has_its_own_bucket(clock, monkeypatch):
+    slept = []
+
+    async def sleep(delay):
+        slept.append(delay)
+        clock.now += delay
+
+    monkeypatch.setattr(ratelimit.asyncio, "sleep", sleep)
+    limiter = RateLimiter(rate=10, burst=1, max_retries=3)
+
+    async def scenario():
+        await limiter.acquire("alice")
+        await limiter.acquire("bob")
+        await limiter.acquire("alice")
+
+    asyncio.run(scenario())
+
+    assert slept == [pytest.approx(0.1)]
+    assert limiter.throttled_requests == 1
+    assert limiter.throttled_seconds == pytest.approx(0.1)
+
+
+def test_backoff_honors_retry_after():
+    limiter = RateLimiter(rate=10, burst=1, max_retries=3, base_delay=0.5, max_delay=4)
+
+    for _ in range(100):
+        assert 2 <= limiter.backoff(0, retry_after=2) <= 2.25
+        assert 0.2 <= limiter.backoff(0, retry_after=0.2) <= 0.25
+        assert 0 <= limiter.backoff(1) <= 1
+        assert 0 <= limiter.backoff(10) <= 4
+
+
+def _run(coroutine):
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            await homeserver_api.client.close()
+
+    return asyncio.run(main())
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    """No waiting between retries, the delays asked for are recorded instead."""
+    limiter = RateLimiter(rate=1000, burst=1000, max_retries=2)
+    waits = []
+
+    async def wait_before_retry(attempt, retry_after=None):
+        waits.append((attempt, retry_after))
+        limiter.retries += 1
+
+    limiter.waits = waits
+    monkeypatch.setattr(limiter, "wait_before_retry", wait_before_retry)
+    monkeypatch.setattr(homeserver_api, "rate_limiter", limiter)
+
+    return limiter
+
+
+def _homeserver(monkeypatch, device_server, statuses):
+    """Answers sent messages with each status in turn, recording the paths and bodies."""
+    requests = []
+
+    async def send(request):
+        requests.append((request.path, await request.json()))
+        status = statuses.pop(0)
+        if status == 429:
+            return web.json_response(
+                {"errcode": "M_LIMIT_EXCEEDED", "retry_after_ms": 1500}, status=429
+            )
+        return web.json_response({"event_id": "$event"}, status=status)
+
+    async def serve():
+        url = await device_server(
+            {("PUT", "/_matrix/client/v3/rooms/{room_id}/send/m.room.message/{txn_id}"): send}
+        )
+        monkeypatch.setitem(CONF.homeserver, "address", url)
+
+    return requests, serve
+
+
+def test_rate_limited_request_is_retried(monkeypatch, device_server, limiter):
+    requests, serve = _homeserver(monkeypatch, device_server, [429, 429, 200])
+
+    async def scenario():
+        await serve()
+        return await homeserver_api.send_message("hello", "!lamp:matrix.example.com", "@bot")
+
+    assert _run(scenario()) == (200, {"event_id": "$event"})
+
+    assert limiter.waits == [(0, 1.5), (1, 1.5)]
+    # Sent again as is, the homeserver dedupes it by transaction ID
+    assert len(requests) == 3
+    assert len(set(path for path, _ in requests)) == 1
+    assert all(body["body"] == "hello" for _, body in requests)
+
+
+def test_rate_limited_request_gives_up(monkeypatch, device_server, limiter):
+    requests, serve = _homeserver(monkeypatch, device_server, [429, 429, 429, 200])
+
+    async def scenario():
+        await serve()
+        await homeserver_api.send_message("hello", "!lamp:matrix.example.com", "@bot")
+
+    with pytest.raises(RateLimitedError):
+        _run(scenario())
+
+    assert len(requests) == 3
+    assert limiter.retries == 2
@@ -0,0 +1,79 @@
+from mautrix_iot.db.models import Entity
+from mautrix_iot.db.operations import add_device_rooms, create_devices
+from mautrix_iot.routing import DeviceRecord, RoutingIndex
+from mautrix_iot.utils import bot_full_name
+
+LAMP = DeviceRecord(
+    id=1,
+    name="lamp",
+    host="http://lamp.example.com",
+    matrix_id="@iot_lamp:matrix.example.com",
+    access_token="token",
+    is_device=True,
+    room_id="!lamp:matrix.example.com",
+)
+
+
+def test_lookups():
+    index = RoutingIndex()
+    index.add(LAMP)
+
+    assert index.for_room(LAMP.room_id) is LAMP
+    assert index.for_room("!unknown:matrix.example.com") is None
+    assert index.for_matrix_id(LAMP.matrix_id) is LAMP
+    assert index.for_name("lamp") is LAMP
+    assert index.devices() == [LAMP]
+    assert (index.hits, index.misses) == (1, 1)
+
+
+def test_moving_room_drops_the_old_one():
+    index = RoutingIndex()
+    index.add(LAMP)
+
+    index.set_room(LAMP.matrix_id, "!new:matrix.example.com")
+    assert index.for_room(LAMP.room_id) is None
+    assert index.for_room("!new:matrix.example.com").name == "lamp"
+
+    index.set_room(LAMP.matrix_id, None)
+    assert index.for_room("!new:matrix.example.com") is None
+    assert index.for_name("lamp").room_id is None
+
+
+def test_removed_entity_is_forgotten():
+    index = RoutingIndex()
+    index.add(LAMP)
+    index.remove(LAMP.matrix_id)
+
+    assert len(index) == 0
+    assert index.for_room(LAMP.room_id) is None
+    assert index.for_name("lamp") is None
+
+
+def test_load_from_database(run):
+    index = RoutingIndex()
+
+    async def scenario():
+        await create_devices(
+            [
+                Entity(
+                    name="lamp",
+                    host="http://lamp.example.com",
+                    matrix_id="@iot_lamp:matrix.example.com",
+                    access_token="token",
+                    is_device=True,
+                )
+            ]
+        )
+        await add_device_rooms({"lamp": "!lamp:matrix.example.com"}, "@alice:matrix.example.com")
+        await index.load()
+
+        # Found in the database when another instance registered it
+        other = RoutingIndex()
+        return await other.load_room("!lamp:matrix.example.com"), other
+
+    record, other = run(scenario())
+
+    assert index.bot.matrix_id == bot_full_name()
+    assert index.for_room("!lamp:matrix.example.com").name == "lamp"
+    assert record.name == "lamp"
+    assert other.for_room("!lamp:matrix.example.com") == record
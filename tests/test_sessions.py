@@ -0,0 +1,120 @@
+from mautrix_iot import sessions
+from mautrix_iot.db.operations import get_flow_session
+from mautrix_iot.flows import HelpFlow, RegisterDeviceFlow
+from mautrix_iot.sessions import FlowSessionManager
+
+ROOM = "!management:matrix.example.com"
+ALICE = "@alice:matrix.example.com"
+BOB = "@bob:matrix.example.com"
+CAROL = "@carol:matrix.example.com"
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(sessions.time, "monotonic", clock)
+    return clock
+
+
+def test_flows_are_kept_per_sender(run):
+    manager = FlowSessionManager(ttl=60, max_sessions=10, persist=False)
+
+    async def scenario():
+        flow = RegisterDeviceFlow(ROOM, ALICE, [])
+        await manager.save(ROOM, ALICE, flow)
+
+        assert await manager.get(ROOM, ALICE) is flow
+        assert await manager.get(ROOM, BOB) is None
+        assert await manager.get("!other:matrix.example.com", ALICE) is None
+
+    run(scenario())
+
+
+def test_finished_flows_are_discarded(run):
+    manager = FlowSessionManager(ttl=60, max_sessions=10, persist=False)
+
+    async def scenario():
+        await manager.save(ROOM, ALICE, RegisterDeviceFlow(ROOM, ALICE, []))
+
+        flow = HelpFlow(ROOM, ALICE, [])
+        await flow.prompt()
+        await manager.save(ROOM, ALICE, flow)
+
+        return await manager.get(ROOM, ALICE)
+
+    assert run(scenario()) is None
+    assert len(manager) == 0
+
+
+def test_idle_flows_expire(run, monkeypatch):
+    clock = _clock(monkeypatch)
+    manager = FlowSessionManager(ttl=60, max_sessions=10, persist=False)
+
+    async def scenario():
+        await manager.save(ROOM, ALICE, RegisterDeviceFlow(ROOM, ALICE, []))
+        await manager.save(ROOM, BOB, RegisterDeviceFlow(ROOM, BOB, []))
+
+        clock.now += 50
+        # Using a flow keeps it alive
+        assert await manager.get(ROOM, ALICE) is not None
+
+        clock.now += 20
+        assert await manager.get(ROOM, BOB) is None
+        assert await manager.get(ROOM, ALICE) is not None
+
+    run(scenario())
+
+
+def test_least_recently_used_flow_is_evicted(run, monkeypatch):
+    clock = _clock(monkeypatch)
+    manager = FlowSessionManager(ttl=60, max_sessions=2, persist=False)
+
+    async def scenario():
+        for sender in (ALICE, BOB):
+            await manager.save(ROOM, sender, RegisterDeviceFlow(ROOM, sender, []))
+            clock.now += 1
+
+        await manager.get(ROOM, ALICE)
+        await manager.save(ROOM, CAROL, RegisterDeviceFlow(ROOM, CAROL, []))
+
+        assert len(manager) == 2
+        assert await manager.get(ROOM, BOB) is None
+        assert await manager.get(ROOM, ALICE) is not None
+
+    run(scenario())
+
+
+def test_persisted_flow_resumes_after_restart(run):
+    async def scenario():
+        flow = RegisterDeviceFlow(ROOM, ALICE, [])
+        await flow.send("lamp")
+        await FlowSessionManager(ttl=60, max_sessions=10, persist=True).save(ROOM, ALICE, flow)
+
+        return await FlowSessionManager(ttl=60, max_sessions=10, persist=True).get(ROOM, ALICE)
+
+    flow = run(scenario())
+
+    assert isinstance(flow, RegisterDeviceFlow)
+    assert flow.state_index == 1
+    assert flow.props == {"device_name": "lamp"}
+    assert run(flow.prompt()) == "What is the device host? (e.g. http://192.168.1.5:35329)"
+
+
+def test_expired_persisted_flow_is_deleted(run):
+    async def scenario():
+        await FlowSessionManager(ttl=60, max_sessions=10, persist=True).save(
+            ROOM, ALICE, RegisterDeviceFlow(ROOM, ALICE, [])
+        )
+
+        flow = await FlowSessionManager(ttl=0, max_sessions=10, persist=True).get(ROOM, ALICE)
+        return flow, await get_flow_session(ROOM, ALICE)
+
+    assert run(scenario()) == (None, None)
+
@@ -0,0 +1,140 @@
+from array import array
+
+from sqlalchemy import text
+
+from mautrix_iot import telemetry
+from mautrix_iot.db.database import engine
+from mautrix_iot.telemetry import HOUR, MAX_CHUNK_SPAN, MINUTE, TelemetryStore
+
+
+def _store(**kwargs) -> TelemetryStore:
+    options = {
+        "flush_interval": 5,
+        "max_buffered": 10000,
+        "raw_retention": 2000 * HOUR,
+        "minute_retention": 7 * 24 * HOUR,
+        "hour_retention": 365 * 24 * HOUR,
+        "retention_interval": HOUR,
+    }
+    options.update(kwargs)
+    return TelemetryStore(**options)
+
+
+def test_long_spans_are_split_into_chunks(run, monkeypatch):
+    inserted = []
+
+    async def insert_telemetry(chunks, rollups):
+        inserted.append((chunks, rollups))
+
+    monkeypatch.setattr(telemetry, "insert_telemetry", insert_telemetry)
+    store = _store()
+    start = 1_700_000_000.0
+    # 60 days apart, more than uint32 milliseconds can hold
+    store.record(1, "temperature", 20.5, start)
+    store.record(1, "temperature", 21.5, start + 1.5)
+    store.record(1, "temperature", 22.5, start + 60 * 24 * HOUR)
+
+    run(store.flush())
+
+    chunks, rollups = inserted[0]
+    assert [(chunk["start"], chunk["count"]) for chunk in chunks] == [
+        (start, 2),
+        (start + 60 * 24 * HOUR, 1),
+    ]
+    assert list(array("I", chunks[0]["offsets"])) == [0, 1500]
+    assert list(array("d", chunks[0]["values"])) == [20.5, 21.5]
+    assert len(rollups) == 2
+    assert store.flushes == 1 and store.failed == 0
+
+
+def test_failed_flush_is_counted(run, monkeypatch):
+    async def insert_telemetry(chunks, rollups):
+        raise RuntimeError("database is gone")
+
+    monkeypatch.setattr(telemetry, "insert_telemetry", insert_telemetry)
+    store = _store()
+    store.record(1, "temperature", 20.5, 1_700_000_000.0)
+
+    run(store.flush())
+
+    assert store.failed == 1
+    assert store.depth == 0
+
+
+def test_max_chunk_span_fits_offsets():
+    array("I", [MAX_CHUNK_SPAN * 1000])
+
+
+NOW = 1_700_000_000.0
+DAY = 24 * HOUR
+
+
+def test_retention_downsamples_and_prunes(run, monkeypatch):
+    monkeypatch.setattr(telemetry.time, "time", lambda: NOW)
+    store = _store(raw_retention=HOUR, minute_retention=DAY, hour_retention=30 * DAY)
+    hour = (NOW - 2 * DAY) // HOUR * HOUR
+
+    async def scenario():
+        store.record(1, "temperature", 99, NOW - 40 * DAY)
+        store.record(1, "temperature", 10, hour + 60)
+        store.record(1, "temperature", 20, hour + 180)
+        await store.flush()
+        store.record(1, "temperature", 5, NOW - 60)
+        await store.flush()
+
+        await store.apply_retention()
+
+        async with engine.connect() as connection:
+            rollups = (
+                await connection.execute(
+                    text(
+                        "SELECT resolution, bucket, count, min, max, sum FROM telemetry_rollups"
+                        " ORDER BY bucket"
+                    )
+                )
+            ).all()
+            chunks = (await connection.execute(text("SELECT start FROM telemetry_chunks"))).all()
+
+        # Readings not flushed yet are part of the summaries
+        store.record(1, "temperature", 50, NOW)
+        store.record(1, "humidity", 40, NOW)
+
+        return (
+            rollups,
+            chunks,
+            await store.summary(1, "temperature", 3 * DAY),
+            await store.summary(1, "temperature", 30 * MINUTE),
+            await store.summary(1, "pressure", DAY),
+            await store.metrics(1),
+        )
+
+    rollups, chunks, days, recent, missing, metrics = run(scenario())
+
+    minute = int((NOW - 60) // MINUTE * MINUTE)
+    assert rollups == [(HOUR, hour, 2, 10, 20, 30), (MINUTE, minute, 1, 5, 5, 5)]
+    assert chunks == [(NOW - 60,)]
+    assert (days.count, days.min, days.max, days.sum) == (4, 5, 50, 85)
+    assert recent.avg == 27.5
+    assert missing is None
+    assert metrics == ["humidity", "temperature"]
+
+
+def test_only_numbers_are_recorded(monkeypatch):
+    monkeypatch.setattr(telemetry.time, "time", lambda: NOW)
+    store = _store(raw_retention=HOUR)
+
+    store.record_events(
+        1,
+        [
+            {"ts": NOW - 10, "data": {"temperature": 21, "on": True, "name": "lamp"}},
+            {"type": "motion", "data": "moved"},
+            # Too far in the future, taken as sent now
+            {"ts": NOW + HOUR, "data": {"temperature": 22.5}},
+            {"ts": "yesterday", "data": {"humidity": 40}},
+        ],
+    )
+
+    times, values = store._buffer[(1, "temperature")]
+    assert (list(times), list(values)) == ([NOW - 10, NOW], [21, 22.5])
+    assert list(store._buffer[(1, "humidity")][0]) == [NOW]
+    assert store.depth == 3
@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+
+from mautrix_iot.db.operations import is_transaction_processed, prune_transactions
+from mautrix_iot.routers import api
+from mautrix_iot.transactions import TransactionStore
+
+
+def test_finished_transaction_is_skipped(run):
+    store = TransactionStore(cache_size=10)
+
+    async def scenario():
+        assert await store.begin("1")
+        await store.finish("1")
+
+        assert not await store.begin("1")
+        # A restart only has the database left
+        assert not await TransactionStore(cache_size=10).begin("1")
+
+    run(scenario())
+
+
+def test_retry_while_handling_is_skipped(run):
+    store = TransactionStore(cache_size=10)
+
+    async def scenario():
+        assert await store.begin("1")
+        assert not await store.begin("1")
+
+        # Failed to queue it, the homeserver's next retry goes through
+        await store.abort("1")
+        assert await store.begin("1")
+        assert not await is_transaction_processed("1")
+
+    run(scenario())
+
+
+def test_evicted_transactions_are_found_in_the_database(run):
+    store = TransactionStore(cache_size=2)
+
+    async def scenario():
+        for txn_id in ("1", "2", "3"):
+            await store.begin(txn_id)
+            await store.finish(txn_id)
+
+        assert len(store) == 2
+        assert await store.is_processed("1")
+        assert len(store) == 2 and "1" in store._cache
+
+    run(scenario())
+
+
+def test_old_transactions_are_pruned(run):
+    store = TransactionStore(cache_size=10)
+
+    async def scenario():
+        await store.begin("1")
+        await store.finish("1")
+
+        await prune_transactions(datetime.utcnow() - timedelta(days=1))
+        assert await is_transaction_processed("1")
+
+        await prune_transactions(datetime.utcnow() + timedelta(seconds=1))
+        return await is_transaction_processed("1")
+
+    assert not run(scenario())
+
+
+def test_retried_transaction_is_queued_once(run, monkeypatch):
+    queued = []
+
+    async def put(item):
+        queued.append(item)
+
+    monkeypatch.setattr(api, "transaction_store", TransactionStore(cache_size=10))
+    monkeypatch.setattr(api.work_queue, "put", put)
+
+    async def scenario():
+        await api.queue_transaction("1", {"events": [{"type": "m.room.message"}]})
+        await api.queue_transaction("1", {"events": [{"type": "m.room.message"}]})
+
+    run(scenario())
+
+    assert queued == [("1", {"events": [{"type": "m.room.message"}]})]
+
+
+def test_shared_store_claims_in_the_database(run):
+    first = TransactionStore(cache_size=10, shared=True)
+    second = TransactionStore(cache_size=10, shared=True)
+
+    async def scenario():
+        assert await first.begin("1")
+        assert not await second.begin("1")
+
+        await first.abort("1")
+        assert await second.begin("1")
+        await second.finish("1")
+        assert not await first.begin("1")
+
+    run(scenario())
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from mautrix_iot.work_queue import WorkQueue
+
+
+def test_put_before_start_is_refused():
+    async def handler(item):
+        pass
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(WorkQueue(handler, max_size=1, workers=1).put(1))
+
+
+def test_stop_drains_queued_items():
+    handled = []
+
+    async def handler(item):
+        await asyncio.sleep(0.01)
+        if item == 3:
+            raise ValueError("Bad item")
+        handled.append(item)
+
+    async def scenario():
+        queue = WorkQueue(handler, max_size=10, workers=2)
+        await queue.start()
+        for item in range(6):
+            await queue.put(item)
+
+        await queue.stop(timeout=5)
+
+        with pytest.raises(RuntimeError):
+            await queue.put(6)
+
+        return queue
+
+    queue = asyncio.run(scenario())
+
+    assert sorted(handled) == [0, 1, 2, 4, 5]
+    assert (queue.enqueued, queue.processed, queue.failed) == (6, 5, 1)
+    assert queue.busy_workers == 0
+
+
+def test_full_queue_pushes_back():
+    release = asyncio.Event()
+
+    async def handler(item):
+        await release.wait()
+
+    async def scenario():
+        queue = WorkQueue(handler, max_size=2, workers=1)
+        await queue.start()
+
+        # One item held by the worker, two waiting in the queue
+        for item in range(3):
+            await queue.put(item)
+            await asyncio.sleep(0)
+        assert queue.depth == 2
+
+        blocked = asyncio.create_task(queue.put(3))
+        await asyncio.sleep(0.05)
+        assert not blocked.done()
+
+        release.set()
+        await blocked
+        await queue.stop(timeout=5)
+
+        return queue
+
+    queue = asyncio.run(scenario())
+
+    assert queue.blocked_puts == 1
+    assert queue.blocked_seconds >= 0.04
+    assert queue.max_depth == 2
+    assert queue.processed == 4
+
+
+def test_stop_gives_up_after_timeout():
+    async def handler(item):
+        await asyncio.sleep(10)
+
+    async def scenario():
+        queue = WorkQueue(handler, max_size=10, workers=1)
+        await queue.start()
+        for item in range(3):
+            await queue.put(item)
+
+        await asyncio.wait_for(queue.stop(timeout=0.05), 1)
+
+        return queue
+
+    queue = asyncio.run(scenario())
+
+    assert queue.processed == 0